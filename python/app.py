@@ -1,52 +1,209 @@
-import base64
-import io
-import sys
+import os
+import threading
 from urllib.parse import quote
 
-import qrcode
-import requests
-from flask import Flask, jsonify, redirect, render_template, request, session
+from flask import Flask, Response, jsonify, redirect, request, session
 from loguru import logger
 
 from flask_session import Session
-from services.pay.wechat_pay import WeChatPay
-from services.transfer.create_transfer import CreateTransfer
-
-# 配置日志
-logger.remove()  # 清除默认的控制台输出
-logger.add(
-    sys.stdout,
-    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
-    level="INFO",
-)
-logger.add(
-    "logs/wechat_pay_{time:YYYY-MM-DD}.log",
-    rotation="00:00",
-    retention="30 days",
-    format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {name}:{function}:{line} - {message}",
-    level="INFO",
-    encoding="utf-8",
-)
+from services import deadline
+from services.admission import install_admission, readiness
+from services.audit_log import audit_log
+from services.endpoints import endpoint_stats
+from services.idempotency import install_idempotency
+from services.log import install_request_logging, payload, setup_logging
+from services.ids import new_out_bill_no, new_out_refund_no
+from services.merchant import KEY_CACHE, merchant_registry
+from services.metrics import REGISTRY, install_route_metrics, render_metrics, timed
+from services.models import Order, Refund, TransferBill
+from services.notification import Notification
+from services.outbox import REFUND, TRANSFER, outbox
+from services.pay.constants import OAUTH_TIMEOUT
+from services.pay.order_expiry import order_expiry
+from services.pay.qr import render_qr_base64
+from services.pay.refund_jobs import parse_items, refund_job_store, start_refund_job, watch_interrupted_jobs
+from services.pay.refund_ledger import refund_ledger, refund_reconciler
+from services.pay.wechat_pay import get_wechat_pay
+from services.rollups import PAYMENT, rollups
+from services.session_store import configure_session
+from services.shared_state import shared_state
+from services.static_pages import StaticPages
+from services.tracing import current_span, install_tracing, start_span
+from services.traffic import install_traffic_recorder
+from services.upstream_health import UPSTREAM
+from services.transfer.constants import MAX_TRANSFER_AMOUNT, MIN_TRANSFER_AMOUNT
+from services.transfer.create_transfer import get_create_transfer
+
+# 配置日志，sink 在后台线程写出
+setup_logging()
 
 app = Flask(__name__)
-wechat_pay = WeChatPay()
+install_request_logging(app)
+deadline.install_deadline(app)
+install_route_metrics(app)
+admission = install_admission(app)
+install_tracing(app)
+install_traffic_recorder(app)
+idempotency_store = install_idempotency(app, admission)
+REGISTRY.start_flusher()
+# 页面只渲染、压缩一次，之后直接返回缓存的字节
+static_pages = StaticPages(app, os.getenv("STATIC_PAGE_CACHE_CONTROL", "no-cache"))
 
 
+OUTBOX_ASYNC = os.getenv("OUTBOX_MODE", "sync").lower() == "async"
+
 app.secret_key = "your_secret_key"  # session需要密钥
-app.config["SESSION_TYPE"] = "filesystem"
+# 会话存储后端通过 SESSION_BACKEND 环境变量选择: memory | sqlite | filesystem
+session_store = configure_session(app)
 Session(app)
+REGISTRY.register_gauge_callback(
+    "session_store_stats", f"会话存储({session_store.backend})命中率与淘汰统计", "stat", session_store.stats
+)
+if idempotency_store is not None:
+    REGISTRY.register_gauge_callback(
+        "idempotency_stats", "幂等请求重放、等待与冲突统计", "stat", idempotency_store.stats
+    )
+REGISTRY.register_gauge_callback("outbox_stats", "发件箱派发统计", "stat", lambda: outbox().stats())
+REGISTRY.register_gauge_callback(
+    "shared_state_stats", "共享状态表统计", "stat", lambda: shared_state().stats()
+)
+REGISTRY.register_gauge_callback("rollup_stats", "汇总统计写入", "stat", lambda: rollups().stats())
+REGISTRY.register_gauge_callback(
+    "audit_log_stats", "审计日志写入统计", "stat", lambda: audit_log().stats() if audit_log() is not None else {}
+)
+if admission is not None:
+    REGISTRY.register_gauge_callback("bulkhead_stats", "按路由的并发、排队与拒绝统计", "stat", admission.stats)
+REGISTRY.register_gauge_callback("upstream_stats", "微信支付请求耗时、失败率与连接池占用", "stat", UPSTREAM.stats)
+REGISTRY.register_gauge_callback("endpoint_stats", "微信支付各域名的耗时、失败率、切换与对冲统计", "stat", endpoint_stats)
+REGISTRY.register_gauge_callback("merchant_key_cache_stats", "商户密钥缓存统计", "stat", KEY_CACHE.stats)
+REGISTRY.register_gauge_callback(
+    "merchant_client_cache_stats", "商户客户端缓存统计", "stat", lambda: merchant_registry().client_stats()
+)
+REGISTRY.register_gauge_callback(
+    "refund_reconcile_stats", "退款对账统计", "stat", lambda: refund_reconciler().stats()
+)
+REGISTRY.register_gauge_callback(
+    "order_expiry_stats", "超时关单统计", "stat", lambda: order_expiry().stats()
+)
+
+
+def current_mch_id():
+    """当前请求的商户号: X-Mch-Id 请求头、查询参数或 JSON 包体中的 mch_id，都没有时使用默认商户"""
+    data = request.get_json(silent=True)
+    return (
+        request.headers.get("X-Mch-Id")
+        or request.args.get("mch_id")
+        or (data.get("mch_id") if isinstance(data, dict) else None)
+    )
+
+
+def respond_async():
+    """转账、退款是否写入发件箱后立即返回: 请求头 Prefer: respond-async，或 OUTBOX_MODE=async"""
+    return OUTBOX_ASYNC or "respond-async" in request.headers.get("Prefer", "")
+
+
+def accepted(entry, **extra):
+    """发件箱受理应答，客户端凭单号通过 /outbox/<单号> 查询派发结果"""
+    response = jsonify({"code": 0, "msg": "已受理", **extra, "data": entry})
+    response.status_code = 202
+    response.headers["Location"] = f"/outbox/{entry['ref']}"
+    return response
+
+
+def parse_amount(value):
+    """金额参数(分)转为整数，非整数（包括 1.5、"1.5"、布尔值）或不大于 0 时返回 None"""
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        return None
+    try:
+        amount = int(value)
+    except (TypeError, ValueError):
+        return None
+    return amount if amount > 0 else None
+
+
+def warm_up():
+    """预热: 加载商户配置与密钥、导入加密和二维码依赖、预编译页面，启动超时关单、退款对账、发件箱派发并续跑中断的批量退款任务
+
+    导入 app 时不做这些工作，由 ensure_warm_up 在每个进程中执行一次
+    """
+    from Crypto.Signature import pkcs1_15  # noqa: F401
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM  # noqa: F401
+    import qrcode  # noqa: F401
+    import requests  # noqa: F401
+
+    for mch_id in merchant_registry().mch_ids():
+        get_wechat_pay(mch_id)
+        get_create_transfer(mch_id)
+
+    static_pages.warm_up()
+
+    # 加载未关闭的订单，到期后自动关单
+    order_expiry().start()
+
+    # 定期查询结果未知的退款单，结算台账中的预留金额
+    refund_reconciler().start()
+
+    # 派发上次进程退出前未完成的发件箱条目
+    outbox().start()
+
+    # 续跑心跳超时(执行的进程已退出)的批量退款任务，之后定期检查
+    watch_interrupted_jobs(get_wechat_pay)
+
+
+_warmed_up_pid = None
+_warm_up_lock = threading.Lock()
+
+
+@app.before_request
+def ensure_warm_up():
+    """每个进程执行一次 warm_up: 默认在首个请求时执行，gunicorn.conf.py 的 post_worker_init 钩子在 worker 启动后立即执行
+
+    按进程号记录，master 中预热过(例如 preload_app)时 fork 出的 worker 仍会重新启动自己的后台线程
+    """
+    global _warmed_up_pid
+    if _warmed_up_pid == os.getpid():
+        return
+    with _warm_up_lock:
+        if _warmed_up_pid == os.getpid():
+            return
+        try:
+            warm_up()
+        except Exception as e:
+            # 预热失败不影响处理请求，商户配置等在使用时再加载；发件箱在写入新条目时启动
+            logger.exception("预热失败: {}", e)
+        _warmed_up_pid = os.getpid()
 
 
 @app.route("/")
 def index():
-    return render_template("index.html")
+    return static_pages.respond("index.html")
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus 指标"""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/ready")
+def ready():
+    """就绪检查: 可以接流量时返回 200，否则返回 503 和原因（worker 并发池、连接池占用，微信支付耗时与失败率）"""
+    report = readiness(admission)
+    return jsonify(report), 200 if report["ready"] else 503
+
+
+@app.route("/stats")
+def stats():
+    """转账、支付的笔数和金额汇总: 累计值、按转账场景、最近 hours 小时(默认 24)逐小时"""
+    hours = request.args.get("hours", 24, type=int)
+    return jsonify({"code": 0, "data": rollups().snapshot(hours=max(hours, 0))})
 
 
 @app.route("/create_order", methods=["POST"])
 def create_order():
     try:
         data = request.get_json()
-        logger.info(f"收到JSAPI支付请求: {data}")
+        logger.info("收到JSAPI支付请求: {}", payload(data))
         openid = data.get("openid")
         amount = data.get("amount")  # 金额（单位：分）
         description = data.get("description", "商品描述")
@@ -56,16 +213,17 @@ def create_order():
             return jsonify({"code": -1, "msg": "缺少必要参数"})
 
         # 创建订单
+        wechat_pay = get_wechat_pay(current_mch_id())
         order_result = wechat_pay.create_jsapi_order(openid, amount, description)
-        logger.info(f"JSAPI支付创建订单结果: {order_result}")
+        logger.info("JSAPI支付创建订单结果: {}", payload(order_result))
 
         if "prepay_id" in order_result:
             # 生成JSAPI调起支付所需的参数
             js_config = wechat_pay.generate_js_config(order_result["prepay_id"])
-            logger.info(f"JSAPI支付配置生成成功: {js_config}")
+            logger.info("JSAPI支付配置生成成功: {}", payload(js_config))
             return jsonify({"code": 0, "data": js_config})
         else:
-            logger.error(f"JSAPI支付创建订单失败: {order_result}")
+            logger.error("JSAPI支付创建订单失败: {}", payload(order_result))
             return jsonify({"code": -1, "msg": "创建订单失败", "error": order_result})
 
     except Exception as e:
@@ -73,50 +231,125 @@ def create_order():
         return jsonify({"code": -1, "msg": str(e)})
 
 
+def verify_and_decrypt(mch_id, get_client):
+    """验证并解密当前请求中的回调通知，返回 (客户端, 通知, None) 或 (None, None, 失败应答)
+
+    多个商户共用同一平台证书时逐个尝试各商户的 APIv3 密钥；包体只解析一次，同一证书只验签一次；
+    解密后的明文在 notification.plaintext 中，由 notification.resource(模型) 按需解析
+    """
+    body = request.get_data()
+    logger.info("收到原始通知数据: {}", payload(body))
+    notification = Notification(request.headers, body)
+    verified = False
+    for candidate in merchant_registry().notify_candidates(mch_id, notification.serial_no):
+        client = get_client(candidate)
+        if not client.verify_notification(notification):
+            continue
+        verified = True
+        if client.decrypt_resource(notification):
+            logger.info("解密后的通知数据: {}", payload(notification.plaintext))
+            return client, notification, None
+
+    if not verified:
+        logger.error("回调通知验签失败")
+        return None, None, (jsonify({"code": "FAIL", "message": "验签失败"}), 401)
+    logger.error("解密回调数据失败")
+    return None, None, (jsonify({"code": "FAIL", "message": "解密失败"}), 401)
+
+
 @app.route("/wxpay/notify", methods=["POST"])
-def notify():
-    """支付结果通知处理"""
+@app.route("/wxpay/notify/<mch_id>", methods=["POST"])
+def notify(mch_id=None):
+    """支付结果通知处理
+
+    服务商模式下回调地址可带上商户号(/wxpay/notify/<mch_id>)，未带商户号时按 Wechatpay-Serial 查找商户
+    """
     logger.info("收到支付结果通知")
     try:
-        # 获取原始请求数据
-        body = request.get_data()
-        logger.info(f"收到原始通知数据: {body}")
+        client, notification, error = verify_and_decrypt(mch_id, get_wechat_pay)
+        if error is not None:
+            return error
 
-        # 验证签名
-        if not wechat_pay.verify_notify_sign(request.headers, body):
-            logger.error("回调通知验签失败")
-            return jsonify({"code": "FAIL", "message": "验签失败"}), 401
+        # 处理支付结果
+        event_type = notification.event_type
+        with start_span("wechatpay.notify.handle", event_type=event_type):
+            if event_type == "TRANSACTION.SUCCESS":
+                # 支付成功
+                order = notification.resource(Order)
+                current_span().set_attributes(
+                    out_trade_no=order.out_trade_no,
+                    transaction_id=order.transaction_id,
+                    trade_state=order.trade_state,
+                )
+                logger.info(
+                    "支付成功 - 商户订单号: {}, 微信支付单号: {}, 交易状态: {}",
+                    order.out_trade_no,
+                    order.transaction_id,
+                    order.trade_state,
+                )
+                logger.info("支付方式: {}, 支付金额: {}分", order.trade_type, order.total)
+                # 记录订单金额，用于部分退款时校验可退余额
+                refund_ledger().record_order(order.out_trade_no, order.total)
+                order_expiry().finish(client.mch_id, order.out_trade_no, order.trade_state)
+                rollups().record(PAYMENT, order.out_trade_no, order.trade_state, order.total)
+                # TODO: 在这里处理您的业务逻辑
+                # 例如：更新订单状态、发货等
+            elif event_type and event_type.startswith("REFUND."):
+                # 退款结果: REFUND.SUCCESS / REFUND.ABNORMAL / REFUND.CLOSED
+                refund = notification.resource(Refund)
+                current_span().set_attributes(out_trade_no=refund.out_trade_no, refund_status=refund.status)
+                logger.info(
+                    "退款结果通知 - 商户订单号: {}, 退款单号: {}, 退款状态: {}",
+                    refund.out_trade_no,
+                    refund.out_refund_no,
+                    refund.status,
+                )
+                refund_ledger().settle(
+                    refund.out_refund_no,
+                    refund.status,
+                    out_trade_no=refund.out_trade_no,
+                    amount=refund.refund,
+                    total=refund.total,
+                )
+                if refund.status == "SUCCESS":
+                    order_expiry().finish(client.mch_id, refund.out_trade_no, "REFUND")
+                    # 按退款单号计数，部分退款多次时每笔退款各计一次
+                    rollups().record(PAYMENT, refund.out_refund_no, "REFUND", refund.refund)
 
-        # 解密通知数据
-        decoded_data = wechat_pay.decrypt_notify_data(body)
-        if not decoded_data:
-            logger.error("解密回调数据失败")
-            return jsonify({"code": "FAIL", "message": "解密失败"}), 401
+        return jsonify({"code": "SUCCESS", "message": "成功"})
+    except Exception as e:
+        logger.exception(f"处理支付通知异常: {str(e)}")
+        return jsonify({"code": "FAIL", "message": str(e)}), 500
 
-        logger.info(f"解密后的通知数据: {decoded_data}")
 
-        # 处理支付结果
-        event_type = decoded_data.get("event_type")
-        if event_type == "TRANSACTION.SUCCESS":
-            # 支付成功
-            trade_state = decoded_data.get("trade_state")
-            out_trade_no = decoded_data.get("out_trade_no")
-            transaction_id = decoded_data.get("transaction_id")
-            trade_type = decoded_data.get("trade_type")
-            amount = decoded_data.get("amount", {}).get("total")
+@app.route("/wxpay/transfer_notify", methods=["POST"])
+@app.route("/wxpay/transfer_notify/<mch_id>", methods=["POST"])
+def transfer_notify(mch_id=None):
+    """商家转账结果通知(MCHTRANSFER.BILL.FINISHED)处理
 
-            logger.info(
-                f"支付成功 - 商户订单号: {out_trade_no}, 微信支付单号: {transaction_id}, "
-                f"交易状态: {trade_state}"
-            )
-            logger.info(f"支付方式: {trade_type}, 支付金额: {amount}分")
-            logger.info(f"解密后的通知数据: {decoded_data}")
-            # TODO: 在这里处理您的业务逻辑
-            # 例如：更新订单状态、发货等
+    发起转账时 notify_url(TRANSFER_NOTIFY_URL) 指向该地址，转账单到达最终状态后微信支付推送结果，
+    状态记录到本地后 /query_transfer 直接返回，不再查询微信支付
+    """
+    logger.info("收到转账结果通知")
+    try:
+        client, notification, error = verify_and_decrypt(mch_id, get_create_transfer)
+        if error is not None:
+            return error
+
+        event_type = notification.event_type
+        bill = notification.resource(TransferBill)
+        current_span().set_attributes(out_bill_no=bill.out_bill_no, state=bill.state)
+        with start_span("wechatpay.transfer_notify.handle", event_type=event_type):
+            if event_type and not event_type.startswith("MCHTRANSFER."):
+                logger.warning("忽略未知的转账通知类型: {}", event_type)
+            else:
+                result = client.apply_notification(bill)
+                logger.info("转账结果通知处理结果: {}", payload(result))
+                # TODO: 在这里处理您的业务逻辑，例如更新提现记录
 
         return jsonify({"code": "SUCCESS", "message": "成功"})
     except Exception as e:
-        logger.exception(f"处理支付通知异常: {str(e)}")
+        logger.exception(f"处理转账通知异常: {str(e)}")
         return jsonify({"code": "FAIL", "message": str(e)}), 500
 
 
@@ -124,6 +357,7 @@ def notify():
 def wx_auth():
     """发起微信授权"""
     logger.info("开始微信授权流程")
+    wechat_pay = get_wechat_pay(current_mch_id())
     # 授权后回调地址
     redirect_uri = quote("https://你的域名/wx_callback")
 
@@ -136,20 +370,23 @@ def wx_auth():
         f"scope=snsapi_base&"
         f"state=STATE#wechat_redirect"
     )
-    logger.debug(f"构造的授权URL: {auth_url}")
+    logger.debug("构造的授权URL: {}", auth_url)
     return redirect(auth_url)
 
 
 @app.route("/wx_callback")
 def wx_callback():
     """微信授权回调"""
+    import requests
+
     logger.info("收到微信授权回调")
     code = request.args.get("code")
     if not code:
         logger.warning("未收到授权code")
         return "授权失败"
 
-    logger.info(f"收到授权code: {code}")
+    logger.info("收到授权code: {}", payload(code))
+    wechat_pay = get_wechat_pay(current_mch_id())
     # 通过code获取access_token和openid
     url = (
         f"https://api.weixin.qq.com/sns/oauth2/access_token?"
@@ -159,17 +396,24 @@ def wx_callback():
         f"grant_type=authorization_code"
     )
 
-    resp = requests.get(url)
+    if deadline.expired():
+        logger.error("获取openid失败: {}", deadline.DEADLINE_EXCEEDED)
+        return "获取openid失败"
+    try:
+        resp = requests.get(url, timeout=deadline.clip_timeout(OAUTH_TIMEOUT))
+    except requests.RequestException as e:
+        logger.error("获取openid失败: {}, {}", deadline.classify(e) or type(e).__name__, e)
+        return "获取openid失败"
     result = resp.json()
-    logger.info(f"获取access_token响应: {result}")
+    logger.info("获取access_token响应: {}", payload(result))
 
     if "openid" in result:
         # 将openid存入session
         session["openid"] = result["openid"]
-        logger.info(f"授权成功，获取到openid: {result['openid']}")
+        logger.info("授权成功，获取到openid: {}", payload(result["openid"]))
         return redirect("/pay")
     else:
-        logger.error(f"获取openid失败: {result}")
+        logger.error("获取openid失败: {}", payload(result))
         return "获取openid失败"
 
 
@@ -179,20 +423,20 @@ def pay():
     openid = session.get("openid")
     if not openid:
         return redirect("/wx_auth")
-    return render_template("pay.html", openid=openid)
+    return static_pages.respond("pay.html", openid=openid)
 
 
 @app.route("/native_pay")
 def native_pay():
     """Native支付页面"""
-    return render_template("native_pay.html")
+    return static_pages.respond("native_pay.html")
 
 
 @app.route("/create_native_order", methods=["POST"])
 def create_native_order():
     try:
         data = request.get_json()
-        logger.info(f"收到Native支付请求: {data}")
+        logger.info("收到Native支付请求: {}", payload(data))
         amount = data.get("amount")
         description = data.get("description", "商品描述")
 
@@ -201,35 +445,27 @@ def create_native_order():
             return jsonify({"code": -1, "msg": "缺少必要参数"})
 
         # 创建订单
-        order_result = wechat_pay.create_native_order(amount, description)
-        logger.info(f"Native支付创建订单结果: {order_result}")
+        order_result = get_wechat_pay(current_mch_id()).create_native_order(amount, description)
+        logger.info("Native支付创建订单结果: {}", payload(order_result))
 
         if "code_url" in order_result:
             # 生成二维码
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(order_result["code_url"])
-            qr.make(fit=True)
-            img = qr.make_image(fill_color="black", back_color="white")
+            with timed("qr_render", "create_native_order"):
+                qr_base64 = render_qr_base64(order_result["code_url"])
 
-            # 转换为base64
-            buffered = io.BytesIO()
-            img.save(buffered, format="PNG")
-            qr_base64 = base64.b64encode(buffered.getvalue()).decode()
-
-            logger.info(
-                f"Native支付二维码生成成功，订单号: {order_result.get('out_trade_no')}"
-            )
+            logger.info("Native支付二维码生成成功，订单号: {}", order_result.get("out_trade_no"))
             return jsonify(
                 {
                     "code": 0,
                     "data": {
                         "qr_code": qr_base64,
                         "out_trade_no": order_result.get("out_trade_no"),
+                        "expire_at": order_result.get("expire_at"),
                     },
                 }
             )
         else:
-            logger.error(f"Native支付创建订单失败: {order_result}")
+            logger.error("Native支付创建订单失败: {}", payload(order_result))
             return jsonify({"code": -1, "msg": "创建订单失败", "error": order_result})
 
     except Exception as e:
@@ -242,23 +478,26 @@ def query_order():
     """查询订单状态"""
     try:
         data = request.get_json()
-        logger.info(f"收到订单查询请求: {data}")
+        logger.info("收到订单查询请求: {}", payload(data))
         out_trade_no = data.get("out_trade_no")
 
         if not out_trade_no:
             logger.warning("订单查询缺少订单号")
             return jsonify({"code": -1, "msg": "缺少订单号"})
 
-        result = wechat_pay.query_order_status(out_trade_no)
-        logger.info(f"订单查询结果: {result}")
+        current_span().set_attribute("out_trade_no", out_trade_no)
+        # 已知最终状态或刚更新过的订单直接返回，不再查询微信支付
+        client = get_wechat_pay(current_mch_id())
+        result = order_expiry().local_state(client.mch_id, out_trade_no)
+        if result is None:
+            result = client.query_order_status(out_trade_no)
+        logger.info("订单查询结果: {}", payload(result))
 
         if "trade_state" in result:
-            logger.info(
-                f"订单查询成功，订单号: {out_trade_no}, 状态: {result['trade_state']}"
-            )
+            logger.info("订单查询成功，订单号: {}, 状态: {}", out_trade_no, result["trade_state"])
             return jsonify({"code": 0, "data": result})
         else:
-            logger.error(f"订单查询失败，订单号: {out_trade_no}, 错误信息: {result}")
+            logger.error("订单查询失败，订单号: {}, 错误信息: {}", out_trade_no, payload(result))
             return jsonify({"code": -1, "msg": "查询失败", "error": result})
 
     except Exception as e:
@@ -266,10 +505,37 @@ def query_order():
         return jsonify({"code": -1, "msg": str(e)})
 
 
+@app.route("/close_order", methods=["POST"])
+def close_order():
+    """关闭未支付的订单"""
+    try:
+        data = request.get_json()
+        logger.info("收到关单请求: {}", payload(data))
+        out_trade_no = data.get("out_trade_no")
+
+        if not out_trade_no:
+            logger.warning("关单请求缺少订单号")
+            return jsonify({"code": -1, "msg": "缺少订单号"})
+
+        current_span().set_attribute("out_trade_no", out_trade_no)
+        result = get_wechat_pay(current_mch_id()).close_order(out_trade_no)
+
+        if result.get("trade_state") == "CLOSED":
+            logger.info("关单成功，订单号: {}", out_trade_no)
+            return jsonify({"code": 0, "data": result})
+        else:
+            logger.error("关单失败，订单号: {}, 错误信息: {}", out_trade_no, payload(result))
+            return jsonify({"code": -1, "msg": "关单失败", "error": result})
+
+    except Exception as e:
+        logger.exception(f"关单异常: {str(e)}")
+        return jsonify({"code": -1, "msg": str(e)})
+
+
 @app.route("/refund")
 def refund_page():
     """退款页面"""
-    return render_template("refund.html")
+    return static_pages.respond("refund.html")
 
 
 @app.route("/do_refund", methods=["POST"])
@@ -277,7 +543,7 @@ def do_refund():
     """处理退款请求"""
     try:
         data = request.get_json()
-        logger.info(f"收到退款请求: {data}")
+        logger.info("收到退款请求: {}", payload(data))
 
         out_trade_no = data.get("out_trade_no")
         amount = data.get("amount")
@@ -286,17 +552,35 @@ def do_refund():
         if not out_trade_no or not amount:
             logger.warning("退款请求缺少必要参数")
             return jsonify({"code": -1, "msg": "缺少必要参数"})
+        amount = parse_amount(amount)
+        if amount is None:
+            logger.warning("退款金额无效: {}", data.get("amount"))
+            return jsonify({"code": -1, "msg": "退款金额必须为正整数(分)"})
+
+        if respond_async():
+            # 台账中已有订单金额时先检查余额，明显超额的请求不进入发件箱；最终以派发时的预留为准
+            balance = refund_ledger().balance(out_trade_no)
+            if balance is not None and amount > balance["refundable"]:
+                return jsonify({"code": -1, "msg": f"可退余额不足，剩余可退 {balance['refundable']} 分"})
+            mch_id = merchant_registry().config(current_mch_id())["mch_id"]
+            entry = outbox().submit(
+                REFUND,
+                new_out_refund_no(),
+                mch_id,
+                {"out_trade_no": out_trade_no, "amount": amount, "reason": reason},
+            )
+            return accepted(entry, out_refund_no=entry["ref"])
 
-        result = wechat_pay.refund_order(out_trade_no, amount, reason)
-        logger.info(f"退款结果: {result}")
+        result = get_wechat_pay(current_mch_id()).refund_order(out_trade_no, amount, reason)
+        logger.info("退款结果: {}", payload(result))
 
         if "status" in result:
             logger.info(
-                f"退款申请成功，订单号: {out_trade_no}, 金额: {amount}分, 状态: {result['status']}"
+                "退款申请成功，订单号: {}, 金额: {}分, 状态: {}", out_trade_no, amount, result["status"]
             )
             return jsonify({"code": 0, "data": result})
         else:
-            logger.error(f"退款失败，订单号: {out_trade_no}, 错误信息: {result}")
+            logger.error("退款失败，订单号: {}, 错误信息: {}", out_trade_no, payload(result))
             return jsonify({"code": -1, "msg": "退款失败", "error": result})
 
     except Exception as e:
@@ -304,10 +588,119 @@ def do_refund():
         return jsonify({"code": -1, "msg": str(e)})
 
 
+@app.route("/query_refund", methods=["POST"])
+def query_refund():
+    """查询退款状态，并按结果结算退款台账"""
+    try:
+        data = request.get_json()
+        logger.info("收到退款查询请求: {}", payload(data))
+        out_refund_no = data.get("out_refund_no")
+
+        if not out_refund_no:
+            logger.warning("退款查询缺少退款单号")
+            return jsonify({"code": -1, "msg": "缺少退款单号"})
+
+        current_span().set_attribute("out_refund_no", out_refund_no)
+        result = get_wechat_pay(current_mch_id()).query_refund(out_refund_no)
+        logger.info("退款查询结果: {}", payload(result))
+
+        if "status" in result:
+            balance = refund_ledger().balance(result.get("out_trade_no"))
+            return jsonify({"code": 0, "data": result, "balance": balance})
+        else:
+            logger.error("退款查询失败，退款单号: {}, 错误信息: {}", out_refund_no, payload(result))
+            return jsonify({"code": -1, "msg": "查询失败", "error": result})
+
+    except Exception as e:
+        logger.exception(f"退款查询异常: {str(e)}")
+        return jsonify({"code": -1, "msg": str(e)})
+
+
+@app.route("/refund_jobs", methods=["POST"])
+def create_refund_job():
+    """创建批量退款任务并立即在后台执行
+
+    条目可以是 JSON 包体中的 items 列表（或整个包体就是列表），也可以是上传的 CSV / JSON Lines 文件(file 字段)。
+    可选参数 workers(并发数)、rate(每秒请求数)。
+    """
+    try:
+        upload = request.files.get("file")
+        if upload is not None:
+            options = request.form
+            items = parse_items(upload.read(), upload.filename)
+        else:
+            data = request.get_json()
+            options = data if isinstance(data, dict) else {}
+            items = parse_items(data.get("items") if isinstance(data, dict) else data)
+
+        mch_id = merchant_registry().config(current_mch_id() or options.get("mch_id"))["mch_id"]
+        store = refund_job_store()
+        job_id = store.create(
+            items,
+            mch_id=mch_id,
+            workers=options.get("workers"),
+            rate=options.get("rate"),
+        )
+        logger.info("创建批量退款任务 - 任务: {}, 商户: {}, 共 {} 条", job_id, mch_id, len(items))
+        start_refund_job(job_id, get_wechat_pay(mch_id))
+        return jsonify({"code": 0, "data": store.progress(job_id)})
+
+    except ValueError as e:
+        logger.warning("批量退款任务参数错误: {}", e)
+        return jsonify({"code": -1, "msg": str(e)})
+    except Exception as e:
+        logger.exception(f"创建批量退款任务异常: {str(e)}")
+        return jsonify({"code": -1, "msg": str(e)})
+
+
+@app.route("/refund_jobs/<job_id>")
+def refund_job_progress(job_id):
+    """查询批量退款任务的实时进度和吞吐量，status 参数不为空时附带该状态的条目"""
+    store = refund_job_store()
+    progress = store.progress(job_id)
+    if progress is None:
+        return jsonify({"code": -1, "msg": "任务不存在"}), 404
+    result = {"code": 0, "data": progress}
+    if request.args.get("status"):
+        try:
+            limit = min(int(request.args.get("limit", 100)), 1000)
+            offset = int(request.args.get("offset", 0))
+        except ValueError:
+            return jsonify({"code": -1, "msg": "limit、offset 必须为整数"}), 400
+        if limit < 0 or offset < 0:
+            return jsonify({"code": -1, "msg": "limit、offset 不能为负数"}), 400
+        result["items"] = store.items(job_id, request.args["status"], limit=limit, offset=offset)
+    return jsonify(result)
+
+
+@app.route("/refund_jobs/<job_id>/resume", methods=["POST"])
+def resume_refund_job(job_id):
+    """续跑暂停或中断的任务；retry_failed 为 true 时失败的条目也使用原退款单号重新申请"""
+    store = refund_job_store()
+    job = store.job(job_id)
+    if job is None:
+        return jsonify({"code": -1, "msg": "任务不存在"}), 404
+    retry_failed = bool((request.get_json(silent=True) or {}).get("retry_failed"))
+    if not start_refund_job(job_id, get_wechat_pay(job["mch_id"]), retry_failed=retry_failed):
+        return jsonify({"code": -1, "msg": "任务正在执行或已完成", "data": store.progress(job_id)})
+    logger.info("续跑批量退款任务 - 任务: {}, 重试失败条目: {}", job_id, retry_failed)
+    return jsonify({"code": 0, "data": store.progress(job_id)})
+
+
+@app.route("/refund_jobs/<job_id>/pause", methods=["POST"])
+def pause_refund_job(job_id):
+    """暂停任务，执行中的批次完成后停止，之后可以续跑"""
+    store = refund_job_store()
+    if not store.pause(job_id):
+        return jsonify({"code": -1, "msg": "任务不存在或不在执行中"})
+    logger.info("暂停批量退款任务 - 任务: {}", job_id)
+    return jsonify({"code": 0, "data": store.progress(job_id)})
+
+
 @app.route("/transfer")
 def transfer_page():
     """转账页面"""
-    return render_template("transfer.html")
+    return static_pages.respond("transfer.html")
 
 
 @app.route("/create_transfer", methods=["POST"])
@@ -315,7 +708,7 @@ def create_transfer():
     """创建转账订单"""
     try:
         data = request.get_json()
-        logger.info(f"收到转账请求: {data}")
+        logger.info("收到转账请求: {}", payload(data))
 
         openid = data.get("openid")
         amount = data.get("amount")
@@ -323,8 +716,22 @@ def create_transfer():
         if not openid or not amount:
             logger.warning("转账请求缺少必要参数")
             return jsonify({"code": -1, "msg": "缺少必要参数"})
-        wechat_transfer = CreateTransfer()
-        result = wechat_transfer.create_transfer_order(
+        amount = parse_amount(amount)
+        if amount is None:
+            logger.warning("转账金额无效: {}", data.get("amount"))
+            return jsonify({"code": -1, "msg": "转账金额必须为正整数(分)"})
+
+        if respond_async():
+            if not MIN_TRANSFER_AMOUNT <= amount <= MAX_TRANSFER_AMOUNT:
+                return jsonify(
+                    {"code": -2, "msg": f"转账金额需在{MIN_TRANSFER_AMOUNT}~{MAX_TRANSFER_AMOUNT}分之间"}
+                )
+            mch_id = merchant_registry().config(current_mch_id())["mch_id"]
+            entry = outbox().submit(
+                TRANSFER, new_out_bill_no(), mch_id, {"openid": openid, "amount": amount, "remark": remark}
+            )
+            return accepted(entry, out_bill_no=entry["ref"])
+        result = get_create_transfer(current_mch_id()).create_transfer_order(
             openid=openid,
             amount=amount,
             remark=remark,
@@ -332,7 +739,7 @@ def create_transfer():
             # user_name=user_name,
             # notify_url=notify_url
         )
-        logger.info(f"转账结果: {result}")
+        logger.info("转账结果: {}", payload(result))
         return jsonify(result)
 
     except Exception as e:
@@ -340,22 +747,33 @@ def create_transfer():
         return jsonify({"code": -1, "msg": str(e)})
 
 
+@app.route("/outbox/<ref>")
+def outbox_entry(ref):
+    """查询发件箱条目的派发状态，DONE 时 result 为微信支付的受理结果"""
+    entry = outbox().store.get(ref)
+    if entry is None:
+        return jsonify({"code": -1, "msg": "单号不存在"}), 404
+    return jsonify({"code": 0, "data": entry})
+
+
 @app.route("/query_transfer", methods=["POST"])
 def query_transfer():
     """查询转账状态"""
     try:
         data = request.get_json()
-        logger.info(f"收到转账查询请求: {data}")
+        logger.info("收到转账查询请求: {}", payload(data))
 
         out_bill_no = data.get("out_bill_no")
+        current_span().set_attribute("out_bill_no", out_bill_no)
 
         if not out_bill_no:
             logger.warning("转账查询缺少商户单号")
             return jsonify({"code": -1, "msg": "缺少商户单号"})
 
-        wechat_transfer = CreateTransfer()
-        result = wechat_transfer.query_transfer_order(out_bill_no)
-        logger.info(f"转账查询结果: {result}")
+        client = get_create_transfer(current_mch_id())
+        # 已知最终状态或刚更新过的转账单直接返回，不再查询微信支付
+        result = client.cached_transfer_state(out_bill_no) or client.query_transfer_order(out_bill_no)
+        logger.info("转账查询结果: {}", payload(result))
         return jsonify(result)
 
     except Exception as e:
@@ -364,6 +782,7 @@ def query_transfer():
 
 
 if __name__ == "__main__":
+    ensure_warm_up()
     app.run(
         debug=True,
         host="0.0.0.0",  # 只监听本地
@@ -0,0 +1,136 @@
+"""主/备域名故障切换与对冲请求的演练
+
+在本机启动两个微信支付替身服务（tools/mock_wechatpay.py）分别作为主域名和备用域名，
+按阶段改变主域名的延迟与错误率，用查单接口持续请求，输出每个阶段的耗时分位数、失败率和各域名收到的请求数:
+
+1. healthy   两个域名都正常
+2. slow      主域名变慢（超过 FAILOVER_LATENCY），请求应切到备用域名；开启对冲时尾延迟应接近 HEDGE_AFTER
+3. outage    主域名大量返回 5XX，请求应切到备用域名，失败率保持在低位
+4. recovered 主域名恢复，FAILBACK_AFTER 秒后请求回到主域名
+
+用法（在 python 目录下执行）:
+    python -m bench.failover
+    python -m bench.failover --hedge-after 200 --phase-seconds 5 --failback-after 3
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fixtures import TestKeys  # noqa: E402
+
+# 各阶段主域名的 (延迟配置, 5XX 比例)
+PHASES = [
+    ("healthy", ("fixed", 20), 0.0),
+    ("slow", ("uniform", 1500, 2500), 0.0),
+    ("outage", ("fixed", 20), 0.8),
+    ("recovered", ("fixed", 20), 0.0),
+]
+
+
+def start_standin(keys, profile="fast"):
+    """在后台线程启动一个替身服务，返回 (MockWeChatPay, base_url, server)"""
+    import logging
+
+    from werkzeug.serving import make_server
+
+    from tools.mock_wechatpay import MockWeChatPay
+
+    mock = MockWeChatPay(keys.platform_key, profile, overrides={"latency": ("fixed", 20)})
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, mock.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return mock, f"http://127.0.0.1:{server.server_port}", server
+
+
+def run_phase(client, seconds, concurrency):
+    """并发查单 seconds 秒，返回耗时(毫秒)列表与失败数"""
+    samples = []
+    failures = 0
+    lock = threading.Lock()
+    stop_at = time.monotonic() + seconds
+
+    def worker():
+        nonlocal failures
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            status, _ = client._call_api("query_order", out_trade_no=uuid.uuid4().hex[:20], mchid=client.mch_id)
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                samples.append(elapsed)
+                failures += status is None or status >= 500
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return samples, failures
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="主/备域名故障切换演练")
+    parser.add_argument("--phase-seconds", type=float, default=8.0, help="每个阶段的持续时间(秒)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--hedge-after", type=float, default=0, help="对冲等待时间(毫秒)，0 表示不对冲")
+    parser.add_argument("--failover-latency", type=float, default=1.0, help="切换的平均耗时阈值(秒)")
+    parser.add_argument("--failback-after", type=float, default=4.0, help="主域名多久没有样本后重新使用(秒)")
+    args = parser.parse_args(argv)
+
+    keys = TestKeys()
+    keys.apply_env()
+    os.environ.update(
+        {
+            "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+            "AUDIT_LOG_DIR": "",
+            "HEDGE_AFTER": str(args.hedge_after),
+            "FAILOVER_LATENCY": str(args.failover_latency),
+            "FAILBACK_AFTER": str(args.failback_after),
+            "FAILOVER_COOLDOWN": str(args.failback_after),
+            "WECHAT_POOL_SIZE": str(args.concurrency * 2),
+        }
+    )
+    primary, primary_base, primary_server = start_standin(keys)
+    backup, backup_base, backup_server = start_standin(keys)
+    os.environ["WECHAT_PAY_API_BASE"] = primary_base
+    os.environ["WECHAT_PAY_API_BACKUP_BASE"] = backup_base
+
+    from services.log import setup_logging
+    from services.pay.wechat_pay import WeChatPay
+    from tools.mock_wechatpay import LatencyModel
+
+    setup_logging()
+    client = WeChatPay()
+    print(f"主域名 {primary_base}，备用域名 {backup_base}，对冲: {args.hedge_after or '关闭'}ms")
+    print(f"{'阶段':<10} {'请求数':>7} {'失败率':>7} {'p50(ms)':>9} {'p99(ms)':>9} {'max(ms)':>9} {'主':>6} {'备':>6}")
+    for name, latency, error_5xx in PHASES:
+        primary.latency = LatencyModel(latency)
+        primary.error_5xx = error_5xx
+        before = primary.stats["requests"], backup.stats["requests"]
+        samples, failures = run_phase(client, args.phase_seconds, args.concurrency)
+        print(
+            f"{name:<10} {len(samples):>7} {failures / len(samples):>7.1%} "
+            f"{statistics.median(samples):>9.1f} {percentile(samples, 0.99):>9.1f} {max(samples):>9.1f} "
+            f"{primary.stats['requests'] - before[0]:>6} {backup.stats['requests'] - before[1]:>6}"
+        )
+        if name == "outage":
+            # 等待主域名的旧样本失效，下一阶段从主域名开始
+            time.sleep(args.failback_after)
+    print(client.endpoints.stats())
+    primary_server.shutdown()
+    backup_server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
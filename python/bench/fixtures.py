@@ -0,0 +1,117 @@
+"""基准测试用的离线测试环境
+
+生成测试用的商户私钥和平台密钥对，写入临时目录并设置 WeChatPayBase 所需的环境变量，
+同时提供构造已签名的回调通知、加密资源等辅助函数。
+"""
+
+import json
+import os
+import tempfile
+import time
+from base64 import b64encode
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+TEST_API_V3_KEY = "0123456789abcdef0123456789abcdef"
+TEST_MCH_ID = "1900000001"
+TEST_APP_ID = "wx0000000000000001"
+TEST_SERIAL_NO = "TESTMCHSERIALNO0001"
+TEST_PLATFORM_SERIAL_NO = "TESTPLATFORMSERIAL0001"
+
+
+class TestKeys:
+    """测试密钥，platform_key 用于模拟微信支付侧签名"""
+
+    def __init__(self, directory=None):
+        self.directory = directory or tempfile.mkdtemp(prefix="wechatpay-bench-")
+        self.merchant_key = RSA.generate(2048)
+        self.platform_key = RSA.generate(2048)
+        self.merchant_key_path = self._write("apiclient_key.pem", self.merchant_key.export_key())
+        self.platform_key_path = self._write("platform_key.pem", self.platform_key.export_key())
+        self.platform_cert_path = self._write("platform_pub.pem", self.platform_key.publickey().export_key())
+
+    def _write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def apply_env(self):
+        """设置 WeChatPayBase 读取的环境变量"""
+        os.environ.update(
+            {
+                "WECHAT_MCH_ID": TEST_MCH_ID,
+                "WECHAT_APP_ID": TEST_APP_ID,
+                "WECHAT_APP_SECRET": "test-app-secret",
+                "WECHAT_API_KEY": "test-api-key",
+                "WECHAT_API_V3_KEY": TEST_API_V3_KEY,
+                "WECHAT_PRIVATE_KEY_PATH": self.merchant_key_path,
+                "WECHAT_CERT_SERIAL_NO": TEST_SERIAL_NO,
+                "WECHAT_PAY_PLAT_CERT_PATH": self.platform_cert_path,
+                "NOTIFY_URL": "https://example.com/wxpay/notify",
+            }
+        )
+
+    def sign_response(self, body, timestamp=None, nonce="benchnonce"):
+        """使用平台私钥生成微信支付应答/回调的签名头"""
+        timestamp = str(timestamp or int(time.time()))
+        body_str = body.decode("utf-8") if isinstance(body, bytes) else body
+        message = f"{timestamp}\n{nonce}\n{body_str}\n"
+        signature = pkcs1_15.new(self.platform_key).sign(SHA256.new(message.encode("utf-8")))
+        return {
+            "Wechatpay-Timestamp": timestamp,
+            "Wechatpay-Nonce": nonce,
+            "Wechatpay-Signature": b64encode(signature).decode("utf-8"),
+            "Wechatpay-Serial": TEST_PLATFORM_SERIAL_NO,
+        }
+
+
+def encrypt_resource(resource, associated_data="transaction", nonce="benchnonce01"):
+    """按 AEAD_AES_256_GCM 加密回调通知的 resource"""
+    plaintext = json.dumps(resource, ensure_ascii=False).encode("utf-8")
+    ciphertext = AESGCM(TEST_API_V3_KEY.encode("utf-8")).encrypt(
+        nonce.encode("utf-8"), plaintext, associated_data.encode("utf-8")
+    )
+    return {
+        "algorithm": "AEAD_AES_256_GCM",
+        "ciphertext": b64encode(ciphertext).decode("utf-8"),
+        "nonce": nonce,
+        "associated_data": associated_data,
+        "original_type": "transaction",
+    }
+
+
+def make_notify(keys, resource, event_type="TRANSACTION.SUCCESS"):
+    """构造已签名的回调通知，返回 (headers, body_bytes)"""
+    envelope = {
+        "id": "EV-2018022511223320873",
+        "create_time": "2015-05-20T13:29:35+08:00",
+        "resource_type": "encrypt-resource",
+        "event_type": event_type,
+        "summary": "支付成功",
+        "resource": encrypt_resource(resource),
+    }
+    body = json.dumps(envelope).encode("utf-8")
+    headers = keys.sign_response(body)
+    headers["Content-Type"] = "application/json"
+    return headers, body
+
+
+def sample_transaction(out_trade_no="202401010000001234"):
+    """支付成功回调中的交易数据"""
+    return {
+        "mchid": TEST_MCH_ID,
+        "appid": TEST_APP_ID,
+        "out_trade_no": out_trade_no,
+        "transaction_id": "4200000000000000000000000001",
+        "trade_type": "NATIVE",
+        "trade_state": "SUCCESS",
+        "trade_state_desc": "支付成功",
+        "bank_type": "OTHERS",
+        "success_time": "2024-01-01T00:00:00+08:00",
+        "payer": {"openid": "oUpF8uMuAJO_M2pxb1Q9zNjWeS6o"},
+        "amount": {"total": 100, "payer_total": 100, "currency": "CNY", "payer_currency": "CNY"},
+    }
@@ -0,0 +1,107 @@
+"""导入耗时预算检查
+
+用 ``python -X importtime -c "import app"`` 测量导入 app.py 的累计耗时（多次取最小值），并检查
+二维码、加密库、requests 等较慢的依赖没有在导入阶段被加载。耗时超过预算或出现应延迟导入的模块时退出码为 1。
+
+用法（在 python 目录下执行）:
+    python -m bench.importtime                      # 对比 bench/importtime_baseline.json 中的预算
+    python -m bench.importtime --update-baseline    # 重新测量基线，预算 = 基线 * (1 + tolerance)
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, "bench", "importtime_baseline.json")
+
+# 默认允许超出基线的比例
+DEFAULT_TOLERANCE = 0.5
+
+# 应在首次使用时才导入的模块
+LAZY_MODULES = ("qrcode", "PIL", "Crypto", "cryptography", "requests", "dotenv")
+
+
+def measure_once(module="app"):
+    """执行一次导入，返回 {模块名: 累计耗时(微秒)}"""
+    env = {**os.environ, "LOG_LEVEL": "WARNING"}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{proc.stderr[-2000:]}")
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def measure(module="app", runs=5):
+    """多次测量取最小值，返回 (耗时毫秒, 最后一次导入的模块表)"""
+    best, modules = None, {}
+    for _ in range(runs):
+        modules = measure_once(module)
+        total = modules[module] / 1000
+        best = total if best is None else min(best, total)
+    return round(best, 1), modules
+
+
+def eager_lazy_modules(modules):
+    """返回导入阶段被加载的、应延迟导入的模块"""
+    return sorted(name for name in modules if name in LAZY_MODULES)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="app.py 导入耗时预算检查")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基线与预算文件(JSON)")
+    parser.add_argument("--update-baseline", action="store_true", help="重新测量并写入基线")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="预算相对基线的余量")
+    parser.add_argument("--runs", type=int, default=5, help="测量次数，取最小值")
+    args = parser.parse_args(argv)
+
+    import_ms, modules = measure(runs=args.runs)
+    children = ((name, us) for name, us in modules.items() if name not in ("app", "site"))
+    slowest = sorted(children, key=lambda item: item[1], reverse=True)[:10]
+    print(f"import app: {import_ms:.1f}ms (best of {args.runs})")
+    for name, us in slowest:
+        print(f"  {name:<40} {us / 1000:>8.1f}ms")
+
+    eager = eager_lazy_modules(modules)
+    if eager:
+        print(f"\n以下模块应在首次使用时导入: {', '.join(eager)}")
+
+    if args.update_baseline:
+        baseline = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "import_ms": import_ms,
+            "budget_ms": round(import_ms * (1 + args.tolerance), 1),
+        }
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"\n基线已更新: {args.baseline}, 预算 {baseline['budget_ms']}ms")
+        return 1 if eager else 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print(f"基线 {baseline['import_ms']}ms, 预算 {baseline['budget_ms']}ms")
+    if import_ms > baseline["budget_ms"]:
+        print(f"\n导入耗时超出预算: {import_ms}ms > {baseline['budget_ms']}ms")
+        return 1
+    return 1 if eager else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
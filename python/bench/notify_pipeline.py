@@ -0,0 +1,177 @@
+"""回调通知处理路径的基准测试
+
+对比三种实现处理一条支付成功通知(验签 + 解密)的耗时和内存分配:
+- legacy: 原实现，包体解码为 str 后拼接验签名串，验签与解密各自解析一次包体，每次解密新建 AESGCM
+- parse_once: Notification 一次读取包体，摘要与外层解析结果只计算一次，JSON 使用 orjson（已安装时）
+- parse_once_json: 同上，JSON 使用标准库
+- parse_once_model: 解密后不转为 dict，按需解析为 Order（services/models.py）
+
+每种实现依次处理 --count 条不同的通知（模拟高并发回调），输出单条耗时的 p50/p99、吞吐，
+以及 tracemalloc 统计的单条通知峰值内存分配。--candidates 模拟多个商户共用同一平台证书、
+前几个商户解密失败时逐个尝试的情况。
+
+用法（在 python 目录下执行）:
+    python -m bench.notify_pipeline
+    python -m bench.notify_pipeline --count 5000 --padding 4096 --candidates 3 --output notify.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from base64 import b64decode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fixtures import TestKeys, make_notify, sample_transaction  # noqa: E402
+
+
+def legacy_pipeline(client, headers, body, candidates):
+    """原实现（含原有的日志、指标和 span）: 每个候选商户各自验签，解密时重新解析包体"""
+    from Crypto.Hash import SHA256
+    from Crypto.Signature import pkcs1_15
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from loguru import logger
+
+    from services.log import payload
+    from services.metrics import timed
+    from services.tracing import start_span
+
+    for _ in range(candidates):
+        timestamp, nonce = headers["Wechatpay-Timestamp"], headers["Wechatpay-Nonce"]
+        body_str = body.decode("utf-8")
+        logger.info("收到回调通知头部信息: timestamp={}, nonce={}, serial_no={}",
+                    timestamp, nonce, headers["Wechatpay-Serial"])
+        message = f"{timestamp}\n{nonce}\n{body_str}\n"
+        logger.debug("验签名串: {}", payload(message))
+        with timed("verify", "notify"), start_span("wechatpay.notify.verify"):
+            pkcs1_15.new(client.platform_cert).verify(
+                SHA256.new(message.encode("utf-8")), b64decode(headers["Wechatpay-Signature"])
+            )
+        logger.info("签名验证成功")
+        with timed("json_decode", "notify"):
+            data = json.loads(body)
+        resource = data["resource"]
+        with timed("decrypt", "notify"), start_span("wechatpay.notify.decrypt"):
+            plaintext = AESGCM(client.api_v3_key.encode("utf-8")).decrypt(
+                resource["nonce"].encode("utf-8"),
+                b64decode(resource["ciphertext"]),
+                resource["associated_data"].encode("utf-8"),
+            )
+        result = json.loads(plaintext)
+        result.setdefault("event_type", data.get("event_type"))
+    return result
+
+
+def parse_once_pipeline(client, headers, body, candidates):
+    from services.notification import Notification
+
+    notification = Notification(headers, body)
+    for _ in range(candidates):
+        if not client.verify_notification(notification):
+            raise AssertionError("验签失败")
+        result = client.decrypt_notification(notification)
+    return result
+
+
+def parse_once_model_pipeline(client, headers, body, candidates):
+    from services.models import Order
+    from services.notification import Notification
+
+    notification = Notification(headers, body)
+    for _ in range(candidates):
+        if not client.verify_notification(notification):
+            raise AssertionError("验签失败")
+        client.decrypt_resource(notification)
+        order = notification.resource(Order)
+        order.trade_state
+    return order
+
+
+def measure(pipeline, client, notifications, candidates):
+    """依次处理全部通知，返回耗时和内存分配统计"""
+    samples = []
+    started = time.perf_counter()
+    for headers, body in notifications:
+        t0 = time.perf_counter_ns()
+        result = pipeline(client, headers, body, candidates)
+        samples.append((time.perf_counter_ns() - t0) / 1000)
+    elapsed = time.perf_counter() - started
+    state = result.get("trade_state") if isinstance(result, dict) else result.trade_state
+    if state != "SUCCESS":
+        raise AssertionError(f"解密结果不正确: {result}")
+
+    # 内存分配单独测量，tracemalloc 会明显拖慢执行
+    peaks = []
+    tracemalloc.start()
+    for headers, body in notifications[: min(len(notifications), 200)]:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        pipeline(client, headers, body, candidates)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+
+    samples.sort()
+    return {
+        "count": len(samples),
+        "p50_us": round(samples[len(samples) // 2], 2),
+        "p99_us": round(samples[int(len(samples) * 0.99) - 1], 2),
+        "notifications_per_sec": round(len(samples) / elapsed, 1),
+        "peak_alloc_bytes": int(sorted(peaks)[len(peaks) // 2]),
+    }
+
+
+def run(count, padding, candidates):
+    from loguru import logger
+
+    logger.remove()
+    keys = TestKeys()
+    keys.apply_env()
+
+    import services.notification as notification_module
+    from services.pay.wechat_pay import WeChatPay
+
+    client = WeChatPay()
+    notifications = []
+    for i in range(count):
+        resource = sample_transaction(f"2024010100{i:010d}")
+        if padding:
+            resource["attach"] = "x" * padding
+        notifications.append(make_notify(keys, resource))
+    print(f"通知数: {count}, 包体大小: {len(notifications[0][1])} 字节, 候选商户: {candidates}")
+
+    results = {}
+    for name, pipeline, parser in (
+        ("legacy", legacy_pipeline, None),
+        ("parse_once", parse_once_pipeline, None),
+        ("parse_once_json", parse_once_pipeline, json.loads),
+        ("parse_once_model", parse_once_model_pipeline, None),
+    ):
+        notification_module._loads = parser
+        results[name] = measure(pipeline, client, notifications, candidates)
+        r = results[name]
+        print(f"{name:<18} p50={r['p50_us']:>9.1f}us  p99={r['p99_us']:>9.1f}us  "
+              f"{r['notifications_per_sec']:>9.1f}/s  峰值分配={r['peak_alloc_bytes']:>8d}B")
+    notification_module._loads = None
+    return {"count": count, "body_bytes": len(notifications[0][1]), "candidates": candidates, "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="回调通知处理路径基准测试")
+    parser.add_argument("--count", type=int, default=2000, help="处理的通知数")
+    parser.add_argument("--padding", type=int, default=0, help="在交易数据中附加的字节数，模拟较大的通知")
+    parser.add_argument("--candidates", type=int, default=1, help="共用同一平台证书、需要逐个尝试的商户数")
+    parser.add_argument("--output", help="结果保存路径(JSON)")
+    args = parser.parse_args(argv)
+
+    report = run(args.count, args.padding, args.candidates)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""支付热点路径基准测试
+
+离线运行（自动生成测试密钥，上游使用进程内替身），覆盖:
+- 微基准: 请求签名、回调验签、回调解密、OAEP 加密、请求包体序列化、商户单号生成、二维码生成、共享状态表读写、
+  指标记录(Counter.inc / observe_stage / timed)
+- 宏基准: 通过 Flask test client 完整请求 app.py 的各个路由
+
+用法（在 python 目录下执行）:
+    python -m bench.run                                   # 运行并输出结果
+    python -m bench.run --output bench/results.json       # 保存结果
+    python -m bench.run --baseline bench/baseline.json    # 与基线对比，变慢超过阈值时退出码为 1
+    python -m bench.run --baseline bench/baseline.json --update-baseline
+    python -m bench.run --filter sign                     # 只运行名称包含 sign 的用例
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fixtures import TestKeys, make_notify, sample_transaction  # noqa: E402
+from bench.standin import StandIn  # noqa: E402
+
+# 默认允许的性能回退比例
+DEFAULT_TOLERANCE = 0.25
+
+
+def measure(fn, min_time=0.5, min_iterations=20, warmup=3, rounds=3):
+    """分多轮重复执行 fn，取 p50 最好的一轮作为结果，降低机器抖动的影响"""
+    for _ in range(warmup):
+        fn()
+    results = [_measure_round(fn, min_time / rounds, min_iterations) for _ in range(rounds)]
+    return min(results, key=lambda result: result["p50_us"])
+
+
+def _measure_round(fn, min_time, min_iterations):
+    """执行一轮，返回单次耗时统计(微秒)"""
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < min_iterations or time.perf_counter() < deadline:
+        started = time.perf_counter_ns()
+        fn()
+        samples.append((time.perf_counter_ns() - started) / 1000)
+    samples.sort()
+    return {
+        "iterations": len(samples),
+        "mean_us": round(statistics.fmean(samples), 2),
+        "p50_us": round(samples[len(samples) // 2], 2),
+        "p95_us": round(samples[int(len(samples) * 0.95) - 1], 2),
+        "p99_us": round(samples[int(len(samples) * 0.99) - 1], 2),
+        "ops_per_sec": round(1e6 / statistics.fmean(samples), 1),
+    }
+
+
+def notification_once(headers, body, client):
+    """一次完整的回调处理: 读取包体、验签，返回供解密使用的 Notification"""
+    from services.notification import Notification
+
+    notification = Notification(headers, body)
+    client.verify_notification(notification)
+    return notification
+
+
+def micro_benchmarks(keys):
+    """微基准用例: {名称: 无参函数}"""
+    from services.ids import new_out_trade_no
+    from services.metrics import API_REQUESTS, observe_stage, timed
+    from services.pay.qr import render_qr_base64
+    from services.pay.wechat_pay import WeChatPay
+    from services.shared_state import shared_state
+    from services.transfer.create_transfer import CreateTransfer
+
+    wechat_pay = WeChatPay()
+    order_body = {
+        "appid": wechat_pay.app_id,
+        "mchid": wechat_pay.mch_id,
+        "description": "Image形象店-深圳腾大-QQ公仔",
+        "out_trade_no": "1217752501201407033233368018",
+        "notify_url": "https://www.weixin.qq.com/wxpay/pay.php",
+        "amount": {"total": 100, "currency": "CNY"},
+        "payer": {"openid": "oUpF8uMuAJO_M2pxb1Q9zNjWeS6o"},
+    }
+    body_str = json.dumps(order_body)
+    notify_headers, notify_body = make_notify(keys, sample_transaction())
+    transfer = CreateTransfer()
+    state_table = shared_state()
+    state_table.put("B202401010000009999", "SUCCESS")
+
+    return {
+        "sign": lambda: wechat_pay.generate_sign("POST", "/v3/pay/transactions/native", body_str),
+        "notify_verify": lambda: wechat_pay.verify_notify_sign(notify_headers, notify_body),
+        "notify_decrypt": lambda: wechat_pay.decrypt_notify_data(notify_body),
+        "notify_pipeline": lambda: wechat_pay.decrypt_notification(
+            notification_once(notify_headers, notify_body, wechat_pay)
+        ),
+        "oaep_encrypt": lambda: transfer.encrypt("张三"),
+        "body_serialize": lambda: json.dumps(order_body),
+        "id_generate": new_out_trade_no,
+        "qr_render": lambda: render_qr_base64("weixin://wxpay/bizpayurl/up?pr=NwY5Mz9&groupid=00"),
+        "shared_state_get": lambda: state_table.get("B202401010000009999"),
+        "shared_state_put": lambda: state_table.put("B202401010000009998", "PROCESSING"),
+        "metrics_counter_inc": lambda: API_REQUESTS.inc("bench", 200),
+        "metrics_observe_stage": lambda: observe_stage("bench", "bench", 0.001),
+        "metrics_timed": lambda: _timed_once(timed),
+    }
+
+
+def _timed_once(timed):
+    with timed("bench", "bench"):
+        pass
+
+
+def macro_benchmarks(keys):
+    """宏基准用例: 通过 Flask test client 请求各路由"""
+    import app as app_module
+    from services.pay.refund_ledger import refund_ledger
+
+    client = app_module.app.test_client()
+    # 退款用例反复对同一订单退款，预先记录足够大的订单金额
+    refund_ledger().record_order("202401010000001234", 10**12)
+    with client.session_transaction() as session:
+        session["openid"] = "oUpF8uMuAJO_M2pxb1Q9zNjWeS6o"
+    notify_headers, notify_body = make_notify(keys, sample_transaction())
+    index_etag = client.get("/").headers["ETag"]
+
+    def post(path, payload):
+        return lambda: client.post(path, json=payload)
+
+    return {
+        "route_index": lambda: client.get("/"),
+        "route_native_pay_page": lambda: client.get("/native_pay"),
+        "route_refund_page": lambda: client.get("/refund"),
+        "route_transfer_page": lambda: client.get("/transfer"),
+        "route_pay_page": lambda: client.get("/pay"),
+        "route_pay_page_gzip": lambda: client.get("/pay", headers={"Accept-Encoding": "gzip"}),
+        "route_index_not_modified": lambda: client.get("/", headers={"If-None-Match": index_etag}),
+        "route_create_order": post("/create_order", {"openid": "oUpF8uMuAJO_M2pxb1Q9zNjWeS6o", "amount": 1}),
+        "route_create_native_order": post("/create_native_order", {"amount": 1, "description": "测试商品"}),
+        "route_query_order": post("/query_order", {"out_trade_no": "202401010000001234"}),
+        "route_do_refund": post("/do_refund", {"out_trade_no": "202401010000001234", "amount": 1}),
+        "route_query_refund": post("/query_refund", {"out_refund_no": "R202401010000001234"}),
+        "route_create_transfer": post("/create_transfer", {"openid": "oUpF8uMuAJO_M2pxb1Q9zNjWeS6o", "amount": 100}),
+        "route_query_transfer": post("/query_transfer", {"out_bill_no": "B202401010000001234"}),
+        "route_notify": lambda: client.post("/wxpay/notify", data=notify_body, headers=notify_headers),
+        "route_metrics": lambda: client.get("/metrics"),
+    }
+
+
+def run(name_filter=None, min_time=0.5):
+    from loguru import logger
+
+    # 基准测试只关注处理耗时，不输出日志
+    logger.remove()
+    keys = TestKeys()
+    keys.apply_env()
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("REFUND_LEDGER_PATH", os.path.join(keys.directory, "refund_ledger.db"))
+    os.environ.setdefault("ORDER_STORE_PATH", os.path.join(keys.directory, "orders.db"))
+    os.environ.setdefault("TRANSFER_STORE_PATH", os.path.join(keys.directory, "transfers.db"))
+    os.environ.setdefault("AUDIT_LOG_DIR", os.path.join(keys.directory, "audit"))
+    os.environ.setdefault("ROLLUP_PATH", os.path.join(keys.directory, "rollups.bin"))
+    os.environ.setdefault("ROLLUP_EVENTS_PATH", os.path.join(keys.directory, "rollups.db"))
+    # 基准测试反复发送相同的请求包体，关闭幂等处理，否则测到的是重放应答的耗时
+    os.environ.setdefault("IDEMPOTENCY_BACKEND", "none")
+    # 查询路由测量的是查询微信支付的耗时，中间状态不使用共享状态表中的结果
+    os.environ.setdefault("SHARED_STATE_PATH", os.path.join(keys.directory, "shared_state.bin"))
+    os.environ.setdefault("SHARED_STATE_MAX_AGE", "0")
+    standin = StandIn(keys)
+    results = {}
+    with standin.installed():
+        suites = [("micro", micro_benchmarks), ("macro", macro_benchmarks)]
+        for suite, factory in suites:
+            try:
+                cases = factory(keys)
+            except Exception as e:
+                print(f"[{suite}] 无法初始化: {e!r}", file=sys.stderr)
+                continue
+            # app.py 导入时会重新配置日志 sink
+            logger.remove()
+            for name, fn in cases.items():
+                if name_filter and name_filter not in name:
+                    continue
+                results[name] = {"suite": suite, **measure(fn, min_time=min_time)}
+                print(f"{name:<28} p50={results[name]['p50_us']:>10.1f}us  "
+                      f"p95={results[name]['p95_us']:>10.1f}us  {results[name]['ops_per_sec']:>10.1f} ops/s")
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def compare(current, baseline, tolerance):
+    """对比 p50，超过 (1 + tolerance) 倍视为性能回退，返回回退的用例列表"""
+    regressions = []
+    print(f"\n{'benchmark':<28} {'baseline p50':>14} {'current p50':>14} {'change':>9}")
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<28} {'-':>14} {result['p50_us']:>12.1f}us {'new':>9}")
+            continue
+        change = result["p50_us"] / base["p50_us"] - 1 if base["p50_us"] else 0.0
+        flag = " REGRESSION" if change > tolerance else ""
+        print(f"{name:<28} {base['p50_us']:>12.1f}us {result['p50_us']:>12.1f}us {change:>+8.1%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="微信支付热点路径基准测试")
+    parser.add_argument("--output", help="结果保存路径(JSON)")
+    parser.add_argument("--baseline", help="基线结果路径(JSON)")
+    parser.add_argument("--update-baseline", action="store_true", help="用本次结果覆盖基线")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="允许的 p50 回退比例")
+    parser.add_argument("--filter", help="只运行名称包含该字符串的用例")
+    parser.add_argument("--min-time", type=float, default=0.5, help="每个用例的最短运行时间(秒)")
+    args = parser.parse_args(argv)
+
+    current = run(args.filter, args.min_time)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, ensure_ascii=False)
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(current, f, indent=2, ensure_ascii=False)
+        print(f"\n基线已更新: {args.baseline}")
+        return 0
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance)
+        if regressions:
+            print(f"\n性能回退: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""进程内的微信支付上游替身
+
+替换 ``requests.request`` 与 ``requests.Session.request``，按接口路径返回固定的、带平台签名的应答，
+用于在不访问外网的情况下测量 Flask 路由的完整处理耗时。
+"""
+
+import datetime
+import json
+import re
+from contextlib import contextmanager
+from unittest import mock
+
+import requests
+
+_ROUTES = [
+    ("POST", re.compile(r"/v3/pay/transactions/(jsapi|native)$"), "order"),
+    ("GET", re.compile(r"/v3/pay/transactions/out-trade-no/(?P<no>[^/?]+)"), "query_order"),
+    ("POST", re.compile(r"/v3/pay/transactions/out-trade-no/(?P<no>[^/?]+)/close$"), "close_order"),
+    ("POST", re.compile(r"/v3/refund/domestic/refunds$"), "refund"),
+    ("GET", re.compile(r"/v3/refund/domestic/refunds/(?P<no>[^/?]+)"), "query_refund"),
+    ("POST", re.compile(r"/v3/fund-app/mch-transfer/transfer-bills$"), "transfer"),
+    ("GET", re.compile(r"/v3/fund-app/mch-transfer/transfer-bills/out-bill-no/(?P<no>[^/?]+)"), "query_transfer"),
+    ("GET", re.compile(r"/sns/oauth2/access_token"), "oauth"),
+]
+
+
+def _payload(kind, match, body):
+    request_body = json.loads(body) if body else {}
+    match kind:
+        case "order":
+            if match.group(1) == "jsapi":
+                return {"prepay_id": "wx201410272009395522657a690389285100"}
+            return {"code_url": "weixin://wxpay/bizpayurl/up?pr=NwY5Mz9&groupid=00"}
+        case "query_order":
+            return {
+                "out_trade_no": match.group("no"),
+                "trade_state": "NOTPAY",
+                "trade_state_desc": "订单未支付",
+                "amount": {"total": 100, "currency": "CNY"},
+            }
+        case "refund":
+            return {
+                "refund_id": "50000000382019052709732678859",
+                "out_refund_no": request_body.get("out_refund_no"),
+                "out_trade_no": request_body.get("out_trade_no"),
+                "status": "PROCESSING",
+                "amount": request_body.get("amount"),
+            }
+        case "query_refund":
+            return {
+                "refund_id": "50000000382019052709732678859",
+                "out_refund_no": match.group("no"),
+                "out_trade_no": "202401010000001234",
+                "status": "SUCCESS",
+                "amount": {"refund": 1, "total": 100, "currency": "CNY"},
+            }
+        case "transfer":
+            return {
+                "out_bill_no": request_body.get("out_bill_no"),
+                "transfer_bill_no": "1330000071100999991182020050700019480001",
+                "create_time": "2024-01-01T00:00:00+08:00",
+                "state": "WAIT_USER_CONFIRM",
+                "package_info": "affffddafdfafddffda==",
+            }
+        case "query_transfer":
+            return {"out_bill_no": match.group("no"), "state": "WAIT_USER_CONFIRM"}
+        case "oauth":
+            return {"openid": "oUpF8uMuAJO_M2pxb1Q9zNjWeS6o", "access_token": "ACCESS_TOKEN"}
+
+
+class StandIn:
+    """上游替身，记录调用次数，应答使用测试平台私钥签名"""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.calls = 0
+
+    def request(self, method, url, headers=None, data=None, json=None, **kwargs):
+        self.calls += 1
+        body = data.decode("utf-8") if isinstance(data, bytes) else data
+        if json is not None:
+            import json as _json
+
+            body = _json.dumps(json)
+        path = url.split("://", 1)[-1]
+        path = path[path.find("/"):]
+        for route_method, pattern, kind in _ROUTES:
+            match = pattern.search(path)
+            if match and route_method == method.upper():
+                if kind == "close_order":
+                    return self._response(204, None)
+                return self._response(200, _payload(kind, match, body))
+        return self._response(404, {"code": "NOT_FOUND", "message": "stand-in: 未实现的接口"})
+
+    def _response(self, status_code, payload):
+        content = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = content
+        response.headers.update(self.keys.sign_response(content))
+        response.headers["Request-Id"] = f"STANDIN-{self.calls}"
+        response.headers["Content-Type"] = "application/json"
+        response.elapsed = datetime.timedelta(0)
+        return response
+
+    def get(self, url, headers=None, **kwargs):
+        return self.request("GET", url, headers=headers, **kwargs)
+
+    def post(self, url, headers=None, **kwargs):
+        return self.request("POST", url, headers=headers, **kwargs)
+
+    @contextmanager
+    def installed(self):
+        """在上下文中把 requests 的请求函数替换为替身"""
+        standin = self
+
+        def session_request(session, method, url, **kwargs):
+            return standin.request(method, url, **kwargs)
+
+        with mock.patch.object(requests, "request", self.request), mock.patch.object(
+            requests, "get", self.get
+        ), mock.patch.object(requests, "post", self.post), mock.patch.object(
+            requests.Session, "request", session_request
+        ):
+            yield self
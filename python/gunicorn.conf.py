@@ -0,0 +1,23 @@
+"""gunicorn 配置: gunicorn -c gunicorn.conf.py app:app
+
+只包含多 worker 部署需要的钩子（指标快照清理、worker 预热），worker 数、线程数、绑定地址等通过命令行或 GUNICORN_CMD_ARGS 设置。
+"""
+
+from services.metrics import REGISTRY
+
+
+def on_starting(server):
+    """master 启动时清理上次运行留下的指标快照(METRICS_MULTIPROC_DIR)"""
+    REGISTRY.reset_multiproc_dir()
+
+
+def post_worker_init(worker):
+    """worker 加载应用后立即预热并启动后台任务（超时关单、退款对账、发件箱派发、续跑中断的批量退款），不等首个请求"""
+    from app import ensure_warm_up
+
+    ensure_warm_up()
+
+
+def child_exit(server, worker):
+    """worker 退出后把它的指标快照并入已退出 worker 的合并快照"""
+    REGISTRY.retire(worker.pid)
@@ -0,0 +1,268 @@
+"""准入控制与按路由隔离(bulkhead)
+
+微信支付变慢时，转账、退款等慢请求会占满 worker 线程，回调通知和查单也随之超时。每个请求进入时按路由准入:
+
+- 每个路由有独立的并发上限(BULKHEAD_LIMITS)，超过上限的请求排队等待，队列长度不超过并发上限，
+  等待时间不超过 BULKHEAD_QUEUE_TIMEOUT 和请求剩余时间；队列已满或等待超时时立即返回 503 和 Retry-After
+- 所有受限路由共用一个总并发池（BULKHEAD_CAPACITY，应与 worker 的线程数一致），
+  其中 NOTIFY_RESERVED 个只给支付/转账回调通知使用，通知先占用预留的位置，预留位置用满时再使用共享的部分
+- 未列出的路由（页面、/metrics、/stats、/ready 等只在本地处理的路由）不受限制
+- 并发上限按进程计算，多 worker 部署时每个 worker 各自限制
+
+readiness() 综合总并发池的占用、上游耗时与失败率、连接池占用(services.upstream_health)，
+供 /ready 使用：不满足时返回 503，负载均衡据此暂时摘除该实例。正在使用的微信支付域名(services.endpoints)只展示，
+已切到备用域名不影响就绪。
+"""
+
+import math
+import os
+import threading
+import time
+
+from loguru import logger
+
+from services import deadline
+from services.endpoints import endpoint_snapshot
+from services.upstream_health import UPSTREAM
+
+DEFAULT_CAPACITY = 32
+DEFAULT_NOTIFY_RESERVED = 4
+DEFAULT_QUEUE_TIMEOUT = 0.5
+
+# 各路由默认的并发上限
+DEFAULT_LIMITS = {
+    "/create_order": 8,
+    "/create_native_order": 8,
+    "/close_order": 4,
+    "/query_order": 8,
+    "/do_refund": 4,
+    "/query_refund": 4,
+    "/refund_jobs": 2,
+    "/create_transfer": 4,
+    "/query_transfer": 8,
+    "/wx_callback": 4,
+}
+
+# 使用预留容量的回调通知路由
+NOTIFY_RULES = frozenset(
+    {
+        "/wxpay/notify",
+        "/wxpay/notify/<mch_id>",
+        "/wxpay/transfer_notify",
+        "/wxpay/transfer_notify/<mch_id>",
+    }
+)
+
+# /ready 的默认阈值
+DEFAULT_READY_MAX_LATENCY = 3.0
+DEFAULT_READY_MAX_ERROR_RATE = 0.5
+DEFAULT_READY_MAX_SATURATION = 0.9
+
+OVERLOADED = "OVERLOADED"
+
+# acquire 的结果
+ADMITTED = "admitted"
+QUEUE_FULL = "queue_full"
+TIMED_OUT = "timed_out"
+
+
+def _parse_limits(value):
+    """解析 ``/route=limit,/route2=limit`` 格式的并发上限配置"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in (value or "").split(","))):
+        route, _, limit = item.partition("=")
+        try:
+            limits[route.strip()] = max(int(limit), 1)
+        except ValueError:
+            logger.warning("忽略无效的并发上限配置: {}", item)
+    return limits
+
+
+class Bulkhead:
+    """并发上限 + 有界等待队列"""
+
+    def __init__(self, name, limit, queue_limit):
+        self.name = name
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+        # 每个请求占用的平均时长(秒)，用于估算 Retry-After
+        self.service_time = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout):
+        with self._cond:
+            # 有请求在排队时新请求也排队，先到先得
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                return ADMITTED
+            if self.waiting >= self.queue_limit or timeout <= 0:
+                self.shed += 1
+                return QUEUE_FULL
+            self.waiting += 1
+            end = time.monotonic() + timeout
+            try:
+                while self.active >= self.limit:
+                    left = end - time.monotonic()
+                    if left <= 0:
+                        self.timed_out += 1
+                        return TIMED_OUT
+                    self._cond.wait(left)
+                self.active += 1
+                self.admitted += 1
+                return ADMITTED
+            finally:
+                self.waiting -= 1
+
+    def release(self, seconds=None):
+        """释放占用，seconds 为占用时长（未处理请求时为 None，不计入平均值）"""
+        with self._cond:
+            self.active -= 1
+            if seconds is not None:
+                self.service_time = seconds if not self.service_time else self.service_time * 0.8 + seconds * 0.2
+            self._cond.notify()
+
+    def retry_after(self):
+        """按排队请求数和平均占用时长估算的重试等待(秒)，至少 1 秒"""
+        return max(1, math.ceil((self.waiting + 1) * self.service_time / self.limit))
+
+    @property
+    def saturation(self):
+        return self.active / self.limit
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "timed_out": self.timed_out,
+        }
+
+
+class Overloaded(Exception):
+    def __init__(self, bulkhead, reason):
+        super().__init__(f"{bulkhead.name}: {reason}")
+        self.bulkhead = bulkhead
+        self.reason = reason
+
+
+class Admission:
+    """按路由准入，enter 返回占用的 bulkhead 列表，请求结束后交给 leave 释放"""
+
+    def __init__(self, limits, capacity, notify_reserved, queue_timeout):
+        self.queue_timeout = queue_timeout
+        notify_reserved = min(notify_reserved, capacity - 1)
+        shared = capacity - notify_reserved
+        self.shared = Bulkhead("shared", shared, shared)
+        self.notify = Bulkhead("notify_reserved", notify_reserved, 0)
+        self.routes = {route: Bulkhead(route, limit, limit) for route, limit in limits.items()}
+
+    def enter(self, rule):
+        """准入，超过上限时抛出 Overloaded"""
+        if rule in NOTIFY_RULES:
+            if self.notify.limit and self.notify.acquire(0) == ADMITTED:
+                return [self.notify]
+            return [self._acquire(self.shared)]
+        bulkhead = self.routes.get(rule)
+        if bulkhead is None:
+            return []
+        self._acquire(bulkhead)
+        try:
+            return [bulkhead, self._acquire(self.shared)]
+        except Overloaded:
+            bulkhead.release()
+            raise
+
+    def _acquire(self, bulkhead):
+        timeout = self.queue_timeout
+        left = deadline.remaining()
+        if left is not None:
+            timeout = min(timeout, left)
+        result = bulkhead.acquire(timeout)
+        if result != ADMITTED:
+            raise Overloaded(bulkhead, result)
+        return bulkhead
+
+    @staticmethod
+    def leave(held, seconds):
+        for bulkhead in held:
+            bulkhead.release(seconds)
+
+    def bulkheads(self):
+        return [self.shared, self.notify, *self.routes.values()]
+
+    def stats(self):
+        """按 bulkhead 展开的计数，作为 /metrics 的 gauge"""
+        return {
+            f"{bulkhead.name}:{name}": value
+            for bulkhead in self.bulkheads()
+            for name, value in bulkhead.stats().items()
+        }
+
+
+def install_admission(app):
+    """注册准入钩子，返回 Admission；BULKHEAD_CAPACITY=0 时不限制，返回 None"""
+    from flask import g, jsonify, request
+
+    capacity = int(os.getenv("BULKHEAD_CAPACITY", DEFAULT_CAPACITY))
+    if capacity <= 0:
+        return None
+    admission = Admission(
+        {**DEFAULT_LIMITS, **_parse_limits(os.getenv("BULKHEAD_LIMITS"))},
+        capacity,
+        int(os.getenv("NOTIFY_RESERVED", DEFAULT_NOTIFY_RESERVED)),
+        float(os.getenv("BULKHEAD_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT)),
+    )
+    logger.info("准入控制已开启 - 总并发: {}, 通知预留: {}", capacity, admission.notify.limit)
+
+    @app.before_request
+    def _admit():
+        if request.url_rule is None:
+            return None
+        try:
+            g._bulkheads = admission.enter(request.url_rule.rule)
+        except Overloaded as e:
+            logger.warning("请求被拒绝 - 路由: {}, 原因: {}", request.path, e)
+            response = jsonify({"code": OVERLOADED, "message": "服务繁忙，请稍后重试"})
+            response.status_code = 503
+            response.headers["Retry-After"] = str(e.bulkhead.retry_after())
+            return response
+        g._admitted_at = time.perf_counter()
+        return None
+
+    @app.teardown_request
+    def _release(exc):
+        held = g.pop("_bulkheads", None)
+        if held:
+            admission.leave(held, time.perf_counter() - g.pop("_admitted_at"))
+
+    return admission
+
+
+def readiness(admission=None):
+    """是否可以接流量，以及不能接流量的原因；阈值由 READY_MAX_* 环境变量调整"""
+    max_latency = float(os.getenv("READY_MAX_LATENCY", DEFAULT_READY_MAX_LATENCY))
+    max_error_rate = float(os.getenv("READY_MAX_ERROR_RATE", DEFAULT_READY_MAX_ERROR_RATE))
+    max_saturation = float(os.getenv("READY_MAX_SATURATION", DEFAULT_READY_MAX_SATURATION))
+
+    upstream = UPSTREAM.snapshot()
+    reasons = []
+    if admission is not None and admission.shared.saturation >= max_saturation:
+        reasons.append(f"worker 并发池占用 {admission.shared.saturation:.0%}")
+    if upstream["pool_saturation"] >= max_saturation:
+        reasons.append(f"连接池占用 {upstream['pool_saturation']:.0%}")
+    if upstream["latency_ms"] is not None and upstream["latency_ms"] > max_latency * 1000:
+        reasons.append(f"微信支付平均耗时 {upstream['latency_ms']}ms")
+    if upstream["error_rate"] is not None and upstream["error_rate"] > max_error_rate:
+        reasons.append(f"微信支付失败率 {upstream['error_rate']:.0%}")
+    report = {"ready": not reasons, "reasons": reasons, "upstream": upstream, "endpoints": endpoint_snapshot()}
+    if admission is not None:
+        report["bulkheads"] = {bulkhead.name: bulkhead.stats() for bulkhead in admission.bulkheads()}
+    return report
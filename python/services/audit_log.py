@@ -0,0 +1,515 @@
+"""微信支付接口调用的审计日志
+
+每次调用微信支付 API（含重试后的最终结果、限流、超时）记录为一条二进制记录，追加写入按天划分的段文件
+（AUDIT_LOG_DIR/YYYYMMDD.seg），请求线程只把记录放入队列，由后台线程批量写出:
+
+- 记录格式: 长度(u32) + CRC32(u32) + 类型(u8) + 内容，进程崩溃留下的不完整记录在读取时跳过
+- 调用记录(EXCHANGE)的定长部分为 时间戳、状态码、尝试次数、方法、耗时(总耗时/收到响应头/读取响应体)、
+  请求与应答包体的位置和摘要，之后是 接口名、商户号、Request-Id、错误码、商户单号(out_trade_no 等)
+- 包体按 blake2b 摘要单独记录(BODY)，同一进程当天写过的相同包体不重复写入
+- 每天一个 mmap 索引文件(YYYYMMDD.idx)，按商户单号的摘要开放寻址，值为调用记录在段文件中的位置；
+  索引写满(超过 INDEX_LOAD_LIMIT)后不再写入，查询时退化为扫描当天的段文件
+- 多个 worker 写同一个段文件，写入时持有段文件的 flock，索引写入使用 MappedFile 的锁
+
+查询使用 ``python -m tools.audit_query``；包体原样保存（未脱敏），目录权限应只对运行用户开放。
+"""
+
+import atexit
+import fcntl
+import hashlib
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from loguru import logger
+
+from services.mapped_file import HEADER, HEADER_SIZE, MappedFile
+
+DEFAULT_DIRECTORY = "data/audit"
+DEFAULT_INDEX_SLOTS = 1 << 18
+
+INDEX_MAGIC = b"WXAI"
+INDEX_VERSION = 1
+# 索引使用率超过该比例后不再写入
+INDEX_LOAD_LIMIT = 0.9
+
+# 记录头: 长度、CRC32、类型
+FRAME = struct.Struct("<IIB")
+EXCHANGE_RECORD = 1
+BODY_RECORD = 2
+
+# 调用记录的定长部分: 时间戳、状态码(-1 表示没有应答)、尝试次数、方法、总耗时/响应头/响应体(毫秒)、
+# 请求包体位置、应答包体位置、请求包体摘要、应答包体摘要
+EXCHANGE = struct.Struct("<dhBBfffQQ16s16s")
+STRING_FIELDS = ("api", "mch_id", "request_id", "code", "ids")
+HASH_SIZE = 16
+NO_BODY = 0xFFFFFFFFFFFFFFFF
+
+METHODS = ("GET", "POST", "PUT", "PATCH", "DELETE")
+_METHOD_CODES = {method: i for i, method in enumerate(METHODS)}
+
+# 建立索引的商户单号
+ID_FIELDS = ("out_trade_no", "out_refund_no", "out_bill_no")
+
+# 每批最多写出的记录数，以及本进程记住的已写包体数
+BATCH_SIZE = 256
+BODY_CACHE_SIZE = 4096
+
+# 索引文件布局: 文件头之后是 条目数(u64)、是否写满(u64)，然后是 (键, 位置) 槽位
+_META_WORDS = 2
+_FIRST_SLOT_WORD = HEADER_SIZE // 8 + _META_WORDS
+
+
+def body_hash(body):
+    return hashlib.blake2b(body, digest_size=HASH_SIZE).digest()
+
+
+def id_key(out_id):
+    """商户单号在索引中的键，0 表示空槽位"""
+    return int.from_bytes(hashlib.blake2b(out_id.encode("utf-8"), digest_size=8).digest(), "little") | 1
+
+
+def day_of(ts):
+    return time.strftime("%Y%m%d", time.localtime(ts))
+
+
+class Exchange:
+    """一次接口调用，_make_request 在调用过程中填写"""
+
+    __slots__ = (
+        "ts", "api", "method", "mch_id", "ids", "request", "response", "status", "code", "request_id",
+        "attempts", "total_ms", "connect_ms", "transfer_ms", "_started",
+    )
+
+    def __init__(self, api, method, mch_id, ids):
+        self.ts = time.time()
+        self._started = time.perf_counter()
+        self.api = api
+        self.method = method
+        self.mch_id = mch_id or ""
+        self.ids = ids
+        self.request = b""
+        self.response = b""
+        self.status = None
+        self.code = ""
+        self.request_id = ""
+        self.attempts = 0
+        self.total_ms = self.connect_ms = self.transfer_ms = 0.0
+
+    def received(self, response, attempt, connect, total):
+        """记录最后一次尝试收到的应答"""
+        self.status = response.status_code
+        self.response = response.content
+        self.request_id = response.headers.get("Request-Id") or ""
+        self.attempts = attempt + 1
+        self.connect_ms = connect * 1000
+        self.transfer_ms = max(total - connect, 0.0) * 1000
+
+    def finish(self, status, result):
+        self.total_ms = (time.perf_counter() - self._started) * 1000
+        self.status = status
+        if (status is None or status >= 400) and isinstance(result, dict):
+            self.code = str(result.get("code") or "")
+
+
+def _encode_string(value):
+    data = str(value or "").encode("utf-8")[:255]
+    return bytes((len(data),)) + data
+
+
+def _frame(rtype, payload):
+    crc = zlib.crc32(payload, zlib.crc32(bytes((rtype,))))
+    return FRAME.pack(len(payload), crc, rtype) + payload
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class AuditIndex:
+    """按天的商户单号索引，slots 为槽位数（写入方）"""
+
+    def __init__(self, path, slots):
+        self.slots = slots
+        self.file = MappedFile(path, INDEX_MAGIC, INDEX_VERSION, slots, (_META_WORDS + slots * 2) * 8)
+        self.words = memoryview(self.file.mm).cast("Q")
+
+    @property
+    def created(self):
+        return self.file.created
+
+    def insert(self, out_id, offset):
+        """写入一个条目（调用方持有 file.locked()），索引已满时返回 False"""
+        meta = HEADER_SIZE // 8
+        if self.words[meta + 1]:
+            return False
+        if self.words[meta] >= self.slots * INDEX_LOAD_LIMIT:
+            self.words[meta + 1] = 1
+            logger.warning("审计日志索引已满，之后的记录只能扫描查询: {}", self.file.path)
+            return False
+        key = id_key(out_id)
+        slot = key % self.slots
+        while self.words[_FIRST_SLOT_WORD + slot * 2]:
+            slot = (slot + 1) % self.slots
+        # 先写位置再写键，无锁读取方看到键时位置已经写好
+        self.words[_FIRST_SLOT_WORD + slot * 2 + 1] = offset
+        self.words[_FIRST_SLOT_WORD + slot * 2] = key
+        self.words[meta] += 1
+        return True
+
+    def clear(self):
+        self.words[HEADER_SIZE // 8:] = memoryview(bytes(len(self.words) * 8 - HEADER_SIZE)).cast("Q")
+
+
+def probe(words, slots, out_id):
+    """在索引中查找商户单号，返回调用记录位置列表（可能因摘要冲突包含其他单号的记录）"""
+    key = id_key(out_id)
+    slot = key % slots
+    offsets = []
+    for _ in range(slots):
+        found = words[_FIRST_SLOT_WORD + slot * 2]
+        if not found:
+            break
+        if found == key:
+            offsets.append(words[_FIRST_SLOT_WORD + slot * 2 + 1])
+        slot = (slot + 1) % slots
+    return offsets
+
+
+class AuditLog:
+    """审计日志写入方，append 只入队，后台线程写出"""
+
+    def __init__(self, directory, index_slots=DEFAULT_INDEX_SLOTS):
+        self.directory = directory
+        self.index_slots = index_slots
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._writer = None
+        self.written = 0
+        self.bytes_written = 0
+        self.bodies_written = 0
+        self.bodies_deduplicated = 0
+        self.unindexed = 0
+        self.write_errors = 0
+        atexit.register(self.close)
+
+    def append(self, exchange):
+        if self._pid != os.getpid():
+            self._start()
+        self._queue.put(exchange)
+
+    def _start(self):
+        """启动写出线程；fork 出的子进程没有父进程的线程，重新打开文件并启动"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._day = None
+            self._segment_fd = None
+            self._index = None
+            self._bodies = OrderedDict()
+            self._writer = threading.Thread(target=self._run, name="audit-log", daemon=True)
+            self._writer.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                self.write_errors += 1
+                logger.error("写入审计日志失败: {}", e)
+
+    def _write_batch(self, batch):
+        by_day = OrderedDict()
+        for exchange in batch:
+            by_day.setdefault(day_of(exchange.ts), []).append(exchange)
+        for day, exchanges in by_day.items():
+            self._open(day)
+            fcntl.flock(self._segment_fd, fcntl.LOCK_EX)
+            try:
+                offset = os.fstat(self._segment_fd).st_size
+                chunks, entries = [], []
+                for exchange in exchanges:
+                    offset = self._encode(exchange, offset, chunks, entries)
+                data = b"".join(chunks)
+                _write_all(self._segment_fd, data)
+                with self._index.file.locked():
+                    for out_id, position in entries:
+                        if not self._index.insert(out_id, position):
+                            self.unindexed += 1
+            finally:
+                fcntl.flock(self._segment_fd, fcntl.LOCK_UN)
+            self.written += len(exchanges)
+            self.bytes_written += len(data)
+
+    def _encode(self, exchange, offset, chunks, entries):
+        """编码一条调用记录（包体先于调用记录写入），返回写入后的文件位置"""
+        positions, hashes = [], []
+        for body in (exchange.request, exchange.response):
+            if not body:
+                positions.append(NO_BODY)
+                hashes.append(bytes(HASH_SIZE))
+                continue
+            digest = body_hash(body)
+            position = self._bodies.get(digest)
+            if position is None:
+                record = _frame(BODY_RECORD, digest + body)
+                chunks.append(record)
+                position = offset
+                offset += len(record)
+                self._remember_body(digest, position)
+                self.bodies_written += 1
+            else:
+                self._bodies.move_to_end(digest)
+                self.bodies_deduplicated += 1
+            positions.append(position)
+            hashes.append(digest)
+
+        payload = EXCHANGE.pack(
+            exchange.ts,
+            -1 if exchange.status is None else exchange.status,
+            min(exchange.attempts, 255),
+            _METHOD_CODES.get(exchange.method, 0),
+            exchange.total_ms,
+            exchange.connect_ms,
+            exchange.transfer_ms,
+            *positions,
+            *hashes,
+        ) + b"".join(
+            _encode_string(value)
+            for value in (
+                exchange.api,
+                exchange.mch_id,
+                exchange.request_id,
+                exchange.code,
+                ",".join(f"{name}={value}" for name, value in exchange.ids.items()),
+            )
+        )
+        record = _frame(EXCHANGE_RECORD, payload)
+        chunks.append(record)
+        entries.extend((out_id, offset) for out_id in exchange.ids.values())
+        return offset + len(record)
+
+    def _remember_body(self, digest, position):
+        self._bodies[digest] = position
+        if len(self._bodies) > BODY_CACHE_SIZE:
+            self._bodies.popitem(last=False)
+
+    def _open(self, day):
+        """打开当天的段文件和索引，索引是新建的（或布局变化）时按段文件重建"""
+        if day == self._day:
+            return
+        if self._segment_fd is not None:
+            os.close(self._segment_fd)
+        path = os.path.join(self.directory, day)
+        self._segment_fd = os.open(f"{path}.seg", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._index = AuditIndex(f"{path}.idx", self.index_slots)
+        self._bodies = OrderedDict()
+        self._day = day
+        if self._index.created and os.fstat(self._segment_fd).st_size:
+            rebuild_index(self.directory, day, self._index)
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "bytes_written": self.bytes_written,
+            "bodies_written": self.bodies_written,
+            "bodies_deduplicated": self.bodies_deduplicated,
+            "unindexed": self.unindexed,
+            "write_errors": self.write_errors,
+            "pending": self._queue.qsize(),
+        }
+
+    def close(self):
+        if self._writer is not None and self._writer.is_alive() and self._pid == os.getpid():
+            self._queue.put(None)
+            self._writer.join(timeout=2)
+
+
+def rebuild_index(directory, day, index=None):
+    """按段文件重建当天的索引，写入方可以同时运行（期间持有段文件和索引的锁），返回写入的条目数"""
+    path = os.path.join(directory, day)
+    if index is None:
+        index = AuditIndex(f"{path}.idx", int(os.getenv("AUDIT_INDEX_SLOTS", DEFAULT_INDEX_SLOTS)))
+    fd = os.open(f"{path}.seg", os.O_RDONLY)
+    count = 0
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        with index.file.locked():
+            index.clear()
+            for record in AuditReader(directory).scan(day):
+                for out_id in record["ids"].values():
+                    if not index.insert(out_id, record["offset"]):
+                        return count
+                    count += 1
+    finally:
+        os.close(fd)
+    logger.info("审计日志索引已重建 - 日期: {}, 条目: {}", day, count)
+    return count
+
+
+class AuditReader:
+    """审计日志查询，只读打开段文件和索引"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def days(self, since=None, until=None):
+        """有段文件的日期(YYYYMMDD)，按时间排序"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        days = sorted(name[:-4] for name in names if name.endswith(".seg"))
+        return [day for day in days if (since is None or day >= since) and (until is None or day <= until)]
+
+    def _segment(self, day):
+        """只读映射段文件，空文件返回 None"""
+        with open(os.path.join(self.directory, f"{day}.seg"), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else None
+
+    def scan(self, day):
+        """按写入顺序遍历当天的调用记录，遇到不完整或校验失败的记录时停止"""
+        mm = self._segment(day)
+        if mm is None:
+            return
+        offset = 0
+        while offset + FRAME.size <= len(mm):
+            frame = _read_frame(mm, offset)
+            if frame is None:
+                logger.warning("审计日志记录不完整，停止读取 - 日期: {}, 位置: {}", day, offset)
+                break
+            rtype, payload, end = frame
+            if rtype == EXCHANGE_RECORD:
+                yield _decode_exchange(payload, day, offset)
+            offset = end
+
+    def find(self, out_id, since=None, until=None):
+        """按商户单号查找调用记录；索引缺失或写满的日期扫描段文件"""
+        records = []
+        for day in self.days(since, until):
+            index = self._index(day)
+            if index is None:
+                records.extend(record for record in self.scan(day) if out_id in record["ids"].values())
+                continue
+            words, slots = index
+            mm = self._segment(day)
+            for offset in sorted(probe(words, slots, out_id)):
+                frame = _read_frame(mm, offset) if mm is not None else None
+                if frame is None or frame[0] != EXCHANGE_RECORD:
+                    continue
+                record = _decode_exchange(frame[1], day, offset)
+                if out_id in record["ids"].values():
+                    records.append(record)
+        return records
+
+    def _index(self, day):
+        """只读映射当天的索引，不存在、格式不符或已写满时返回 None"""
+        path = os.path.join(self.directory, f"{day}.idx")
+        try:
+            with open(path, "rb") as f:
+                magic, version, slots = HEADER.unpack(f.read(HEADER.size))
+                size = os.fstat(f.fileno()).st_size
+                if (magic, version) != (INDEX_MAGIC, INDEX_VERSION) or size != HEADER_SIZE + (_META_WORDS + slots * 2) * 8:
+                    return None
+                words = memoryview(mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)).cast("Q")
+        except (FileNotFoundError, struct.error):
+            return None
+        if words[HEADER_SIZE // 8 + 1]:
+            return None
+        return words, slots
+
+    def body(self, day, offset):
+        """读取包体，offset 为调用记录中的 request_body / response_body"""
+        if offset is None or offset == NO_BODY:
+            return b""
+        mm = self._segment(day)
+        frame = _read_frame(mm, offset) if mm is not None else None
+        if frame is None or frame[0] != BODY_RECORD:
+            raise ValueError(f"包体记录不存在: {day}@{offset}")
+        return frame[1][HASH_SIZE:]
+
+
+def _read_frame(mm, offset):
+    """读取一条记录，返回 (类型, 内容, 下一条记录位置)，不完整或校验失败时返回 None"""
+    if offset + FRAME.size > len(mm):
+        return None
+    length, crc, rtype = FRAME.unpack_from(mm, offset)
+    start, end = offset + FRAME.size, offset + FRAME.size + length
+    if end > len(mm):
+        return None
+    payload = mm[start:end]
+    if zlib.crc32(payload, zlib.crc32(bytes((rtype,)))) != crc:
+        return None
+    return rtype, payload, end
+
+
+def _decode_exchange(payload, day, offset):
+    (ts, status, attempts, method, total_ms, connect_ms, transfer_ms,
+     request_body, response_body, request_hash, response_hash) = EXCHANGE.unpack_from(payload)
+    strings = {}
+    position = EXCHANGE.size
+    for name in STRING_FIELDS:
+        length = payload[position]
+        strings[name] = payload[position + 1:position + 1 + length].decode("utf-8")
+        position += 1 + length
+    ids = dict(pair.split("=", 1) for pair in strings.pop("ids").split(",") if pair)
+    return {
+        "day": day,
+        "offset": offset,
+        "ts": ts,
+        "method": METHODS[method] if method < len(METHODS) else str(method),
+        "status": None if status < 0 else status,
+        "attempts": attempts,
+        "total_ms": round(total_ms, 3),
+        "connect_ms": round(connect_ms, 3),
+        "transfer_ms": round(transfer_ms, 3),
+        **strings,
+        "ids": ids,
+        "request_body": None if request_body == NO_BODY else request_body,
+        "response_body": None if response_body == NO_BODY else response_body,
+        "request_hash": request_hash.hex() if request_body != NO_BODY else None,
+        "response_hash": response_hash.hex() if response_body != NO_BODY else None,
+    }
+
+
+_audit_log = None
+_audit_log_lock = threading.Lock()
+_disabled = False
+
+
+def audit_log():
+    """获取全局审计日志写入方，AUDIT_LOG_DIR 设置为空时不记录（返回 None）"""
+    global _audit_log, _disabled
+    if _audit_log is None and not _disabled:
+        with _audit_log_lock:
+            if _audit_log is None and not _disabled:
+                directory = os.getenv("AUDIT_LOG_DIR", DEFAULT_DIRECTORY)
+                if not directory:
+                    _disabled = True
+                    return None
+                _audit_log = AuditLog(directory, int(os.getenv("AUDIT_INDEX_SLOTS", DEFAULT_INDEX_SLOTS)))
+    return _audit_log
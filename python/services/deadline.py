@@ -0,0 +1,114 @@
+"""请求截止时间
+
+每个 Flask 请求进入时设置一个截止时间（``X-Request-Timeout`` 请求头，或按路由的默认值），
+保存在 contextvar 中，向微信支付发起的每次请求（包括重试）都从剩余时间中扣减超时，
+截止时间已过时不再发起请求，直接返回 DEADLINE_EXCEEDED。
+
+后台线程（批量退款、超时关单等）没有截止时间，只受各接口自身的超时限制。
+"""
+
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+# 默认的请求截止时间(秒)，可由 REQUEST_DEADLINE 调整
+DEFAULT_REQUEST_DEADLINE = 15.0
+
+# 客户端通过 X-Request-Timeout 请求头声明的截止时间上限(秒)
+MAX_REQUEST_DEADLINE = 60.0
+
+# 不设置截止时间的路由（只在本地处理，或为内部管理接口）
+EXEMPT_PATHS = ("/metrics", "/stats", "/ready", "/static/")
+
+# 错误分类，作为接口返回结果中的 code
+DEADLINE_EXCEEDED = "DEADLINE_EXCEEDED"
+CONNECT_TIMEOUT = "CONNECT_TIMEOUT"
+READ_TIMEOUT = "READ_TIMEOUT"
+CONNECTION_ERROR = "CONNECTION_ERROR"
+
+ERROR_MESSAGES = {
+    DEADLINE_EXCEEDED: "请求截止时间已到，未完成对微信支付的调用",
+    CONNECT_TIMEOUT: "连接微信支付超时",
+    READ_TIMEOUT: "等待微信支付应答超时",
+    CONNECTION_ERROR: "连接微信支付失败",
+}
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def remaining():
+    """距离截止时间的剩余秒数，没有截止时间时返回 None"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def clip_timeout(timeout):
+    """按剩余时间收紧 (connect, read) 超时"""
+    left = remaining()
+    if left is None:
+        return timeout
+    left = max(left, 0.001)
+    return tuple(min(value, left) for value in timeout)
+
+
+def classify(exc):
+    """把 requests 的异常归类为错误码，无法归类时返回 None"""
+    import requests
+
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return CONNECT_TIMEOUT
+    if isinstance(exc, requests.exceptions.Timeout):
+        return READ_TIMEOUT
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        return CONNECTION_ERROR
+    return None
+
+
+def error_result(code, detail=None):
+    """分类错误的返回结果，与微信支付错误应答的格式一致"""
+    message = ERROR_MESSAGES[code]
+    return {"code": code, "message": f"{message}: {detail}" if detail else message}
+
+
+@contextmanager
+def deadline_scope(seconds):
+    """在上下文中设置截止时间，已有更早的截止时间时保留原值"""
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def install_deadline(app):
+    """为每个请求设置截止时间"""
+    from flask import g, request
+
+    default = float(os.getenv("REQUEST_DEADLINE", DEFAULT_REQUEST_DEADLINE))
+
+    @app.before_request
+    def _set_request_deadline():
+        if request.path.startswith(EXEMPT_PATHS):
+            return
+        seconds = default
+        header = request.headers.get("X-Request-Timeout")
+        if header:
+            try:
+                seconds = min(max(float(header), 0.0), MAX_REQUEST_DEADLINE)
+            except ValueError:
+                pass
+        g._deadline_token = _deadline.set(time.monotonic() + seconds)
+
+    @app.teardown_request
+    def _clear_request_deadline(exc):
+        token = g.pop("_deadline_token", None)
+        if token is not None:
+            _deadline.reset(token)
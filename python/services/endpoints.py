@@ -0,0 +1,281 @@
+"""微信支付 API 域名的故障切换与对冲请求
+
+微信支付除主域名 api.mch.weixin.qq.com 外还提供备用域名 api2.mch.weixin.qq.com，两者访问同一套服务，
+地区性故障时通常只有其中一个受影响。每个域名分别记录耗时与失败率（按时间衰减的 EWMA，
+见 services/upstream_health.py），_send 每次尝试（包括重试）前选择域名:
+
+- 按优先级（主域名在前）选择第一个健康的域名: 不在熔断期内，失败率不超过 FAILOVER_ERROR_RATE，
+  平均耗时不超过 FAILOVER_LATENCY 秒，且没有进行了超过 FAILOVER_LATENCY 秒仍未返回的请求
+  （流量大时平均值被之前的正常样本稀释，域名突然变慢或挂起时靠进行中请求的等待时间尽快发现）
+- 连续 FAILOVER_FAILURES 次失败（连接失败、超时、5XX、耗时超过 FAILOVER_LATENCY、被对冲请求抢先）的域名
+  熔断 FAILOVER_COOLDOWN 秒
+- 切到备用域名后主域名不再有样本，FAILBACK_AFTER 秒后旧数据失效，主域名重新视为健康，请求回到主域名；
+  主域名仍有故障时第一个失败样本就会让失败率超过阈值，再次切走
+- 所有域名都不健康时选择失败率、耗时最低的，不拒绝请求
+
+幂等的查询接口（API_CONFIGS 中 hedge 为 True）在设置了 HEDGE_AFTER（毫秒）时对冲:
+请求超过该时间未返回时向另一个域名再发一次相同的请求，采用先返回的成功应答，另一个请求的结果只计入健康统计。
+
+健康状况按域名在进程内共享，同一组域名的所有商户共用一份。
+"""
+
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from loguru import logger
+
+from services.upstream_health import HALF_LIFE, Ewma
+
+# 微信支付备用域名
+DEFAULT_BACKUP_API_BASE = "https://api2.mch.weixin.qq.com"
+
+# 切换阈值的默认值
+DEFAULT_FAILOVER_LATENCY = 2.0
+DEFAULT_FAILOVER_ERROR_RATE = 0.5
+DEFAULT_FAILOVER_FAILURES = 3
+DEFAULT_FAILOVER_COOLDOWN = 10.0
+DEFAULT_FAILBACK_AFTER = 30.0
+
+# 对冲请求的线程数
+DEFAULT_HEDGE_WORKERS = 16
+
+
+class Endpoint:
+    """一个 API 域名及其健康统计"""
+
+    def __init__(self, base, half_life=HALF_LIFE):
+        self.base = base
+        self.latency = Ewma(half_life)
+        self.errors = Ewma(half_life)
+        # 进行中的请求: 编号 -> 开始时间
+        self.inflight = {}
+        # 连续失败或超过耗时阈值的次数
+        self.strikes = 0
+        self.down_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def stats(self, now, stale_after):
+        latency = self.latency.get(now, stale_after)
+        error_rate = self.errors.get(now, stale_after)
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "latency_ms": 0 if latency is None else round(latency * 1000, 1),
+            "error_rate": 0 if error_rate is None else round(error_rate, 3),
+            "inflight": len(self.inflight),
+            "down": int(now < self.down_until),
+        }
+
+
+class EndpointSet:
+    """按优先级排列的一组域名，选择当前应使用的域名并记录每次请求的结果"""
+
+    def __init__(
+        self,
+        bases,
+        max_latency=DEFAULT_FAILOVER_LATENCY,
+        max_error_rate=DEFAULT_FAILOVER_ERROR_RATE,
+        max_failures=DEFAULT_FAILOVER_FAILURES,
+        cooldown=DEFAULT_FAILOVER_COOLDOWN,
+        failback_after=DEFAULT_FAILBACK_AFTER,
+        hedge_after=None,
+    ):
+        self.endpoints = [Endpoint(base) for base in bases]
+        self.max_latency = max_latency
+        self.max_error_rate = max_error_rate
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failback_after = failback_after
+        # 对冲等待时间(秒)，None 表示不对冲
+        self.hedge_after = hedge_after
+        self.active = self.endpoints[0]
+        self.switches = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._tokens = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self):
+        return self.endpoints[0]
+
+    @property
+    def can_hedge(self):
+        return self.hedge_after is not None and len(self.endpoints) > 1
+
+    def _healthy(self, endpoint, now):
+        if now < endpoint.down_until:
+            return False
+        if endpoint.inflight and now - min(endpoint.inflight.values()) > self.max_latency:
+            return False
+        error_rate = endpoint.errors.get(now, self.failback_after)
+        if error_rate is not None and error_rate > self.max_error_rate:
+            return False
+        latency = endpoint.latency.get(now, self.failback_after)
+        return latency is None or latency <= self.max_latency
+
+    def _score(self, endpoint, now):
+        return (
+            now < endpoint.down_until,
+            endpoint.errors.get(now, self.failback_after) or 0.0,
+            endpoint.latency.get(now, self.failback_after) or 0.0,
+        )
+
+    def choose(self, exclude=None):
+        """当前应使用的域名；exclude 用于对冲时选择另一个域名，只有一个域名时返回 None"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint is not exclude]
+            if not candidates:
+                return None
+            chosen = next((endpoint for endpoint in candidates if self._healthy(endpoint, now)), None)
+            if chosen is None:
+                chosen = min(candidates, key=lambda endpoint: self._score(endpoint, now))
+            if exclude is None and chosen is not self.active:
+                logger.warning(
+                    "微信支付域名{} - {} -> {}",
+                    "恢复" if chosen is self.primary else "切换",
+                    self.active.base,
+                    chosen.base,
+                )
+                self.active = chosen
+                self.switches += 1
+            return chosen
+
+    def begin(self, endpoint):
+        """开始一次请求，返回交给 end 的编号"""
+        token = next(self._tokens)
+        with self._lock:
+            endpoint.inflight[token] = time.monotonic()
+        return token
+
+    def end(self, endpoint, token, seconds, failed):
+        now = time.monotonic()
+        with self._lock:
+            endpoint.inflight.pop(token, None)
+            endpoint.latency.add(seconds, now)
+            endpoint.errors.add(1.0 if failed else 0.0, now)
+            endpoint.requests += 1
+            endpoint.failures += failed
+            if not failed and seconds <= self.max_latency:
+                endpoint.strikes = 0
+            else:
+                self._strike(endpoint, now)
+
+    def record_hedge(self, endpoint, won):
+        """记录一次对冲，endpoint 为超时未返回的域名；对冲请求先返回时同样计为该域名的一次失败"""
+        with self._lock:
+            self.hedges += 1
+            self.hedge_wins += won
+            if won:
+                self._strike(endpoint, time.monotonic())
+
+    def _strike(self, endpoint, now):
+        endpoint.strikes += 1
+        if endpoint.strikes >= self.max_failures:
+            endpoint.strikes = 0
+            endpoint.down_until = now + self.cooldown
+            logger.warning("微信支付域名连续失败或超时，暂停使用 {} 秒 - {}", self.cooldown, endpoint.base)
+
+    def stats(self):
+        """按域名展开的计数，作为 /metrics 的 gauge"""
+        now = time.monotonic()
+        with self._lock:
+            stats = {
+                f"{endpoint.base}:{name}": value
+                for endpoint in self.endpoints
+                for name, value in endpoint.stats(now, self.failback_after).items()
+            }
+            stats.update(
+                {
+                    "switches": self.switches,
+                    "active_backup": int(self.active is not self.primary),
+                    "hedges": self.hedges,
+                    "hedge_wins": self.hedge_wins,
+                }
+            )
+        return stats
+
+
+_sets = {}
+_sets_lock = threading.Lock()
+_hedge_pool = None
+
+
+def endpoint_set(bases):
+    """按域名列表（主域名在前）获取共享的 EndpointSet，阈值从环境变量读取"""
+    bases = tuple(dict.fromkeys(base.rstrip("/") for base in bases if base))
+    with _sets_lock:
+        endpoints = _sets.get(bases)
+        if endpoints is None:
+            hedge_after = float(os.getenv("HEDGE_AFTER", "0")) / 1000
+            endpoints = _sets[bases] = EndpointSet(
+                bases,
+                max_latency=float(os.getenv("FAILOVER_LATENCY", DEFAULT_FAILOVER_LATENCY)),
+                max_error_rate=float(os.getenv("FAILOVER_ERROR_RATE", DEFAULT_FAILOVER_ERROR_RATE)),
+                max_failures=int(os.getenv("FAILOVER_FAILURES", DEFAULT_FAILOVER_FAILURES)),
+                cooldown=float(os.getenv("FAILOVER_COOLDOWN", DEFAULT_FAILOVER_COOLDOWN)),
+                failback_after=float(os.getenv("FAILBACK_AFTER", DEFAULT_FAILBACK_AFTER)),
+                hedge_after=hedge_after if hedge_after > 0 else None,
+            )
+            logger.info("微信支付域名: {}", ", ".join(bases))
+        return endpoints
+
+
+def endpoint_stats():
+    """所有域名组的统计，只有一组时不加前缀"""
+    with _sets_lock:
+        sets = list(_sets.values())
+    if len(sets) == 1:
+        return sets[0].stats()
+    return {f"{index}:{name}": value for index, endpoints in enumerate(sets) for name, value in endpoints.stats().items()}
+
+
+def endpoint_snapshot():
+    """各组域名的主域名与当前使用的域名，供 /ready 展示"""
+    with _sets_lock:
+        sets = list(_sets.values())
+    return [{"active": endpoints.active.base, "primary": endpoints.primary.base} for endpoints in sets]
+
+
+class HedgePool:
+    """对冲请求的线程池。被放弃的慢请求仍会占用线程直到返回，线程都在忙时 try_submit 不排队而是返回 None，
+    由调用方直接发出请求、不对冲"""
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hedge")
+        self._slots = threading.BoundedSemaphore(workers)
+
+    def try_submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            return None
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+def hedge_pool():
+    """对冲请求使用的线程池，首次使用时创建（在 fork 出的 worker 中）"""
+    global _hedge_pool
+    if _hedge_pool is None:
+        with _sets_lock:
+            if _hedge_pool is None:
+                _hedge_pool = HedgePool(int(os.getenv("HEDGE_WORKERS", DEFAULT_HEDGE_WORKERS)))
+    return _hedge_pool
+
+
+def first_success(futures, succeeded):
+    """等待一组 future，返回第一个 succeeded(result) 为真的 (future, result)；都不满足时返回最后完成的"""
+    pending = set(futures)
+    last = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            last = (future, future.result())
+            if succeeded(last[1]):
+                return last
+    return last
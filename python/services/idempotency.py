@@ -0,0 +1,313 @@
+"""下单、退款、转账接口的幂等处理
+
+客户端超时重试时，同一个请求只会向微信支付发起一次，重复的请求得到第一次的应答:
+
+- 幂等键取 ``Idempotency-Key`` 请求头，没有时不做幂等处理；设置 IDEMPOTENCY_BODY_WINDOW 后，带会话 cookie 的请求
+  按 会话 + 商户号 + 路由 + 请求包体 的摘要派生键，只在该时长(秒)内有效，避免把用户真实的重复下单合并掉。
+  没有会话的请求（例如服务端直接调用 /create_native_order）不派生: 客户端 IP 不能区分用户，
+  经过代理时所有请求的 IP 相同，不同用户相同金额和描述的下单会拿到彼此的应答
+- 同一个键的请求正在处理时，后到的请求最多等待 IDEMPOTENCY_WAIT 秒，处理完成后直接返回保存的应答，
+  等待超时返回 409；开启准入控制时等待期间占着并发名额，最长等待不超过排队超时(BULKHEAD_QUEUE_TIMEOUT)。
+  同一个键用于不同的请求包体时返回 422
+- 只保存结果确定的应答，按 IDEMPOTENCY_TTL 保存: 5XX，以及包体 code 为 -1 的应答（上游超时、异常等结果未知，
+  或参数错误）不保存，客户端可以用同一个键重试；code 为 0、-2（明确的业务失败）等应答保存
+- 后端由 IDEMPOTENCY_BACKEND 选择: memory(进程内 LRU + TTL) / sqlite(多 worker 共享，IDEMPOTENCY_SQLITE_PATH) / none
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+from services import deadline
+from services.sqlite_store import SQLiteStore
+
+# 需要幂等处理的路由
+IDEMPOTENT_ROUTES = {"/create_order", "/create_native_order", "/do_refund", "/create_transfer"}
+
+# 默认应答保存时长(秒)、派生键的有效期(秒，0 为不派生)、最多保存的应答数量
+DEFAULT_TTL = 24 * 3600
+DEFAULT_BODY_WINDOW = 0
+DEFAULT_MAX_ENTRIES = 10000
+
+# 等待处理中的相同请求的最长时间(秒)
+DEFAULT_WAIT = 30
+
+# 处理中的键超过该时长(秒)未完成视为处理它的 worker 已退出
+IN_FLIGHT_TIMEOUT = 120
+
+# sqlite 后端轮询处理结果的间隔(秒)、每保存多少条清理一次过期数据
+POLL_INTERVAL = 0.05
+PRUNE_EVERY = 100
+
+# 包体中表示结果未知的 code，这样的应答不保存
+UNKNOWN_OUTCOME_CODE = -1
+
+# 重放应答时保留的响应头
+REPLAYED_HEADERS = ("Content-Type",)
+
+# begin() 的结果
+BEGIN = "begin"  # 首个请求，继续处理
+DONE = "done"  # 已有保存的应答
+BUSY = "busy"  # 相同请求仍在处理中，等待超时
+MISMATCH = "mismatch"  # 同一个键对应不同的请求包体
+
+
+class _StatsMixin:
+    def _init_stats(self):
+        self.replays = self.waits = self.conflicts = self.mismatches = 0
+
+    def stats(self):
+        return {
+            "size": self._size(),
+            "replays": self.replays,
+            "waits": self.waits,
+            "conflicts": self.conflicts,
+            "mismatches": self.mismatches,
+        }
+
+
+class MemoryIdempotencyStore(_StatsMixin):
+    """进程内的幂等应答缓存，处理中的请求用条件变量通知等待者"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> [fingerprint, response, expires_at]
+        self._cond = threading.Condition()
+        self._init_stats()
+
+    def _size(self):
+        return len(self._entries)
+
+    def begin(self, key, fingerprint, wait=DEFAULT_WAIT):
+        deadline = time.monotonic() + wait
+        waited = False
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                entry = self._entries.get(key)
+                if entry is None or entry[2] <= now:
+                    self._entries[key] = [fingerprint, None, now + IN_FLIGHT_TIMEOUT]
+                    self._entries.move_to_end(key)
+                    return BEGIN, None
+                if entry[0] != fingerprint:
+                    self.mismatches += 1
+                    return MISMATCH, None
+                if entry[1] is not None:
+                    self.replays += 1
+                    self._entries.move_to_end(key)
+                    return DONE, entry[1]
+                if now >= deadline:
+                    self.conflicts += 1
+                    return BUSY, None
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                self._cond.wait(deadline - now)
+
+    def complete(self, key, response, ttl):
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] = response
+                entry[2] = time.monotonic() + ttl
+            # 超过容量时淘汰最久未使用的已完成应答，处理中的键移到队尾保留
+            for _ in range(len(self._entries) - self.max_entries):
+                old_key = next(iter(self._entries))
+                if self._entries[old_key][1] is None:
+                    self._entries.move_to_end(old_key)
+                else:
+                    del self._entries[old_key]
+            self._cond.notify_all()
+
+    def release(self, key):
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is None:
+                del self._entries[key]
+            self._cond.notify_all()
+
+
+class SQLiteIdempotencyStore(_StatsMixin, SQLiteStore):
+    """多个 worker 共享的幂等应答存储，等待者轮询处理结果"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS idempotency ("
+        "key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, status INTEGER, headers TEXT, body BLOB, "
+        "expires_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency(expires_at)",
+    )
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        super().__init__(path)
+        self.max_entries = max_entries
+        self._completed = 0
+        self._init_stats()
+
+    def _size(self):
+        return self._conn().execute("SELECT COUNT(*) FROM idempotency").fetchone()[0]
+
+    def begin(self, key, fingerprint, wait=DEFAULT_WAIT):
+        deadline = time.monotonic() + wait
+        waited = False
+        while True:
+            now = time.time()
+            with self.transaction() as conn:
+                row = conn.execute(
+                    "SELECT fingerprint, status, headers, body, expires_at FROM idempotency WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None or row[4] <= now:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO idempotency (key, fingerprint, expires_at) VALUES (?, ?, ?)",
+                        (key, fingerprint, now + IN_FLIGHT_TIMEOUT),
+                    )
+                    return BEGIN, None
+            if row[0] != fingerprint:
+                self.mismatches += 1
+                return MISMATCH, None
+            if row[1] is not None:
+                self.replays += 1
+                return DONE, (row[1], json.loads(row[2]), row[3])
+            if time.monotonic() >= deadline:
+                self.conflicts += 1
+                return BUSY, None
+            if not waited:
+                waited = True
+                self.waits += 1
+            time.sleep(POLL_INTERVAL)
+
+    def complete(self, key, response, ttl):
+        status, headers, body = response
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE idempotency SET status = ?, headers = ?, body = ?, expires_at = ? WHERE key = ?",
+                (status, json.dumps(headers), body, time.time() + ttl, key),
+            )
+        self._completed += 1
+        if self._completed % PRUNE_EVERY == 0:
+            self.prune()
+
+    def release(self, key):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM idempotency WHERE key = ? AND status IS NULL", (key,))
+
+    def prune(self):
+        """删除过期的应答，超过容量时删除最早过期的已完成应答"""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM idempotency WHERE expires_at <= ?", (time.time(),))
+            conn.execute(
+                "DELETE FROM idempotency WHERE key IN (SELECT key FROM idempotency WHERE status IS NOT NULL "
+                "ORDER BY expires_at LIMIT MAX((SELECT COUNT(*) FROM idempotency) - ?, 0))",
+                (self.max_entries,),
+            )
+
+
+def create_idempotency_store():
+    """按 IDEMPOTENCY_BACKEND 创建存储，none 时返回 None"""
+    backend = os.getenv("IDEMPOTENCY_BACKEND", "memory").lower()
+    max_entries = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+    if backend == "none":
+        return None
+    if backend == "sqlite":
+        path = os.getenv("IDEMPOTENCY_SQLITE_PATH", "data/idempotency.db")
+        return SQLiteIdempotencyStore(path, max_entries=max_entries)
+    if backend != "memory":
+        raise ValueError(f"不支持的 IDEMPOTENCY_BACKEND: {backend}")
+    return MemoryIdempotencyStore(max_entries=max_entries)
+
+
+def _request_key(request, session_cookie_name, body_window):
+    """返回 (幂等键, 保存时长)，没有请求头、且未开启派生键或请求没有会话时返回 (None, None)"""
+    scope = f"{request.path}:{request.headers.get('X-Mch-Id') or request.args.get('mch_id') or ''}"
+    key = request.headers.get("Idempotency-Key")
+    if key:
+        return f"{scope}:key:{key}", None
+    session_id = request.cookies.get(session_cookie_name)
+    if body_window <= 0 or not session_id:
+        return None, None
+    digest = hashlib.sha256()
+    digest.update(session_id.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(request.get_data(cache=True))
+    return f"{scope}:body:{digest.hexdigest()}", body_window
+
+
+def _definitive(response):
+    """应答的结果是否确定，只有确定的结果才保存下来重放"""
+    if response.status_code >= 500 or response.direct_passthrough:
+        return False
+    body = response.get_json(silent=True)
+    return not (isinstance(body, dict) and body.get("code") == UNKNOWN_OUTCOME_CODE)
+
+
+def install_idempotency(app, admission=None):
+    """在 app 上注册幂等处理，返回存储（未开启时返回 None）
+
+    admission 为准入控制(services.admission.Admission)时，等待相同请求的时间不超过它的排队超时
+    """
+    from flask import Response, g, jsonify, request
+
+    store = create_idempotency_store()
+    if store is None:
+        return None
+    ttl = int(os.getenv("IDEMPOTENCY_TTL", DEFAULT_TTL))
+    body_window = int(os.getenv("IDEMPOTENCY_BODY_WINDOW", DEFAULT_BODY_WINDOW))
+    wait = float(os.getenv("IDEMPOTENCY_WAIT", DEFAULT_WAIT))
+    if admission is not None:
+        # 等待时占着并发名额，不比排队等待名额更久
+        wait = min(wait, admission.queue_timeout)
+
+    @app.before_request
+    def _idempotency_begin():
+        if request.method != "POST" or request.path not in IDEMPOTENT_ROUTES:
+            return None
+        key, key_ttl = _request_key(request, app.config.get("SESSION_COOKIE_NAME", "session"), body_window)
+        if key is None:
+            return None
+        fingerprint = hashlib.sha256(request.get_data(cache=True)).hexdigest()
+        left = deadline.remaining()
+        outcome, stored = store.begin(key, fingerprint, wait if left is None else max(min(wait, left), 0))
+        if outcome == BEGIN:
+            g.idempotency_key = key
+            g.idempotency_ttl = key_ttl or ttl
+            return None
+        if outcome == DONE:
+            status, headers, body = stored
+            logger.info("重放幂等请求的应答 - 路由: {}, 幂等键: {}", request.path, key)
+            response = Response(body, status=status, headers=headers)
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+        if outcome == MISMATCH:
+            logger.warning("幂等键对应的请求内容不一致 - 路由: {}, 幂等键: {}", request.path, key)
+            return jsonify({"code": -1, "msg": "幂等键已用于不同的请求内容"}), 422
+        logger.warning("相同幂等键的请求仍在处理中 - 路由: {}, 幂等键: {}", request.path, key)
+        response = jsonify({"code": -1, "msg": "相同的请求正在处理中，请稍后重试"})
+        response.status_code = 409
+        response.headers["Retry-After"] = "1"
+        return response
+
+    @app.after_request
+    def _idempotency_complete(response):
+        key = g.pop("idempotency_key", None)
+        if key is None:
+            return response
+        if not _definitive(response):
+            store.release(key)
+        else:
+            headers = [(name, response.headers[name]) for name in REPLAYED_HEADERS if name in response.headers]
+            store.complete(key, (response.status_code, headers, response.get_data()), g.idempotency_ttl)
+        return response
+
+    @app.teardown_request
+    def _idempotency_release(exc):
+        # after_request 未执行（处理过程中抛出异常）时释放键，允许重试
+        key = g.pop("idempotency_key", None)
+        if key is not None:
+            store.release(key)
+
+    logger.info("幂等处理已开启 - 后端: {}, 保存时长: {}秒, 最长等待: {}秒", type(store).__name__, ttl, wait)
+    return store
@@ -0,0 +1,113 @@
+"""商户单号生成
+
+out_trade_no / out_refund_no / out_bill_no 要求只包含数字和大小写字母、长度不超过 32，且在商户系统内唯一。
+单号由以下部分组成（均为数字或大写字母，最长 29 位）:
+
+    [前缀 1 位] + 时间 yyyyMMddHHmmss + 毫秒 3 位 + 节点 3 位 + 进程号 5 位 + 序号 3 位
+
+- 节点: ID_NODE_ID 环境变量（0 ~ 46655），未设置时取主机名的 CRC32 并在启动时输出警告:
+  取模后不同主机名可能落到同一节点号，多台机器部署时必须为每台显式配置不同的值
+- 进程号: 同一台机器上同时存活的进程 pid 不会重复，fork 后子进程自动使用新的 pid
+- 序号: 进程内每毫秒递增，同一毫秒内用完后借用下一毫秒；时钟回拨时沿用上次的时间继续递增
+
+因此多个进程无需任何协调即可生成不重复的单号。
+"""
+
+import os
+import threading
+import time
+import zlib
+from socket import gethostname
+
+from loguru import logger
+
+_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+NODE_WIDTH = 3
+PID_WIDTH = 5
+SEQUENCE_WIDTH = 3
+MAX_SEQUENCE = 36**SEQUENCE_WIDTH
+
+
+def _base36(value, width):
+    chars = []
+    for _ in range(width):
+        value, rem = divmod(value, 36)
+        chars.append(_DIGITS[rem])
+    return "".join(reversed(chars))
+
+
+def _default_node_id():
+    node_id = os.getenv("ID_NODE_ID")
+    if node_id:
+        node_id = int(node_id)
+        if not 0 <= node_id < 36**NODE_WIDTH:
+            raise ValueError(f"ID_NODE_ID 超出范围(0 ~ {36**NODE_WIDTH - 1}): {node_id}")
+        return node_id
+    hostname = gethostname()
+    node_id = zlib.crc32(hostname.encode("utf-8")) % 36**NODE_WIDTH
+    logger.warning(
+        "未设置 ID_NODE_ID，按主机名 {} 生成节点号 {}；多台机器部署时不同主机可能得到相同的节点号，请为每台机器显式配置",
+        hostname,
+        node_id,
+    )
+    return node_id
+
+
+class IdGenerator:
+    """Snowflake 风格的单号生成器，线程安全"""
+
+    def __init__(self, node_id=None):
+        self._node = _base36((node_id if node_id is not None else _default_node_id()) % 36**NODE_WIDTH, NODE_WIDTH)
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._worker = self._node + _base36(os.getpid() % 36**PID_WIDTH, PID_WIDTH)
+        self._last_ms = 0
+        self._sequence = 0
+        self._stamp = ""
+
+    def next_id(self, prefix=""):
+        """生成一个单号，prefix 为可选的单个字母，例如退款单 R、转账单 B"""
+        now_ms = time.time_ns() // 1_000_000
+        with self._lock:
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+                self._stamp = ""
+            else:
+                # 同一毫秒内或时钟回拨，沿用上次的时间递增序号
+                self._sequence += 1
+                if self._sequence >= MAX_SEQUENCE:
+                    self._last_ms += 1
+                    self._sequence = 0
+                    self._stamp = ""
+            if not self._stamp:
+                seconds, millis = divmod(self._last_ms, 1000)
+                self._stamp = f"{time.strftime('%Y%m%d%H%M%S', time.localtime(seconds))}{millis:03d}{self._worker}"
+            return f"{prefix}{self._stamp}{_base36(self._sequence, SEQUENCE_WIDTH)}"
+
+
+_generator = IdGenerator()
+
+
+def new_out_trade_no():
+    """生成商户订单号"""
+    return _generator.next_id()
+
+
+def new_out_refund_no():
+    """生成商户退款单号"""
+    return _generator.next_id("R")
+
+
+def new_out_bill_no():
+    """生成商家转账单号"""
+    return _generator.next_id("B")
+
+
+def new_refund_job_no():
+    """生成批量退款任务号"""
+    return _generator.next_id("J")
@@ -0,0 +1,183 @@
+"""日志配置与热点路径日志工具
+
+- 日志通过 enqueue=True 的 loguru sink 写出，格式化后的记录交给后台线程落盘，请求线程不阻塞在磁盘 IO 上
+- 调用方使用 ``logger.info("xxx: {}", payload(data))`` 这种参数化写法，级别未开启时不会格式化
+- ``payload()`` 包装的大报文默认只输出长度和摘要，开启 DEBUG 或 LOG_PAYLOADS=1 时才输出脱敏后的全文；
+  JSON 对象/数组按字段脱敏，单个值（openid、授权 code 等裸字符串，以及不是 JSON 的文本）无法判断含义，一律只保留前 4 位
+- 按路由采样 INFO 及以下级别的日志，WARNING 及以上级别始终保留。loguru 在过滤器之前就格式化消息，
+  所以未被采样的请求中 ``payload()`` 只输出类型和长度，不计算摘要、不序列化、不脱敏
+
+环境变量:
+- LOG_LEVEL: 日志级别，默认 INFO
+- LOG_PAYLOADS: 为 1 时输出完整报文（已脱敏）
+- LOG_SAMPLE_RATES: 按路由采样率，例如 ``/query_order=0.1,/wxpay/notify=1``
+"""
+
+import contextvars
+import hashlib
+import json
+import os
+import random
+import sys
+
+from loguru import logger
+
+# 日志中需要脱敏的字段
+SENSITIVE_FIELDS = frozenset(
+    {
+        "openid",
+        "user_name",
+        "secret",
+        "access_token",
+        "refresh_token",
+        "paySign",
+        "signature",
+        "ciphertext",
+        "associated_data",
+        "package_info",
+        "Authorization",
+        "Wechatpay-Signature",
+    }
+)
+
+# 低于该级别编号的日志参与采样（INFO = 20）
+_SAMPLED_LEVEL_NO = 20
+
+_current_route = contextvars.ContextVar("log_route", default=None)
+_current_sampled = contextvars.ContextVar("log_sampled", default=True)
+
+_settings = {
+    "full_payloads": False,
+    "sample_rates": {},
+}
+
+
+def _parse_sample_rates(value):
+    """解析 ``/route=rate,/route2=rate`` 格式的采样配置"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in (value or "").split(","))):
+        route, _, rate = item.partition("=")
+        try:
+            rates[route.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            logger.warning(f"忽略无效的日志采样配置: {item}")
+    return rates
+
+
+def _sample_filter(record):
+    """采样过滤器：未被采样的请求只保留 WARNING 及以上级别的日志"""
+    return record["level"].no > _SAMPLED_LEVEL_NO or _current_sampled.get()
+
+
+def _inject_route(record):
+    record["extra"].setdefault("route", _current_route.get() or "-")
+
+
+def setup_logging():
+    """初始化日志 sink，应用启动时调用一次"""
+    level = os.getenv("LOG_LEVEL", "INFO").upper()
+    _settings["full_payloads"] = level == "DEBUG" or os.getenv("LOG_PAYLOADS") == "1"
+    _settings["sample_rates"] = _parse_sample_rates(os.getenv("LOG_SAMPLE_RATES"))
+
+    logger.remove()  # 清除默认的控制台输出
+    logger.configure(patcher=_inject_route)
+    logger.add(
+        sys.stdout,
+        format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
+        level=level,
+        filter=_sample_filter,
+        enqueue=True,
+    )
+    logger.add(
+        "logs/wechat_pay_{time:YYYY-MM-DD}.log",
+        rotation="00:00",
+        retention="30 days",
+        format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {extra[route]} | {name}:{function}:{line} - {message}",
+        level=level,
+        filter=_sample_filter,
+        encoding="utf-8",
+        enqueue=True,
+    )
+
+
+def begin_request(route):
+    """请求开始时记录路由并决定本次请求是否采样"""
+    _current_route.set(route)
+    rate = _settings["sample_rates"].get(route, 1.0)
+    _current_sampled.set(rate >= 1.0 or random.random() < rate)
+
+
+def install_request_logging(app):
+    """为 Flask 应用注册按路由采样的请求钩子"""
+
+    @app.before_request
+    def _begin_request_logging():
+        from flask import request
+
+        begin_request(request.path)
+
+
+def redact(obj):
+    """返回脱敏后的副本，敏感字段只保留前 4 位"""
+    if isinstance(obj, dict):
+        return {
+            key: _mask(value) if key in SENSITIVE_FIELDS else redact(value)
+            for key, value in obj.items()
+        }
+    if isinstance(obj, list):
+        return [redact(item) for item in obj]
+    return obj
+
+
+def _mask(value):
+    if value is None:
+        return None
+    text = str(value)
+    return f"{text[:4]}***" if len(text) > 4 else "***"
+
+
+def _to_bytes(obj):
+    if isinstance(obj, bytes):
+        return obj
+    if isinstance(obj, str):
+        return obj.encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+
+
+class payload:
+    """大报文日志包装，只在日志真正被格式化时才计算输出内容
+
+    默认输出 ``<N bytes sha256=xxxx>``；开启完整报文时输出脱敏后的内容，单个值只保留前 4 位。
+    未被采样的请求中只输出 ``<N bytes>`` / ``<N chars>`` / ``<dict>``：INFO 及以下的日志会被丢弃，
+    WARNING 及以上的日志需要摘要或全文时，把该路由的采样率设为 1。
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        if not _current_sampled.get():
+            if isinstance(self.obj, bytes):
+                return f"<{len(self.obj)} bytes>"
+            if isinstance(self.obj, str):
+                return f"<{len(self.obj)} chars>"
+            return f"<{type(self.obj).__name__}>"
+        if _settings["full_payloads"]:
+            obj = self.obj
+            if isinstance(obj, bytes):
+                obj = obj.decode("utf-8", errors="replace")
+            if isinstance(obj, str):
+                try:
+                    obj = json.loads(obj)
+                except ValueError:
+                    return _mask(obj)
+            if not isinstance(obj, (dict, list)):
+                return _mask(obj)
+            return json.dumps(redact(obj), ensure_ascii=False, default=str)
+        data = _to_bytes(self.obj)
+        return f"<{len(data)} bytes sha256={hashlib.sha256(data).hexdigest()[:16]}>"
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
@@ -0,0 +1,62 @@
+"""多进程共享的定长 mmap 文件
+
+同一台机器上的各 worker 映射同一个文件。文件头记录格式(magic、版本、布局参数)，与当前配置不一致时
+清空后重新初始化；写入方通过 locked() 互斥（进程内线程锁 + 跨进程 flock）。
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+from loguru import logger
+
+HEADER = struct.Struct("<4sII")  # magic, 版本, 布局参数
+HEADER_SIZE = 64
+
+
+class MappedFile:
+    """定长 mmap 文件，created 表示本次打开时新建或重新初始化了文件"""
+
+    def __init__(self, path, magic, version, layout, size):
+        self.path = path
+        self.size = HEADER_SIZE + size
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._pid = os.getpid()
+        self._thread_lock = threading.Lock()
+        expected = HEADER.pack(magic, version, layout)
+        self.created = False
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.pread(self._fd, HEADER.size, 0) != expected or os.fstat(self._fd).st_size != self.size:
+                # 新文件或布局变化时重新初始化
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self.size)
+                os.pwrite(self._fd, expected, 0)
+                self.created = True
+                logger.info("初始化共享内存文件: {}, 大小: {}字节", path, self.size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self.mm = mmap.mmap(self._fd, self.size)
+
+    @contextmanager
+    def locked(self):
+        """写入互斥，进程内的线程和同一台机器的其他进程之间都互斥"""
+        with self._thread_lock:
+            fd = self._lock_fd()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _lock_fd(self):
+        """fork 出的子进程与父进程共用打开的文件，flock 不互斥，子进程首次加锁时重新打开（调用方持有线程锁）"""
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR)
+            self._pid = os.getpid()
+        return self._fd
@@ -0,0 +1,254 @@
+"""服务商多商户配置
+
+商户配置按以下顺序加载，每个商户使用独立的客户端（各自的密钥、限流和连接池）:
+
+- MERCHANTS_FILE: JSON 文件，内容为商户配置列表，或 ``{"merchants": [...]}``
+- MERCHANTS_DB: SQLite 数据库，从 ``merchants`` 表读取，列名与配置字段一致
+- 以上都未配置时，使用 WECHAT_MCH_ID 等环境变量中的单商户配置
+
+配置字段见 ``MERCHANT_FIELDS``。解析后的 RSA 密钥缓存在按路径索引的 LRU 中（MERCHANT_KEY_CACHE_SIZE），
+客户端本身只保存配置，上千个商户也不会常驻上千份密钥。客户端（及其连接池）同样缓存在 LRU 中
+（MERCHANT_CLIENT_CACHE_SIZE），被淘汰的商户下次使用时重新创建。限流器(rate_limit)按商户号保存在注册表中，
+同一商户的各类客户端（支付、转账）共用，客户端被淘汰、重新创建后也沿用原来的令牌桶。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+# 商户配置字段与单商户模式下对应的环境变量
+MERCHANT_FIELDS = {
+    "mch_id": "WECHAT_MCH_ID",
+    "app_id": "WECHAT_APP_ID",
+    "app_secret": "WECHAT_APP_SECRET",
+    "api_key": "WECHAT_API_KEY",
+    "api_v3_key": "WECHAT_API_V3_KEY",
+    "private_key_path": "WECHAT_PRIVATE_KEY_PATH",
+    "serial_no": "WECHAT_CERT_SERIAL_NO",
+    "platform_cert_path": "WECHAT_PAY_PLAT_CERT_PATH",
+    "platform_serial_no": "WECHAT_PAY_PLAT_SERIAL_NO",
+    "api_base": "WECHAT_PAY_API_BASE",
+    "api_backup_base": "WECHAT_PAY_API_BACKUP_BASE",
+    "notify_url": "NOTIFY_URL",
+    # 每秒请求数上限，不设置时不限流
+    "rate_limit": "WECHAT_RATE_LIMIT",
+    # 连接池大小
+    "pool_size": "WECHAT_POOL_SIZE",
+}
+
+# 默认缓存的密钥数量
+DEFAULT_KEY_CACHE_SIZE = 1024
+
+# 默认缓存的客户端数量（每个客户端有自己的连接池）
+DEFAULT_CLIENT_CACHE_SIZE = 256
+
+# 等待限流令牌的最长时间(秒)
+RATE_LIMIT_WAIT = 1.0
+
+
+def merchant_from_env():
+    """从环境变量(及 .env)读取单商户配置"""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return {field: os.getenv(env) for field, env in MERCHANT_FIELDS.items() if os.getenv(env)}
+
+
+class KeyCache:
+    """按文件路径缓存解析后的 RSA 密钥，超过容量时淘汰最久未使用的"""
+
+    def __init__(self, max_entries=DEFAULT_KEY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, path):
+        with self._lock:
+            key = self._keys.get(path)
+            if key is not None:
+                self._keys.move_to_end(path)
+                self.hits += 1
+                return key
+            self.misses += 1
+
+        from Crypto.PublicKey import RSA
+
+        with open(path) as f:
+            key = RSA.import_key(f.read())
+        with self._lock:
+            self._keys[path] = key
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+                self.evictions += 1
+        return key
+
+    def stats(self):
+        return {
+            "size": len(self._keys),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+KEY_CACHE = KeyCache(int(os.getenv("MERCHANT_KEY_CACHE_SIZE", DEFAULT_KEY_CACHE_SIZE)))
+
+
+class RateLimiter:
+    """令牌桶限流，rate 为每秒请求数，允许 rate 个请求的突发；rate 不大于 0 时不限流"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.unlimited = self.rate <= 0
+        self.capacity = max(self.rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=RATE_LIMIT_WAIT):
+        """获取一个令牌，超过 timeout 仍拿不到时返回 False"""
+        if self.unlimited:
+            return True
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+def _load_file(path):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data["merchants"] if isinstance(data, dict) else data
+
+
+def _load_db(path):
+    conn = sqlite3.connect(path)
+    try:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute("SELECT * FROM merchants").fetchall()
+    finally:
+        conn.close()
+    return [{key: row[key] for key in row.keys() if row[key] is not None} for row in rows]
+
+
+class MerchantRegistry:
+    """商户注册表，按商户号懒创建并缓存客户端"""
+
+    def __init__(self, merchants, default_mch_id=None, max_clients=DEFAULT_CLIENT_CACHE_SIZE):
+        self._merchants = {str(m["mch_id"]): m for m in merchants}
+        self._by_serial = {}
+        for merchant in self._merchants.values():
+            serial = merchant.get("platform_serial_no")
+            if serial:
+                self._by_serial.setdefault(serial, []).append(str(merchant["mch_id"]))
+        self.default_mch_id = default_mch_id or next(iter(self._merchants), None)
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        # 正在创建的客户端: key -> 锁，同一商户只创建一次，不阻塞其他商户
+        self._creating = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self.client_evictions = 0
+
+    @classmethod
+    def from_env(cls):
+        if os.getenv("MERCHANTS_FILE"):
+            merchants, source = _load_file(os.getenv("MERCHANTS_FILE")), os.getenv("MERCHANTS_FILE")
+        elif os.getenv("MERCHANTS_DB"):
+            merchants, source = _load_db(os.getenv("MERCHANTS_DB")), os.getenv("MERCHANTS_DB")
+        else:
+            merchant = merchant_from_env()
+            merchants, source = ([merchant] if merchant.get("mch_id") else []), "env"
+        logger.info("加载商户配置 {} 个，来源: {}", len(merchants), source)
+        return cls(
+            merchants,
+            os.getenv("MERCHANTS_DEFAULT"),
+            int(os.getenv("MERCHANT_CLIENT_CACHE_SIZE", DEFAULT_CLIENT_CACHE_SIZE)),
+        )
+
+    def __len__(self):
+        return len(self._merchants)
+
+    def mch_ids(self):
+        return list(self._merchants)
+
+    def config(self, mch_id=None):
+        mch_id = str(mch_id or self.default_mch_id or "")
+        merchant = self._merchants.get(mch_id)
+        if merchant is None:
+            raise ValueError(f"未配置的商户号: {mch_id or '(空)'}")
+        return merchant
+
+    def client(self, client_class, mch_id=None):
+        """获取商户的客户端实例，首次使用时创建，超过 max_clients 时淘汰最久未使用的
+
+        创建客户端（加载密钥）时只持有该商户的锁，不阻塞其他商户
+        """
+        merchant = self.config(mch_id)
+        key = (client_class, merchant["mch_id"])
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+            creating = self._creating.setdefault(key, threading.Lock())
+        with creating:
+            with self._lock:
+                client = self._clients.get(key)
+            if client is not None:
+                return client
+            client = client_class(merchant, rate_limiter=self.rate_limiter(merchant["mch_id"]))
+            with self._lock:
+                self._clients[key] = client
+                self._creating.pop(key, None)
+                while len(self._clients) > self.max_clients:
+                    # 被淘汰的客户端可能仍被进行中的请求使用，不主动关闭，连接池随客户端一起回收
+                    self._clients.popitem(last=False)
+                    self.client_evictions += 1
+        return client
+
+    def rate_limiter(self, mch_id):
+        """商户共用的限流器，未配置 rate_limit 时返回 None"""
+        with self._lock:
+            if mch_id not in self._limiters:
+                rate = self.config(mch_id).get("rate_limit")
+                self._limiters[mch_id] = RateLimiter(rate) if rate else None
+            return self._limiters[mch_id]
+
+    def client_stats(self):
+        return {"size": len(self._clients), "evictions": self.client_evictions}
+
+    def notify_candidates(self, mch_id=None, serial_no=None):
+        """回调通知可能对应的商户号: 优先使用回调地址中的商户号，其次按平台证书序列号查找"""
+        if mch_id:
+            return [str(mch_id)]
+        return self._by_serial.get(serial_no) or [self.default_mch_id]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def merchant_registry():
+    """获取全局商户注册表，首次调用时加载配置"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = MerchantRegistry.from_env()
+    return _registry
@@ -0,0 +1,395 @@
+"""Prometheus 文本格式的指标采集
+
+- Counter / Histogram 按线程分片、按标签值元组存储，记录一次指标只需一次字典查找、一次二分查找和两次自增，无需加锁
+  （单次记录的开销见 ``python -m bench.run --filter metrics``）
+- 多个 gunicorn worker 时设置 ``METRICS_MULTIPROC_DIR``，每个 worker 定期把自己的快照写入该目录，
+  ``render_metrics()`` 读取目录下所有快照合并输出，任意 worker 响应 /metrics 都能看到全局数据。
+  快照文件按 PID + 进程启动时间命名；worker 退出后由 master 把它的快照并入 metrics_retired.json，
+  master 启动时清空目录（gunicorn.conf.py 中的 on_starting / child_exit 钩子）
+
+常用入口:
+- ``timed(stage, api)``: 统计某个阶段的耗时，例如签名、HTTP、验签、解密、JSON 编解码、二维码生成
+- ``record_api_result(api, status_code, result)``: 统计接口返回的 HTTP 状态码和业务状态
+"""
+
+import atexit
+import fcntl
+import glob
+import json
+import numbers
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from loguru import logger
+
+# 默认耗时分桶(秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 快照写入间隔(秒)
+FLUSH_INTERVAL = 5
+
+# 快照中标签值的分隔符
+_LABEL_SEP = "\x1f"
+
+# 已退出 worker 的快照合并后的文件
+RETIRED_SNAPSHOT = "metrics_retired.json"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _ShardedMetric:
+    """按线程分片存储的指标
+
+    每个线程只写自己的分片，热点路径上不需要加锁；汇总时合并所有分片，
+    已退出线程的分片会并入 _retired 后释放，避免线程频繁创建时分片无限增长。
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []  # [(thread, values)]
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def _new_shard(self):
+        values = self._local.values = {}
+        with self._lock:
+            self._shards.append((threading.current_thread(), values))
+        return values
+
+    def _copy(self, value):
+        return value
+
+    def snapshot(self):
+        merged = {}
+        with self._lock:
+            alive = []
+            for thread, values in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    self.merge(self._retired, {key: self._copy(v) for key, v in values.items()})
+            self._shards = alive
+            self.merge(merged, {key: self._copy(v) for key, v in self._retired.items()})
+            for _, values in alive:
+                self.merge(merged, {key: self._copy(v) for key, v in list(values.items())})
+        return {_LABEL_SEP.join(map(str, labels)) if isinstance(labels, tuple) else labels: value
+                for labels, value in merged.items()}
+
+
+class Counter(_ShardedMetric):
+    """单调递增计数器"""
+
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        try:
+            values = self._local.values
+        except AttributeError:
+            values = self._new_shard()
+        values[labels] = values.get(labels, 0) + amount
+
+    @staticmethod
+    def merge(target, source):
+        for key, value in source.items():
+            target[key] = target.get(key, 0) + value
+
+    def render(self, merged):
+        lines = []
+        for key, value in sorted(merged.items()):
+            labels = key.split(_LABEL_SEP) if self.labelnames else ()
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram(_ShardedMetric):
+    """固定分桶直方图，每个标签组合保存各分桶计数和总和"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._size = len(self.buckets) + 1
+
+    def observe(self, value, *labels):
+        try:
+            values = self._local.values
+        except AttributeError:
+            values = self._new_shard()
+        counts = values.get(labels)
+        if counts is None:
+            # [bucket_0, ..., bucket_n, +Inf, sum]
+            counts = values[labels] = [0] * self._size + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _copy(self, value):
+        return list(value)
+
+    @staticmethod
+    def merge(target, source):
+        for key, counts in source.items():
+            current = target.get(key)
+            if current is None:
+                target[key] = list(counts)
+            else:
+                for i, value in enumerate(counts):
+                    current[i] += value
+
+    def render(self, merged):
+        lines = []
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        for key, counts in sorted(merged.items()):
+            labels = key.split(_LABEL_SEP) if self.labelnames else ()
+            cumulative = 0
+            for bound, count in zip(bounds, counts[:-1]):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """指标注册表，负责多进程快照的写入与合并"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._gauge_callbacks = []
+        self._flusher = None
+        # (pid, 快照文件名)，fork 后 pid 变化时重新生成
+        self._snapshot_name = None
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def register_gauge_callback(self, name, documentation, labelname, callback):
+        """注册在渲染时计算的 Gauge，callback 返回 {标签值: 数值}，仅统计当前进程"""
+        self._gauge_callbacks.append((name, documentation, labelname, callback))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def _multiproc_dir(self):
+        return os.getenv("METRICS_MULTIPROC_DIR")
+
+    def _snapshot_path(self, directory):
+        """当前进程的快照文件，按 PID + 启动时间命名，复用 PID 的新 worker 不会覆盖旧快照"""
+        pid = os.getpid()
+        if self._snapshot_name is None or self._snapshot_name[0] != pid:
+            self._snapshot_name = (pid, f"metrics_{pid}_{time.time_ns()}.json")
+        return os.path.join(directory, self._snapshot_name[1])
+
+    def flush(self):
+        """把当前进程的快照写入共享目录（先写临时文件再原子替换）"""
+        directory = self._multiproc_dir()
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = self._snapshot_path(directory)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_flusher(self, interval=FLUSH_INTERVAL):
+        """启动后台线程定期写入快照，进程退出时再写一次"""
+        if not self._multiproc_dir() or self._flusher is not None:
+            return
+
+        def _run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.warning("写入指标快照失败: {}", e)
+
+        self._flusher = threading.Thread(target=_run, name="metrics-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    def reset_multiproc_dir(self):
+        """删除快照目录中上次运行留下的快照，由 master 在启动 worker 前调用"""
+        directory = self._multiproc_dir()
+        if not directory:
+            return
+        for path in glob.glob(os.path.join(directory, "metrics_*.json*")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def retire(self, pid):
+        """把已退出 worker 的快照并入 metrics_retired.json 后删除，由 master 在 worker 退出时调用
+
+        计数器与直方图只增不减，合并后全局数据不会因 worker 退出而回退
+        """
+        directory = self._multiproc_dir()
+        if not directory:
+            return
+        paths = glob.glob(os.path.join(directory, f"metrics_{pid}_*.json"))
+        if not paths:
+            return
+        retired_path = os.path.join(directory, RETIRED_SNAPSHOT)
+        with open(os.path.join(directory, ".retire.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired = _load_snapshot(retired_path) or {}
+            for path in paths:
+                for name, values in (_load_snapshot(path) or {}).items():
+                    _merge_values(retired.setdefault(name, {}), values)
+            tmp_path = f"{retired_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(retired, f)
+            os.replace(tmp_path, retired_path)
+            for path in paths:
+                os.remove(path)
+
+    def collect(self):
+        """合并当前进程的实时数据与其他 worker 的快照（含已退出 worker 的合并快照）"""
+        merged = self.snapshot()
+        directory = self._multiproc_dir()
+        if directory:
+            own_path = self._snapshot_path(directory)
+            for path in glob.glob(os.path.join(directory, "metrics_*.json")):
+                if path == own_path:
+                    continue
+                snapshot = _load_snapshot(path)
+                if snapshot is None:
+                    continue
+                for name, values in snapshot.items():
+                    metric = self._metrics.get(name)
+                    if metric is not None:
+                        metric.merge(merged.setdefault(name, {}), values)
+        return merged
+
+    def render(self):
+        """输出 Prometheus 文本格式"""
+        lines = []
+        for name, values in self.collect().items():
+            metric = self._metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            lines.extend(metric.render(values))
+        for name, documentation, labelname, callback in self._gauge_callbacks:
+            try:
+                values = callback()
+            except Exception as e:
+                logger.warning("采集指标 {} 失败: {}", name, e)
+                continue
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for label, value in values.items():
+                # 文本格式只接受数值，非数值会让 Prometheus 拒绝整次抓取
+                if isinstance(value, bool):
+                    value = int(value)
+                elif not isinstance(value, numbers.Real):
+                    logger.debug("跳过非数值指标 {} {}={}: {!r}", name, labelname, label, value)
+                    continue
+                lines.append(f'{name}{{{labelname}="{_escape(label)}",pid="{os.getpid()}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+def _load_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge_values(target, source):
+    """合并快照中的一个指标: 计数器为数值，直方图为分桶计数列表"""
+    for key, value in source.items():
+        current = target.get(key)
+        if current is None:
+            target[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                current[i] += item
+        else:
+            target[key] = current + value
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram("wechatpay_stage_seconds", "微信支付调用各阶段耗时(秒)", ("stage", "api"))
+)
+API_REQUESTS = REGISTRY.register(
+    Counter("wechatpay_api_requests_total", "微信支付接口调用次数(按HTTP状态码)", ("api", "status"))
+)
+BUSINESS_STATES = REGISTRY.register(
+    Counter("wechatpay_business_state_total", "微信支付接口返回的业务状态次数", ("api", "state"))
+)
+ROUTE_SECONDS = REGISTRY.register(
+    Histogram("http_route_seconds", "Flask 路由处理耗时(秒)", ("route", "status"))
+)
+
+
+class timed:
+    """统计代码块耗时: ``with timed("sign", "create_native_order"): ...``"""
+
+    __slots__ = ("stage", "api", "start")
+
+    def __init__(self, stage, api):
+        self.stage = stage
+        self.api = api
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, self.stage, self.api)
+        return False
+
+
+def observe_stage(stage, api, seconds):
+    STAGE_SECONDS.observe(seconds, stage, api)
+
+
+def record_api_result(api, status_code, result):
+    """记录接口 HTTP 状态码，以及返回结果中的业务状态(state/trade_state/status)"""
+    API_REQUESTS.inc(api, status_code or "error")
+    if isinstance(result, dict):
+        state = result.get("state") or result.get("trade_state") or result.get("status")
+        if state:
+            BUSINESS_STATES.inc(api, state)
+
+
+def install_route_metrics(app):
+    """注册 Flask 钩子，统计每个路由的处理耗时"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_route_timer():
+        g._route_started = time.perf_counter()
+
+    @app.after_request
+    def _record_route_timer(response):
+        started = g.pop("_route_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "<unmatched>"
+            ROUTE_SECONDS.observe(time.perf_counter() - started, route, response.status_code)
+        return response
+
+
+def render_metrics():
+    return REGISTRY.render()
@@ -0,0 +1,182 @@
+"""订单、退款、转账单的记录模型
+
+微信支付的应答和回调通知原先以 dict 在各处传递，取值要写成 .get() 链，处理过程中还会反复复制。
+这里的模型是只读的 __slots__ 类，每个字段对应包体中的一个路径（嵌套字段用 "." 分隔，例如 amount.total）:
+
+- from_json(raw) 只保存原始包体，首次访问字段时才解析，解析结果直接写入各个 slot
+- from_dict(data) 从已解析的 dict 取出字段，不保留 dict
+- to_wire() 按包体的格式生成 dict（省略为 None 的字段）；to_json() 对 from_json 创建且未修改的实例直接返回原始包体
+- 只读，修改使用 replace() 生成新实例
+
+只保留模型中声明的字段，包体中的其他字段只在 from_json 保留的原始包体中。
+"""
+
+import json
+
+from services.notification import json_loads
+
+
+class Model:
+    """记录模型基类，子类在 FIELDS 中声明 (属性名, 包体路径, 备选路径...)，并按属性名声明 __slots__"""
+
+    __slots__ = ("_raw",)
+
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._names = tuple(field[0] for field in cls.FIELDS)
+        cls._paths = {field[0]: tuple(tuple(path.split(".")) for path in field[1:]) for field in cls.FIELDS}
+
+    def __init__(self, **values):
+        unknown = set(values) - set(self._names)
+        if unknown:
+            raise TypeError(f"{type(self).__name__} 没有字段: {', '.join(sorted(unknown))}")
+        for name in self._names:
+            object.__setattr__(self, name, values.get(name))
+        object.__setattr__(self, "_raw", None)
+
+    @classmethod
+    def from_json(cls, raw):
+        """从原始包体(bytes/str)创建，字段在首次访问时解析"""
+        record = cls.__new__(cls)
+        object.__setattr__(record, "_raw", raw)
+        return record
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        object.__setattr__(record, "_raw", None)
+        record._load(data or {})
+        return record
+
+    def _load(self, data):
+        for name, paths in self._paths.items():
+            value = None
+            for path in paths:
+                value = data
+                for key in path:
+                    value = value.get(key) if isinstance(value, dict) else None
+                if value is not None:
+                    break
+            object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        # 只在 slot 未赋值时调用: from_json 创建的实例首次访问字段，解析包体后填入全部字段
+        if name in self._paths and object.__getattribute__(self, "_raw") is not None:
+            self._load(json_loads(self._raw))
+            return object.__getattribute__(self, name)
+        raise AttributeError(f"{type(self).__name__} 没有属性: {name}")
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} 是只读的，使用 replace() 生成修改后的实例")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} 是只读的")
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self._names)
+
+    def replace(self, **changes):
+        """返回修改了部分字段的新实例"""
+        values = dict(zip(self._names, self.values()))
+        values.update(changes)
+        return type(self)(**values)
+
+    def with_defaults(self, **defaults):
+        """为 None 的字段填上默认值，没有需要填写的字段时返回自身"""
+        missing = {name: value for name, value in defaults.items() if getattr(self, name) is None}
+        return self.replace(**missing) if missing else self
+
+    def to_wire(self):
+        """按包体格式生成 dict，字段使用第一个路径，省略为 None 的字段"""
+        wire = {}
+        for name, value in zip(self._names, self.values()):
+            if value is None:
+                continue
+            *parents, key = self._paths[name][0]
+            target = wire
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[key] = value
+        return wire
+
+    def to_json(self):
+        """包体(bytes)，from_json 创建的实例直接返回原始包体"""
+        if self._raw is not None:
+            return self._raw.encode("utf-8") if isinstance(self._raw, str) else bytes(self._raw)
+        return json.dumps(self.to_wire(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.values() == self.values()
+
+    def __hash__(self):
+        return hash((type(self), self.values()))
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={value!r}" for name, value in zip(self._names, self.values()) if value is not None)
+        return f"{type(self).__name__}({fields})"
+
+
+class Order(Model):
+    """支付订单: 查询订单应答、支付成功通知的 resource"""
+
+    FIELDS = (
+        ("out_trade_no", "out_trade_no"),
+        ("transaction_id", "transaction_id"),
+        ("appid", "appid"),
+        ("mchid", "mchid"),
+        ("trade_type", "trade_type"),
+        ("trade_state", "trade_state"),
+        ("trade_state_desc", "trade_state_desc"),
+        ("bank_type", "bank_type"),
+        ("attach", "attach"),
+        ("success_time", "success_time"),
+        ("openid", "payer.openid"),
+        ("total", "amount.total"),
+        ("payer_total", "amount.payer_total"),
+        ("currency", "amount.currency"),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+class Refund(Model):
+    """退款单: 申请/查询退款应答（状态字段 status）、退款结果通知的 resource（状态字段 refund_status）"""
+
+    FIELDS = (
+        ("out_refund_no", "out_refund_no"),
+        ("refund_id", "refund_id"),
+        ("out_trade_no", "out_trade_no"),
+        ("transaction_id", "transaction_id"),
+        ("status", "status", "refund_status"),
+        ("channel", "channel"),
+        ("user_received_account", "user_received_account"),
+        ("create_time", "create_time"),
+        ("success_time", "success_time"),
+        ("refund", "amount.refund"),
+        ("total", "amount.total"),
+        ("payer_refund", "amount.payer_refund"),
+        ("currency", "amount.currency"),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+class TransferBill(Model):
+    """商家转账单: 发起/查询转账应答、转账结果通知的 resource"""
+
+    FIELDS = (
+        ("out_bill_no", "out_bill_no"),
+        ("transfer_bill_no", "transfer_bill_no"),
+        ("appid", "appid"),
+        ("mch_id", "mch_id"),
+        ("state", "state"),
+        ("transfer_amount", "transfer_amount"),
+        ("transfer_remark", "transfer_remark"),
+        ("transfer_scene_id", "transfer_scene_id"),
+        ("openid", "openid"),
+        ("fail_reason", "fail_reason"),
+        ("package_info", "package_info"),
+        ("create_time", "create_time"),
+        ("update_time", "update_time"),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
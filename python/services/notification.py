@@ -0,0 +1,94 @@
+"""微信支付回调通知的解析
+
+每个通知只读取一次请求包体(bytes)，之后的验签、解析、解密都基于同一份数据:
+
+- 验签名串不再解码为 str 后拼接，而是把 时间戳、随机串、包体(memoryview) 依次送入 SHA256，
+  摘要只计算一次；多个商户共用同一平台证书时，同一证书的验签结果也只计算一次
+- 通知外层(envelope)只解析一次，解密时直接使用解析结果
+- JSON 解析优先使用 orjson（未安装时使用标准库 json），可通过 NOTIFY_JSON_PARSER=json 强制使用标准库
+- 解密后的 resource 明文保存为 bytes，由 resource(model) 按需生成 services.models 中的记录，不先转为 dict
+"""
+
+import json
+import os
+
+from loguru import logger
+
+_loads = None
+
+
+def json_loads(data):
+    """解析 JSON（bytes 或 str），首次调用时选择解析器"""
+    global _loads
+    if _loads is None:
+        _loads = _select_parser()
+    return _loads(data)
+
+
+def _select_parser():
+    if os.getenv("NOTIFY_JSON_PARSER", "auto").lower() != "json":
+        try:
+            import orjson
+
+            return orjson.loads
+        except ImportError:
+            logger.info("orjson 未安装，回调通知使用标准库 json 解析")
+    return json.loads
+
+
+class Notification:
+    """一次回调通知: 请求头中的签名信息、原始包体，以及按需计算并缓存的摘要、外层解析结果"""
+
+    __slots__ = (
+        "body", "timestamp", "nonce", "signature", "serial_no", "plaintext", "_digest", "_envelope", "_verified"
+    )
+
+    def __init__(self, headers, body):
+        self.body = body
+        self.timestamp = headers.get("Wechatpay-Timestamp")
+        self.nonce = headers.get("Wechatpay-Nonce")
+        self.signature = headers.get("Wechatpay-Signature")
+        self.serial_no = headers.get("Wechatpay-Serial")
+        # 解密后的 resource 明文(bytes)，由 WeChatPayBase.decrypt_resource 填入
+        self.plaintext = None
+        self._digest = None
+        self._envelope = None
+        self._verified = {}
+
+    @property
+    def complete(self):
+        """是否带有验签所需的全部请求头"""
+        return bool(self.timestamp and self.nonce and self.signature and self.serial_no)
+
+    def digest(self):
+        """验签名串 "时间戳\\n随机串\\n包体\\n" 的 SHA256，不复制包体"""
+        if self._digest is None:
+            from Crypto.Hash import SHA256
+
+            digest = SHA256.new(f"{self.timestamp}\n{self.nonce}\n".encode("utf-8"))
+            digest.update(memoryview(self.body))
+            digest.update(b"\n")
+            self._digest = digest
+        return self._digest
+
+    def verified_by(self, cert, verify):
+        """返回证书 cert 的验签结果，同一证书只调用一次 verify(digest)"""
+        key = (cert.n, cert.e)
+        if key not in self._verified:
+            self._verified[key] = verify(self.digest())
+        return self._verified[key]
+
+    @property
+    def envelope(self):
+        """通知外层的解析结果，包体不是合法 JSON 时抛出 ValueError"""
+        if self._envelope is None:
+            self._envelope = json_loads(self.body)
+        return self._envelope
+
+    @property
+    def event_type(self):
+        return self.envelope.get("event_type")
+
+    def resource(self, model):
+        """解密后的 resource 对应的记录，例如 resource(Order)，字段在首次访问时解析"""
+        return model.from_json(self.plaintext)
@@ -0,0 +1,262 @@
+"""转账、退款请求的事务性发件箱
+
+异步模式下 /create_transfer、/do_refund 只把请求意图写入 SQLite（OUTBOX_PATH）并立即返回受理句柄（商户单号），
+由后台的派发线程批量取出、按 OUTBOX_RATE 限速调用微信支付:
+
+- 商户单号(out_bill_no / out_refund_no)在写入发件箱时生成，派发、重试、进程崩溃后重新派发都使用同一个单号，
+  微信支付按单号去重，不会重复转账或退款
+- 派发前以租约(lease)方式领取条目，领取后进程退出的条目在租约到期后由任意 worker 重新派发；
+  每次领取都会增加 attempts，(id, attempts) 即本次租约的标识: 派发每个条目前续租，写回结果时只更新仍持有租约的条目，
+  租约过期后被其他 worker 重新领取的条目，原 worker 既不会再派发也不会覆盖新结果
+- 结果未知（超时、5XX、429 等）的条目按指数退避重试，超过 MAX_ATTEMPTS 次后标记为 FAILED，等待人工处理
+- 通过 ``/outbox/<单号>`` 查询派发状态和微信支付的应答
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from services.log import payload
+from services.merchant import RateLimiter
+from services.sqlite_store import SQLiteStore
+
+DEFAULT_OUTBOX_PATH = "data/outbox.db"
+
+# 默认派发线程数、每秒派发数、每批领取的条目数(不少于派发线程数)
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 50
+BATCH_SIZE = 20
+
+# 领取条目的租约时长(秒)，派发每个条目前续租，应大于单个条目的处理时间
+LEASE_SECONDS = 60
+
+# 没有待派发条目时的轮询间隔(秒)；本进程写入新条目时会立即唤醒派发线程
+POLL_INTERVAL = 0.5
+
+# 最大尝试次数，以及重试的退避时间(秒)
+MAX_ATTEMPTS = 10
+RETRY_BACKOFF = 1.0
+MAX_BACKOFF = 300.0
+
+# 条目类型
+TRANSFER = "transfer"
+REFUND = "refund"
+
+# 条目状态
+PENDING = "PENDING"
+DISPATCHING = "DISPATCHING"
+RETRY = "RETRY"
+DONE = "DONE"  # 已提交到微信支付并得到受理结果，后续状态以查询或回调为准
+FAILED = "FAILED"
+
+
+class OutboxStore(SQLiteStore):
+    """发件箱条目的持久化"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, ref TEXT NOT NULL UNIQUE, mch_id TEXT, "
+        "payload TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, result TEXT, "
+        "available_at REAL NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_available ON outbox(status, available_at)",
+    )
+
+    _COLUMNS = ("id", "kind", "ref", "mch_id", "payload", "status", "attempts", "result", "created_at", "updated_at")
+
+    def _entry(self, row):
+        entry = dict(zip(self._COLUMNS, row))
+        entry["payload"] = json.loads(entry["payload"])
+        entry["result"] = json.loads(entry["result"]) if entry["result"] else None
+        return entry
+
+    def enqueue(self, kind, ref, mch_id, data):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO outbox (kind, ref, mch_id, payload, status, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, ref, mch_id, json.dumps(data, ensure_ascii=False), PENDING, now, now, now),
+            )
+
+    def get(self, ref):
+        row = self._conn().execute(
+            f"SELECT {', '.join(self._COLUMNS)} FROM outbox WHERE ref = ?", (ref,)
+        ).fetchone()
+        return self._entry(row) if row else None
+
+    def claim(self, limit):
+        """领取一批到期的条目（待派发、待重试或租约已过期的派发中条目）"""
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute(
+                f"UPDATE outbox SET status = ?, attempts = attempts + 1, available_at = ?, updated_at = ? "
+                f"WHERE id IN (SELECT id FROM outbox WHERE status IN (?, ?, ?) AND available_at <= ? "
+                f"ORDER BY available_at LIMIT ?) RETURNING {', '.join(self._COLUMNS)}",
+                (DISPATCHING, now + LEASE_SECONDS, now, PENDING, RETRY, DISPATCHING, now, limit),
+            ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def renew(self, entry):
+        """续租，返回是否仍持有该条目的租约"""
+        now = time.time()
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE outbox SET available_at = ?, updated_at = ? WHERE id = ? AND attempts = ? AND status = ?",
+                (now + LEASE_SECONDS, now, entry["id"], entry["attempts"], DISPATCHING),
+            )
+        return cursor.rowcount == 1
+
+    def finish(self, entry, status, result, retry_at=None):
+        """写回派发结果，返回是否写入；租约已被其他 worker 接管时不写入"""
+        now = time.time()
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE outbox SET status = ?, result = ?, available_at = ?, updated_at = ? "
+                "WHERE id = ? AND attempts = ? AND status = ?",
+                (
+                    status,
+                    json.dumps(result, ensure_ascii=False),
+                    retry_at or now,
+                    now,
+                    entry["id"],
+                    entry["attempts"],
+                    DISPATCHING,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def counts(self):
+        return dict(self._conn().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+
+def _dispatch_transfer(mch_id, ref, data):
+    """返回 (状态, 结果)：有转账单状态即为已受理，code -1 为结果未知可重试，其余为失败"""
+    from services.transfer.create_transfer import get_create_transfer
+
+    result = get_create_transfer(mch_id).create_transfer_order(out_bill_no=ref, **data)
+    if result.get("state"):
+        return DONE, result
+    return (RETRY if result.get("code") == -1 else FAILED), result
+
+
+def _dispatch_refund(mch_id, ref, data):
+    """返回 (状态, 结果)：有退款状态即为已受理，结果未知的错误可使用原退款单号重试"""
+    from services.pay.refund_jobs import RETRIABLE_CODES
+    from services.pay.wechat_pay import get_wechat_pay
+
+    result = get_wechat_pay(mch_id).refund_order(
+        data["out_trade_no"], data["amount"], data.get("reason", ""), out_refund_no=ref
+    )
+    if result.get("status"):
+        return DONE, result
+    code = result.get("code")
+    return (RETRY if not code or code in RETRIABLE_CODES else FAILED), result
+
+
+HANDLERS = {TRANSFER: _dispatch_transfer, REFUND: _dispatch_refund}
+
+
+class OutboxDispatcher:
+    """发件箱派发线程池，首次写入或进程预热(warm_up)时启动"""
+
+    def __init__(self, store, workers=None, rate=None):
+        self.store = store
+        self.workers = workers or int(os.getenv("OUTBOX_WORKERS", DEFAULT_WORKERS))
+        self.limiter = RateLimiter(rate or float(os.getenv("OUTBOX_RATE", DEFAULT_RATE)))
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dispatched = self.retried = self.failed = self.lost = 0
+
+    def submit(self, kind, ref, mch_id, data):
+        """写入发件箱并唤醒派发线程，返回条目"""
+        self.store.enqueue(kind, ref, mch_id, data)
+        logger.info("写入发件箱 - 类型: {}, 单号: {}, 商户: {}", kind, ref, mch_id)
+        self.start()
+        self._wakeup.set()
+        return self.store.get(ref)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+            self._thread.start()
+        logger.info("发件箱派发已启动 - 线程数: {}, 速率: {}/s", self.workers, self.limiter.rate)
+
+    def stats(self):
+        return {
+            "dispatched": self.dispatched,
+            "retried": self.retried,
+            "failed": self.failed,
+            "lost": self.lost,
+            **{f"queued_{status.lower()}": count for status, count in self.store.counts().items()},
+        }
+
+    def _run(self):
+        """领取一批条目交给线程池派发，整批完成后再领取下一批"""
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="outbox") as pool:
+            while True:
+                try:
+                    batch = self.store.claim(max(BATCH_SIZE, self.workers))
+                except Exception as e:
+                    logger.exception("领取发件箱条目失败: {}", e)
+                    batch = []
+                if not batch:
+                    self._wakeup.wait(POLL_INTERVAL)
+                    self._wakeup.clear()
+                    continue
+                for future in [pool.submit(self._dispatch, entry) for entry in batch]:
+                    future.result()
+
+    def _dispatch(self, entry):
+        self.limiter.acquire(timeout=float("inf"))
+        # 排在批次后面的条目可能已等待较久，派发前续租，租约已过期并被重新领取时跳过
+        if not self.store.renew(entry):
+            self.lost += 1
+            logger.warning("发件箱条目租约已被接管，跳过 - 单号: {}", entry["ref"])
+            return
+        try:
+            status, result = HANDLERS[entry["kind"]](entry["mch_id"], entry["ref"], entry["payload"])
+        except Exception as e:
+            logger.exception("派发发件箱条目异常 - 单号: {}", entry["ref"])
+            status, result = RETRY, {"message": str(e)}
+
+        retry_at = None
+        if status == RETRY:
+            if entry["attempts"] >= MAX_ATTEMPTS:
+                status = FAILED
+            else:
+                retry_at = time.time() + min(RETRY_BACKOFF * 2 ** (entry["attempts"] - 1), MAX_BACKOFF)
+        if not self.store.finish(entry, status, result, retry_at):
+            # 处理超过租约时长，条目已被其他 worker 重新领取，以对方的结果为准（单号相同，微信支付侧不会重复受理）
+            self.lost += 1
+            logger.warning("发件箱条目租约已被接管，丢弃本次结果 - 单号: {}, 结果: {}", entry["ref"], payload(result))
+            return
+        if status == RETRY:
+            self.retried += 1
+        elif status == FAILED:
+            self.failed += 1
+            logger.error("发件箱条目失败 - 单号: {}, 结果: {}", entry["ref"], payload(result))
+        elif status == DONE:
+            self.dispatched += 1
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def outbox():
+    """获取全局发件箱派发器，首次调用时打开数据库"""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = OutboxDispatcher(OutboxStore(os.getenv("OUTBOX_PATH", DEFAULT_OUTBOX_PATH)))
+    return _dispatcher
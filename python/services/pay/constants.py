@@ -0,0 +1,52 @@
+"""微信支付相关常量配置"""
+
+# API配置
+API_CONFIGS = {
+    "create_jsapi_order": {
+        # 接口请求方法
+        "method": "POST",
+        # 接口请求路径
+        "path": "/v3/pay/transactions/jsapi",
+        # 接口描述
+        "desc": "JSAPI下单API",
+        # (连接, 读取) 超时(秒)，未配置时使用 wechat_pay_base.DEFAULT_TIMEOUT
+        "timeout": (3.05, 10),
+        # 超时、连接失败、429/5XX 时使用相同参数重试的次数，未配置时使用 DEFAULT_RETRIES
+        "retries": 1,
+    },
+    "create_native_order": {
+        "method": "POST",
+        "path": "/v3/pay/transactions/native",
+        "desc": "Native下单API",
+        "timeout": (3.05, 10),
+    },
+    "query_order": {
+        "method": "GET",
+        "path": "/v3/pay/transactions/out-trade-no/{out_trade_no}?mchid={mchid}",
+        "desc": "商户订单号查询订单API",
+        "timeout": (3.05, 5),
+        # 幂等查询，设置 HEDGE_AFTER 后超时未返回时向备用域名发出对冲请求，见 services/endpoints.py
+        "hedge": True,
+    },
+    "close_order": {
+        "method": "POST",
+        "path": "/v3/pay/transactions/out-trade-no/{out_trade_no}/close",
+        "desc": "关闭订单API",
+        "timeout": (3.05, 5),
+    },
+    "refund": {
+        "method": "POST",
+        "path": "/v3/refund/domestic/refunds",
+        "desc": "退款申请API",
+        "timeout": (3.05, 10),
+    },
+    "query_refund": {
+        "method": "GET",
+        "path": "/v3/refund/domestic/refunds/{out_refund_no}",
+        "desc": "查询单笔退款API",
+        "timeout": (3.05, 5),
+    },
+}
+
+# 网页授权 code 换取 openid 接口(api.weixin.qq.com)的 (连接, 读取) 超时(秒)
+OAUTH_TIMEOUT = (3.05, 5)
@@ -0,0 +1,347 @@
+"""未支付订单超时自动关单
+
+- 下单成功后订单按 创建时间 + ORDER_TTL 放入时间轮，同时下单请求带上 time_expire，微信支付侧到期也不再允许支付
+- 时间轮每 TICK 秒前进一格，到期的订单进入关单队列，由后台线程按 ORDER_CLOSE_RATE 限速、每批 CLOSE_BATCH 个调用关单 API
+- 订单状态记录在 SQLite（ORDER_STORE_PATH）中，按 商户号 + 商户订单号 索引，多个 worker 共享：关单前先把 NOTPAY 原子地改为 CLOSING，
+  同一订单只有一个 worker 会去关单；关单成功后标记为 CLOSED，/query_order 直接返回本地记录的最终状态，不再查询微信支付
+- 关单失败时查单确认状态，已支付等最终状态直接记录，其余情况延后 RETRY_DELAY 秒重试
+- 进程重启后从数据库重新加载未关闭的订单；运行中每 RESCAN_INTERVAL 秒扫描一次过期超过 RESCAN_INTERVAL 秒仍未关闭的订单，
+  由已退出的 worker 创建、不在任何存活 worker 时间轮中的订单也会被关闭
+- 支付通知、查单、关单得到的交易状态同时写入共享状态表(services.shared_state)，供各 worker 的 /query_order 直接读取
+"""
+
+import datetime
+import os
+import threading
+import time
+
+from loguru import logger
+
+from services.merchant import RateLimiter
+from services.shared_state import max_age as shared_state_max_age
+from services.shared_state import shared_state, state_key
+from services.sqlite_store import SQLiteStore
+
+DEFAULT_STORE_PATH = "data/orders.db"
+
+# 订单有效期(秒)，Native 支付二维码的有效期为 2 小时；0 表示不自动关单
+DEFAULT_ORDER_TTL = 7200
+
+# 时间轮每格的时长(秒)和格数，超过一圈的订单按圈数等待
+TICK = 1.0
+WHEEL_SIZE = 3600
+
+# 关单批大小、默认每秒关单数、失败后的重试间隔(秒)
+CLOSE_BATCH = 50
+DEFAULT_CLOSE_RATE = 5
+RETRY_DELAY = 60
+
+# CLOSING 状态超过该时长(秒)视为关单的 worker 已退出，重新加载时继续关单
+CLOSING_TIMEOUT = 300
+
+# 扫描数据库中漏关订单的间隔(秒)，只处理过期超过该时长的订单，正常情况下它们已由创建订单的 worker 关闭；每次最多加载的数量
+RESCAN_INTERVAL = 60
+RESCAN_BATCH = 1000
+
+# 本地订单状态
+NOTPAY = "NOTPAY"
+CLOSING = "CLOSING"
+CLOSED = "CLOSED"
+
+# 微信支付的最终交易状态，进入这些状态后不再关单，也不需要继续轮询
+FINAL_TRADE_STATES = {"SUCCESS", "CLOSED", "REVOKED", "REFUND", "PAYERROR"}
+
+TRADE_STATE_DESC = {
+    "SUCCESS": "支付成功",
+    "REFUND": "转入退款",
+    "NOTPAY": "未支付",
+    "CLOSED": "订单已关闭",
+    "REVOKED": "订单已撤销",
+    "USERPAYING": "用户支付中",
+    "PAYERROR": "支付失败",
+}
+
+
+def order_ttl():
+    return int(os.getenv("ORDER_TTL", DEFAULT_ORDER_TTL))
+
+
+def time_expire(created_at, ttl):
+    """下单参数 time_expire，rfc3339 格式，例如 2018-06-08T10:34:56+08:00"""
+    expire = datetime.datetime.fromtimestamp(created_at + ttl).astimezone()
+    return expire.isoformat(timespec="seconds")
+
+
+class TimingWheel:
+    """哈希时间轮，add / cancel 为 O(1)，advance 每格只扫描一个槽
+
+    非线程安全，由调用方加锁
+    """
+
+    def __init__(self, tick=TICK, size=WHEEL_SIZE, now=None):
+        self.tick = tick
+        self.size = size
+        self._slots = [dict() for _ in range(size)]
+        self._index = {}
+        self._current = self._tick_of(time.time() if now is None else now)
+
+    def _tick_of(self, timestamp):
+        return int(timestamp // self.tick)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def add(self, key, deadline):
+        """加入或重新安排到期时间，已过期的在下一格到期"""
+        self.cancel(key)
+        due = max(self._tick_of(deadline), self._current + 1)
+        slot = due % self.size
+        self._slots[slot][key] = due
+        self._index[key] = slot
+
+    def cancel(self, key):
+        slot = self._index.pop(key, None)
+        if slot is not None:
+            self._slots[slot].pop(key, None)
+
+    def advance(self, now=None):
+        """前进到 now，返回期间到期的 key"""
+        target = self._tick_of(time.time() if now is None else now)
+        expired = []
+        # 落后超过一圈时每个槽只需扫描一次
+        start = max(self._current + 1, target - self.size + 1)
+        for tick in range(start, target + 1):
+            slot = self._slots[tick % self.size]
+            due = [key for key, due_tick in slot.items() if due_tick <= target]
+            for key in due:
+                del slot[key]
+                del self._index[key]
+            expired.extend(due)
+        self._current = max(self._current, target)
+        return expired
+
+
+class OrderStore(SQLiteStore):
+    """订单本地状态，按 商户号 + 商户订单号 索引（商户订单号只在同一商户内唯一）"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS orders ("
+        "mch_id TEXT NOT NULL DEFAULT '', out_trade_no TEXT NOT NULL, state TEXT NOT NULL, "
+        "created_at REAL NOT NULL, expire_at REAL, updated_at REAL NOT NULL, PRIMARY KEY (mch_id, out_trade_no))",
+        "CREATE INDEX IF NOT EXISTS idx_orders_state ON orders(state, expire_at)",
+    )
+
+    PRIMARY_KEYS = {"orders": ["mch_id", "out_trade_no"]}
+
+    def add(self, mch_id, out_trade_no, created_at, expire_at):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO orders (mch_id, out_trade_no, state, created_at, expire_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (mch_id or "", out_trade_no, NOTPAY, created_at, expire_at, created_at),
+            )
+
+    def state(self, mch_id, out_trade_no):
+        row = self._conn().execute(
+            "SELECT state FROM orders WHERE mch_id = ? AND out_trade_no = ?", (mch_id or "", out_trade_no)
+        ).fetchone()
+        return row[0] if row else None
+
+    def mch_id(self, out_trade_no):
+        """订单所属的商户号（不同商户使用了相同订单号时取任意一个），没有记录时返回 None"""
+        row = self._conn().execute(
+            "SELECT mch_id FROM orders WHERE out_trade_no = ? LIMIT 1", (out_trade_no,)
+        ).fetchone()
+        return (row[0] or None) if row else None
+
+    def set_state(self, mch_id, out_trade_no, state):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE orders SET state = ?, updated_at = ? WHERE mch_id = ? AND out_trade_no = ?",
+                (state, time.time(), mch_id or "", out_trade_no),
+            )
+
+    def claim(self, keys):
+        """把仍未支付的订单标记为 CLOSING，keys 与返回值均为 [(mch_id, out_trade_no)]"""
+        now = time.time()
+        claimed = []
+        with self.transaction() as conn:
+            for mch_id, out_trade_no in keys:
+                row = conn.execute(
+                    "UPDATE orders SET state = ?, updated_at = ? WHERE mch_id = ? AND out_trade_no = ? "
+                    "AND (state = ? OR (state = ? AND updated_at < ?)) RETURNING mch_id",
+                    (CLOSING, now, mch_id, out_trade_no, NOTPAY, CLOSING, now - CLOSING_TIMEOUT),
+                ).fetchone()
+                if row is not None:
+                    claimed.append((mch_id, out_trade_no))
+        return claimed
+
+    def pending(self):
+        """未支付及关单中断的订单: [(mch_id, out_trade_no, expire_at)]"""
+        return self._conn().execute(
+            "SELECT mch_id, out_trade_no, expire_at FROM orders WHERE expire_at IS NOT NULL "
+            "AND (state = ? OR (state = ? AND updated_at < ?))",
+            (NOTPAY, CLOSING, time.time() - CLOSING_TIMEOUT),
+        ).fetchall()
+
+    def overdue(self, before, limit=RESCAN_BATCH):
+        """在 before 之前已过期、仍未关闭(或关单中断)的订单: [(mch_id, out_trade_no)]"""
+        rows = self._conn().execute(
+            "SELECT mch_id, out_trade_no FROM orders WHERE expire_at <= ? "
+            "AND (state = ? OR (state = ? AND updated_at < ?)) LIMIT ?",
+            (before, NOTPAY, CLOSING, time.time() - CLOSING_TIMEOUT, limit),
+        ).fetchall()
+        return [tuple(row) for row in rows]
+
+
+class OrderExpiryScheduler:
+    """时间轮驱动的关单调度器，后台线程在首次登记订单时启动"""
+
+    def __init__(self, store, ttl=None, rate=None):
+        self.store = store
+        self.ttl = order_ttl() if ttl is None else ttl
+        self.limiter = RateLimiter(rate or float(os.getenv("ORDER_CLOSE_RATE", DEFAULT_CLOSE_RATE)))
+        self._wheel = TimingWheel()
+        self._due = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self.closed = self.failed = self.rescued = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def track(self, mch_id, out_trade_no, created_at=None):
+        """登记新订单，返回到期时间；未启用自动关单时只记录状态"""
+        created_at = created_at or time.time()
+        expire_at = created_at + self.ttl if self.enabled else None
+        self.store.add(mch_id, out_trade_no, created_at, expire_at)
+        if self.enabled:
+            with self._lock:
+                self._wheel.add((mch_id or "", out_trade_no), expire_at)
+            self.start()
+        return expire_at
+
+    def finish(self, mch_id, out_trade_no, trade_state):
+        """记录交易状态（支付成功通知、查单、关单结果）到共享状态表，最终状态同时记录到本地并不再关单"""
+        shared_state().put(state_key(mch_id, out_trade_no), trade_state)
+        if trade_state not in FINAL_TRADE_STATES:
+            return
+        with self._lock:
+            self._wheel.cancel((mch_id or "", out_trade_no))
+        self.store.set_state(mch_id, out_trade_no, trade_state)
+
+    def local_state(self, mch_id, out_trade_no):
+        """不需要查询微信支付的订单状态: 共享状态表中的最终状态或仍有效的中间状态，
+        以及本地记录的最终状态，返回 {out_trade_no, trade_state, trade_state_desc}，否则返回 None
+        """
+        state = shared_state().fresh_state(state_key(mch_id, out_trade_no), FINAL_TRADE_STATES, shared_state_max_age())
+        if state is None:
+            # 共享状态表中已被淘汰时以本地记录的最终状态为准
+            state = self.store.state(mch_id, out_trade_no)
+            if state not in FINAL_TRADE_STATES:
+                return None
+        return {"out_trade_no": out_trade_no, "trade_state": state, "trade_state_desc": TRADE_STATE_DESC.get(state, "")}
+
+    def start(self):
+        """启动后台线程，并把数据库中未关闭的订单加入时间轮"""
+        if not self.enabled or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            pending = self.store.pending()
+            for mch_id, out_trade_no, expire_at in pending:
+                self._wheel.add((mch_id, out_trade_no), expire_at)
+            self._thread = threading.Thread(target=self._run, name="order-expiry", daemon=True)
+            self._thread.start()
+        logger.info("订单超时关单已启动 - 有效期: {}秒, 待关单订单: {}", self.ttl, len(pending))
+
+    def stats(self):
+        return {
+            "scheduled": len(self._wheel),
+            "due": len(self._due),
+            "closed": self.closed,
+            "failed": self.failed,
+            "rescued": self.rescued,
+        }
+
+    def rescan(self, now=None):
+        """把数据库中过期超过 RESCAN_INTERVAL 秒、不在本进程时间轮中的未关闭订单加入关单队列，返回加入的数量"""
+        now = time.time() if now is None else now
+        overdue = self.store.overdue(now - RESCAN_INTERVAL)
+        with self._lock:
+            queued = set(self._due)
+            missing = [key for key in overdue if key not in self._wheel and key not in queued]
+            self._due.extend(missing)
+        if missing:
+            self.rescued += len(missing)
+            logger.info("发现漏关的过期订单 {} 个，加入关单队列", len(missing))
+        return len(missing)
+
+    def _run(self):
+        next_rescan = time.monotonic() + RESCAN_INTERVAL
+        while True:
+            time.sleep(TICK)
+            try:
+                if time.monotonic() >= next_rescan:
+                    next_rescan = time.monotonic() + RESCAN_INTERVAL
+                    self.rescan()
+                with self._lock:
+                    self._due.extend(self._wheel.advance())
+                    batch, self._due = self._due[:CLOSE_BATCH], self._due[CLOSE_BATCH:]
+                if batch:
+                    self._close_batch(batch)
+            except Exception as e:
+                logger.exception("超时关单异常: {}", e)
+
+    def _close_batch(self, keys):
+        for mch_id, out_trade_no in self.store.claim(keys):
+            self.limiter.acquire(timeout=float("inf"))
+            # 单个订单出错（例如商户号未配置、网络异常）不影响同批次的其他订单
+            try:
+                self._close_one(mch_id, out_trade_no)
+            except Exception as e:
+                logger.exception("关单异常，{}秒后重试 - 商户订单号: {}, 错误: {}", RETRY_DELAY, out_trade_no, e)
+                self._retry_later(mch_id, out_trade_no)
+
+    def _close_one(self, mch_id, out_trade_no):
+        from services.pay.wechat_pay import get_wechat_pay
+
+        client = get_wechat_pay(mch_id or None)
+        result = client.close_order(out_trade_no)
+        if result.get("trade_state") == CLOSED:
+            self.closed += 1
+            return
+
+        # 关单失败（例如订单已支付）时以查单结果为准
+        trade_state = client.query_order_status(out_trade_no).get("trade_state")
+        if trade_state in FINAL_TRADE_STATES:
+            logger.info("订单无需关单 - 商户订单号: {}, 交易状态: {}", out_trade_no, trade_state)
+            self.finish(mch_id, out_trade_no, trade_state)
+        else:
+            logger.warning("关单失败，{}秒后重试 - 商户订单号: {}, 应答: {}", RETRY_DELAY, out_trade_no, result)
+            self._retry_later(mch_id, out_trade_no)
+
+    def _retry_later(self, mch_id, out_trade_no):
+        """关单失败: 释放 CLOSING 状态，RETRY_DELAY 秒后重新关单"""
+        self.failed += 1
+        self.store.set_state(mch_id, out_trade_no, NOTPAY)
+        with self._lock:
+            self._wheel.add((mch_id, out_trade_no), time.time() + RETRY_DELAY)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def order_expiry():
+    """获取全局关单调度器，首次调用时打开数据库"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = OrderExpiryScheduler(OrderStore(os.getenv("ORDER_STORE_PATH", DEFAULT_STORE_PATH)))
+    return _scheduler
@@ -0,0 +1,22 @@
+"""支付二维码生成"""
+
+import base64
+import io
+
+
+def render_qr_base64(code_url):
+    """将 Native 支付的 code_url 渲染为 PNG 二维码，返回 base64 字符串
+
+    qrcode 与 Pillow 导入较慢，在首次生成二维码时才导入
+    """
+    import qrcode
+
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(code_url)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+
+    # 转换为base64
+    buffered = io.BytesIO()
+    img.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode()
@@ -0,0 +1,430 @@
+"""批量退款任务
+
+一个任务包含若干条 (out_trade_no, amount, reason)，由后台线程池按并发和速率上限逐条调用 ``refund_order``。
+
+- 创建任务时就为每一条生成并保存 out_refund_no，重试和断点续跑都使用同一个单号，
+  微信支付和退款台账都按退款单号去重，不会重复退款
+- 每条的处理结果实时写入 SQLite（REFUND_JOBS_PATH），进程重启后可以从未完成的条目继续
+- 任务由心跳维持归属，心跳超时的任务可以被任意 worker 接管续跑；每个进程启动时以及之后每 HEARTBEAT_TIMEOUT 秒
+  检查一次(watch_interrupted_jobs)，worker 崩溃后立即被重启时心跳尚未超时，由之后的检查接管
+- 进度按状态计数，吞吐量按最近 THROUGHPUT_WINDOW 秒内完成的条目计算，任意 worker 都可以查询
+"""
+
+import csv
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from services import deadline
+from services.ids import new_out_refund_no, new_refund_job_no
+from services.log import payload
+from services.merchant import RateLimiter
+from services.sqlite_store import SQLiteStore
+
+DEFAULT_JOBS_PATH = "data/refund_jobs.db"
+
+# 默认并发数和每秒请求数
+DEFAULT_WORKERS = int(os.getenv("REFUND_JOB_WORKERS", "4"))
+DEFAULT_RATE = float(os.getenv("REFUND_JOB_RATE", "10"))
+
+# 单个任务允许的最大并发数
+MAX_WORKERS = 32
+
+# 单条结果未知时的最大尝试次数
+MAX_ATTEMPTS = 5
+
+# 心跳间隔及超时(秒)，超时未更新心跳的运行中任务视为中断
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 30
+
+# 吞吐量统计窗口(秒)
+THROUGHPUT_WINDOW = 10
+
+# 任务状态
+JOB_PENDING = "PENDING"
+JOB_RUNNING = "RUNNING"
+JOB_PAUSED = "PAUSED"
+JOB_DONE = "DONE"
+
+# 条目状态，SUCCESS / PROCESSING 等退款状态直接沿用微信支付返回的 status
+ITEM_PENDING = "PENDING"
+ITEM_IN_FLIGHT = "IN_FLIGHT"  # 已发出请求，结果未写回；续跑时使用同一单号重新申请
+ITEM_RETRY = "RETRY"
+ITEM_FAILED = "FAILED"
+
+UNFINISHED_ITEM_STATES = (ITEM_PENDING, ITEM_IN_FLIGHT, ITEM_RETRY)
+
+# 可以使用原单号重试的错误码；没有错误码说明请求未送达或应答无法解析，同样可以重试
+RETRIABLE_CODES = {
+    "SYSTEM_ERROR",
+    "FREQUENCY_LIMITED",
+    deadline.DEADLINE_EXCEEDED,
+    deadline.CONNECT_TIMEOUT,
+    deadline.READ_TIMEOUT,
+    deadline.CONNECTION_ERROR,
+}
+
+
+def parse_items(data, filename=None):
+    """解析任务条目，支持 JSON 列表、JSON Lines 和 CSV（out_trade_no,amount,reason，可带表头）
+
+    Returns:
+        list: [(out_trade_no, amount, reason)]，格式错误时抛出 ValueError 并指出行号
+    """
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8-sig")
+    if isinstance(data, str):
+        text = data.strip()
+        if (filename and filename.lower().endswith(".csv")) or (text and text[0] not in "[{"):
+            rows = [row for row in csv.reader(io.StringIO(text)) if row and any(cell.strip() for cell in row)]
+            if rows and rows[0][0].strip() == "out_trade_no":
+                rows = rows[1:]
+            data = [dict(zip(("out_trade_no", "amount", "reason"), row)) for row in rows]
+        elif text.startswith("["):
+            data = json.loads(text)
+        else:
+            data = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    items = []
+    for line, entry in enumerate(data, 1):
+        out_trade_no = str(entry.get("out_trade_no") or "").strip()
+        try:
+            amount = int(str(entry.get("amount")).strip())
+        except ValueError:
+            amount = 0
+        if not out_trade_no or amount <= 0:
+            raise ValueError(f"第 {line} 条格式错误: 需要 out_trade_no 和正整数金额(分)")
+        items.append((out_trade_no, amount, str(entry.get("reason") or "").strip()))
+    if not items:
+        raise ValueError("没有可处理的退款条目")
+    return items
+
+
+class RefundJobStore(SQLiteStore):
+    """批量退款任务及条目的持久化"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS refund_jobs ("
+        "job_id TEXT PRIMARY KEY, mch_id TEXT, status TEXT NOT NULL, total INTEGER NOT NULL, "
+        "workers INTEGER NOT NULL, rate REAL NOT NULL, owner TEXT, heartbeat_at REAL, "
+        "created_at REAL NOT NULL, started_at REAL, finished_at REAL)",
+        "CREATE TABLE IF NOT EXISTS refund_job_items ("
+        "job_id TEXT NOT NULL, seq INTEGER NOT NULL, out_trade_no TEXT NOT NULL, amount INTEGER NOT NULL, "
+        "reason TEXT NOT NULL, out_refund_no TEXT NOT NULL UNIQUE, status TEXT NOT NULL, "
+        "attempts INTEGER NOT NULL DEFAULT 0, result TEXT, updated_at REAL NOT NULL, "
+        "PRIMARY KEY (job_id, seq))",
+        "CREATE INDEX IF NOT EXISTS idx_refund_job_items_status ON refund_job_items(job_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_refund_job_items_updated ON refund_job_items(job_id, updated_at)",
+    )
+
+    def create(self, items, mch_id=None, workers=None, rate=None):
+        """保存任务并为每一条分配退款单号，返回 job_id
+
+        Args:
+            workers (int, optional): 并发数，默认 REFUND_JOB_WORKERS，不超过 MAX_WORKERS
+            rate (float, optional): 每秒请求数，默认 REFUND_JOB_RATE，0 表示不限速
+        """
+        workers = min(max(int(workers or DEFAULT_WORKERS), 1), MAX_WORKERS)
+        rate = float(DEFAULT_RATE if rate in (None, "") else rate)
+        job_id = new_refund_job_no()
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO refund_jobs (job_id, mch_id, status, total, workers, rate, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, mch_id, JOB_PENDING, len(items), workers, rate, now),
+            )
+            conn.executemany(
+                "INSERT INTO refund_job_items (job_id, seq, out_trade_no, amount, reason, out_refund_no, "
+                "status, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (job_id, seq, out_trade_no, amount, reason, new_out_refund_no(), ITEM_PENDING, now)
+                    for seq, (out_trade_no, amount, reason) in enumerate(items)
+                ],
+            )
+        return job_id
+
+    def job(self, job_id):
+        row = self._conn().execute(
+            "SELECT job_id, mch_id, status, total, workers, rate, owner, heartbeat_at, created_at, started_at, "
+            "finished_at FROM refund_jobs WHERE job_id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        keys = ("job_id", "mch_id", "status", "total", "workers", "rate", "owner", "heartbeat_at",
+                "created_at", "started_at", "finished_at")
+        return dict(zip(keys, row))
+
+    def claim(self, job_id, owner, retry_failed=False):
+        """获取任务的执行权: 未完成且没有存活的执行者时成功"""
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT status, owner, heartbeat_at FROM refund_jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            status, current_owner, heartbeat_at = row
+            alive = status == JOB_RUNNING and current_owner != owner and now - (heartbeat_at or 0) < HEARTBEAT_TIMEOUT
+            if alive or (status == JOB_DONE and not retry_failed):
+                return False
+            if retry_failed:
+                conn.execute(
+                    "UPDATE refund_job_items SET status = ?, attempts = 0, updated_at = ? "
+                    "WHERE job_id = ? AND status = ?",
+                    (ITEM_PENDING, now, job_id, ITEM_FAILED),
+                )
+            conn.execute(
+                "UPDATE refund_jobs SET status = ?, owner = ?, heartbeat_at = ?, finished_at = NULL, "
+                "started_at = COALESCE(started_at, ?) WHERE job_id = ?",
+                (JOB_RUNNING, owner, now, now, job_id),
+            )
+            return True
+
+    def heartbeat(self, job_id, owner):
+        """更新心跳，返回任务是否仍由 owner 执行（被暂停或被接管时返回 False）"""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE refund_jobs SET heartbeat_at = ? WHERE job_id = ? AND owner = ? AND status = ?",
+                (time.time(), job_id, owner, JOB_RUNNING),
+            )
+            return cursor.rowcount == 1
+
+    def release(self, job_id, owner, status):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE refund_jobs SET status = ?, owner = NULL, finished_at = ? "
+                "WHERE job_id = ? AND owner = ? AND status = ?",
+                (status, time.time() if status == JOB_DONE else None, job_id, owner, JOB_RUNNING),
+            )
+
+    def pause(self, job_id):
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE refund_jobs SET status = ?, owner = NULL WHERE job_id = ? AND status IN (?, ?)",
+                (JOB_PAUSED, job_id, JOB_PENDING, JOB_RUNNING),
+            )
+            return cursor.rowcount == 1
+
+    def next_items(self, job_id, limit):
+        """取出一批待处理条目并标记为 IN_FLIGHT"""
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT seq, out_trade_no, amount, reason, out_refund_no, attempts FROM refund_job_items "
+                "WHERE job_id = ? AND status IN (?, ?, ?) ORDER BY seq LIMIT ?",
+                (job_id, *UNFINISHED_ITEM_STATES, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE refund_job_items SET status = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE job_id = ? AND seq = ?",
+                [(ITEM_IN_FLIGHT, time.time(), job_id, row[0]) for row in rows],
+            )
+        return rows
+
+    def record(self, job_id, seq, status, result):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE refund_job_items SET status = ?, result = ?, updated_at = ? WHERE job_id = ? AND seq = ?",
+                (status, json.dumps(result, ensure_ascii=False), time.time(), job_id, seq),
+            )
+
+    def progress(self, job_id):
+        """任务进度: 各状态条数、已完成数、耗时、吞吐量(条/秒)和预计剩余时间"""
+        job = self.job(job_id)
+        if job is None:
+            return None
+        conn = self._conn()
+        counts = dict(
+            conn.execute(
+                "SELECT status, COUNT(*) FROM refund_job_items WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall()
+        )
+        now = time.time()
+        unfinished = sum(counts.get(status, 0) for status in UNFINISHED_ITEM_STATES)
+        completed = job["total"] - unfinished
+        recent = conn.execute(
+            "SELECT COUNT(*) FROM refund_job_items WHERE job_id = ? AND status NOT IN (?, ?, ?) AND updated_at >= ?",
+            (job_id, *UNFINISHED_ITEM_STATES, now - THROUGHPUT_WINDOW),
+        ).fetchone()[0]
+        elapsed = ((job["finished_at"] or now) - job["started_at"]) if job["started_at"] else 0.0
+        window = min(THROUGHPUT_WINDOW, elapsed)
+        throughput = recent / window if job["status"] == JOB_RUNNING and window > 0 else 0.0
+        return {
+            "job_id": job_id,
+            "mch_id": job["mch_id"],
+            "status": job["status"],
+            "total": job["total"],
+            "completed": completed,
+            "counts": counts,
+            "elapsed": round(elapsed, 3),
+            "throughput": round(throughput, 2),
+            "average_throughput": round(completed / elapsed, 2) if elapsed else 0.0,
+            "eta": round(unfinished / throughput, 1) if throughput else None,
+        }
+
+    def items(self, job_id, status=None, limit=100, offset=0):
+        sql = ("SELECT seq, out_trade_no, amount, reason, out_refund_no, status, attempts, result "
+               "FROM refund_job_items WHERE job_id = ?")
+        params = [job_id]
+        if status:
+            sql += " AND status = ?"
+            params.append(status)
+        rows = self._conn().execute(sql + " ORDER BY seq LIMIT ? OFFSET ?", (*params, limit, offset)).fetchall()
+        keys = ("seq", "out_trade_no", "amount", "reason", "out_refund_no", "status", "attempts", "result")
+        return [
+            {**dict(zip(keys, row)), "result": json.loads(row[7]) if row[7] else None}
+            for row in rows
+        ]
+
+    def interrupted_jobs(self):
+        """心跳超时的运行中任务"""
+        rows = self._conn().execute(
+            "SELECT job_id FROM refund_jobs WHERE status = ? AND heartbeat_at < ?",
+            (JOB_RUNNING, time.time() - HEARTBEAT_TIMEOUT),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+
+class RefundJobRunner(threading.Thread):
+    """在后台执行一个批量退款任务"""
+
+    def __init__(self, store, job_id, client):
+        super().__init__(name=f"refund-job-{job_id}", daemon=True)
+        self.store = store
+        self.job_id = job_id
+        self.client = client
+        self.owner = f"{os.getpid()}:{threading.get_ident()}:{job_id}"
+
+    def run(self):
+        job = self.store.job(self.job_id)
+        workers = job["workers"]
+        limiter = RateLimiter(job["rate"]) if job["rate"] else None
+        logger.info("批量退款任务开始 - 任务: {}, 共 {} 条, 并发: {}, 速率: {}/s",
+                    self.job_id, job["total"], workers, job["rate"])
+
+        stopped = threading.Event()
+        beat = threading.Thread(target=self._heartbeat, args=(stopped,), name=f"{self.name}-heartbeat", daemon=True)
+        beat.start()
+        status = JOB_DONE
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.name) as pool:
+                while not stopped.is_set():
+                    batch = self.store.next_items(self.job_id, workers * 2)
+                    if not batch:
+                        break
+                    for future in [pool.submit(self._process, limiter, *row) for row in batch]:
+                        future.result()
+        except Exception as e:
+            logger.exception("批量退款任务异常中止 - 任务: {}, 错误: {}", self.job_id, e)
+            status = JOB_PAUSED
+        if stopped.is_set():
+            logger.info("批量退款任务已暂停或被接管 - 任务: {}", self.job_id)
+        else:
+            stopped.set()
+            self.store.release(self.job_id, self.owner, status)
+        beat.join()
+        logger.info("批量退款任务结束 - 任务: {}, 进度: {}", self.job_id, payload(self.store.progress(self.job_id)))
+
+    def _heartbeat(self, stopped):
+        """定期更新心跳，任务被暂停或被接管时通知主循环在当前批次结束后退出"""
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            if not self.store.heartbeat(self.job_id, self.owner):
+                stopped.set()
+
+    def _process(self, limiter, seq, out_trade_no, amount, reason, out_refund_no, attempts):
+        if limiter is not None:
+            limiter.acquire(timeout=float("inf"))
+        try:
+            result = self.client.refund_order(out_trade_no, amount, reason, out_refund_no=out_refund_no)
+        except Exception as e:
+            logger.exception("批量退款条目异常 - 任务: {}, 退款单号: {}", self.job_id, out_refund_no)
+            result = {"message": str(e)}
+
+        if result.get("status"):
+            status = result["status"]
+        elif result.get("code") in RETRIABLE_CODES or not result.get("code"):
+            # attempts 为本次之前的尝试次数
+            status = ITEM_RETRY if attempts + 1 < MAX_ATTEMPTS else ITEM_FAILED
+        else:
+            status = ITEM_FAILED
+        self.store.record(self.job_id, seq, status, result)
+        if status == ITEM_RETRY:
+            time.sleep(min(2 ** attempts, 30) * 0.1)
+
+
+_store = None
+_store_lock = threading.Lock()
+_runners = {}
+_watcher = None
+
+
+def refund_job_store():
+    """获取全局批量退款任务存储，首次调用时打开数据库"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = RefundJobStore(os.getenv("REFUND_JOBS_PATH", DEFAULT_JOBS_PATH))
+    return _store
+
+
+def start_refund_job(job_id, client, retry_failed=False):
+    """在本进程启动或续跑任务，任务已由其他存活的执行者运行时返回 False
+
+    Args:
+        client: 任务所属商户的 WeChatPay 客户端
+        retry_failed (bool): 是否把失败的条目重新加入队列（使用原退款单号）
+    """
+    store = refund_job_store()
+    with _store_lock:
+        runner = _runners.get(job_id)
+        if runner is not None and runner.is_alive():
+            return False
+        runner = RefundJobRunner(store, job_id, client)
+        if not store.claim(job_id, runner.owner, retry_failed=retry_failed):
+            return False
+        _runners[job_id] = runner
+    runner.start()
+    return True
+
+
+def resume_interrupted_jobs(get_client):
+    """在本进程续跑心跳超时的任务，返回续跑的任务号
+
+    Args:
+        get_client: 按商户号返回 WeChatPay 客户端的函数
+    """
+    store = refund_job_store()
+    resumed = []
+    for job_id in store.interrupted_jobs():
+        if start_refund_job(job_id, get_client(store.job(job_id)["mch_id"])):
+            logger.info("续跑中断的批量退款任务: {}", job_id)
+            resumed.append(job_id)
+    return resumed
+
+
+def watch_interrupted_jobs(get_client, interval=HEARTBEAT_TIMEOUT):
+    """启动后台线程，立即并在之后每 interval 秒续跑一次中断的任务；每个进程只启动一次"""
+    global _watcher
+    with _store_lock:
+        if _watcher is not None:
+            return
+        _watcher = threading.Thread(
+            target=_watch, args=(get_client, interval), name="refund-job-watch", daemon=True
+        )
+        _watcher.start()
+
+
+def _watch(get_client, interval):
+    while True:
+        try:
+            resume_interrupted_jobs(get_client)
+        except Exception as e:
+            logger.exception("续跑中断的批量退款任务失败: {}", e)
+        time.sleep(interval)
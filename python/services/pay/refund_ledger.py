@@ -0,0 +1,272 @@
+"""部分退款台账
+
+按 out_trade_no 记录订单金额、已退金额和退款中(已预留)金额，可退余额 = 订单金额 - 已退 - 预留。
+
+- 申请退款前在同一个 SQLite 事务(BEGIN IMMEDIATE)中检查并预留可退余额，余额不足时不做签名和 HTTP 请求
+- 退款应答、退款查询和 REFUND.* 回调通知负责结算：SUCCESS 把预留转为已退，CLOSED 及明确失败的请求释放预留，
+  PROCESSING / ABNORMAL 以及网络异常、5XX 等结果未知的情况保持预留，等待查询或回调
+- 回调可能丢失，后台对账线程(RefundReconciler)每 REFUND_RECONCILE_INTERVAL 秒查询一批超过 REFUND_RECONCILE_AFTER 秒
+  仍未结算的退款单：查到退款状态时按状态结算，退款单不存在(404)说明申请未被受理，释放预留；
+  查询前先更新退款单的 updated_at，多个 worker 不会同时查询同一笔
+- 多个 worker 进程共享同一个数据库文件，路径由 REFUND_LEDGER_PATH 配置
+"""
+
+import os
+import threading
+import time
+
+from loguru import logger
+
+from services.sqlite_store import SQLiteStore
+
+DEFAULT_LEDGER_PATH = "data/refund_ledger.db"
+
+# 对账间隔(秒，0 表示不对账)、未结算多久后开始对账(秒)、每次对账的数量
+DEFAULT_RECONCILE_INTERVAL = 60
+DEFAULT_RECONCILE_AFTER = 300
+RECONCILE_BATCH = 50
+
+# 退款单状态
+RESERVED = "RESERVED"  # 已预留，请求结果未知
+PROCESSING = "PROCESSING"
+SUCCESS = "SUCCESS"
+CLOSED = "CLOSED"
+ABNORMAL = "ABNORMAL"
+FAILED = "FAILED"  # 请求被明确拒绝，未生成退款单
+
+# 已经结算、不再变化的状态
+SETTLED_STATES = {SUCCESS, CLOSED, FAILED}
+
+# 需要释放预留金额的状态
+RELEASED_STATES = {CLOSED, FAILED}
+
+
+class RefundLedger(SQLiteStore):
+    """退款台账，所有方法线程安全、进程安全"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS refund_orders ("
+        "out_trade_no TEXT PRIMARY KEY, total INTEGER NOT NULL, "
+        "refunded INTEGER NOT NULL DEFAULT 0, reserved INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS refunds ("
+        "out_refund_no TEXT PRIMARY KEY, out_trade_no TEXT NOT NULL, amount INTEGER NOT NULL, "
+        "status TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_refunds_trade ON refunds(out_trade_no)",
+    )
+
+    def order_total(self, out_trade_no):
+        row = self._conn().execute(
+            "SELECT total FROM refund_orders WHERE out_trade_no = ?", (out_trade_no,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def record_order(self, out_trade_no, total):
+        """记录订单金额，下单、支付成功回调或查单时调用"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO refund_orders (out_trade_no, total, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(out_trade_no) DO UPDATE SET total = excluded.total, updated_at = excluded.updated_at",
+                (out_trade_no, int(total), time.time()),
+            )
+
+    def balance(self, out_trade_no):
+        """返回 {total, refunded, reserved, refundable}，订单未记录时返回 None"""
+        row = self._conn().execute(
+            "SELECT total, refunded, reserved FROM refund_orders WHERE out_trade_no = ?", (out_trade_no,)
+        ).fetchone()
+        if row is None:
+            return None
+        total, refunded, reserved = row
+        return {"total": total, "refunded": refunded, "reserved": reserved, "refundable": total - refunded - reserved}
+
+    def reserve(self, out_trade_no, out_refund_no, amount):
+        """预留退款金额，返回 (是否成功, 预留后剩余可退金额)
+
+        使用已存在的 out_refund_no 重试时不重复预留
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT total, refunded, reserved FROM refund_orders WHERE out_trade_no = ?", (out_trade_no,)
+            ).fetchone()
+            if row is None:
+                return False, 0
+            total, refunded, reserved = row
+            available = total - refunded - reserved
+
+            existing = conn.execute(
+                "SELECT amount, status FROM refunds WHERE out_refund_no = ?", (out_refund_no,)
+            ).fetchone()
+            if existing is not None and existing[1] not in RELEASED_STATES:
+                return existing[0] == amount, available
+
+            if amount <= 0 or amount > available:
+                return False, available
+            conn.execute(
+                "UPDATE refund_orders SET reserved = reserved + ?, updated_at = ? WHERE out_trade_no = ?",
+                (amount, now, out_trade_no),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO refunds (out_refund_no, out_trade_no, amount, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (out_refund_no, out_trade_no, amount, RESERVED, now, now),
+            )
+            return True, available - amount
+
+    def settle(self, out_refund_no, status, out_trade_no=None, amount=None, total=None):
+        """按退款状态结算，重复调用是幂等的
+
+        台账中没有的退款单（例如在商户平台发起的退款）会按回调中的金额补记
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT out_trade_no, amount, status FROM refunds WHERE out_refund_no = ?", (out_refund_no,)
+            ).fetchone()
+            if row is None:
+                if out_trade_no is None or amount is None:
+                    return
+                if total is not None:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO refund_orders (out_trade_no, total, updated_at) VALUES (?, ?, ?)",
+                        (out_trade_no, int(total), now),
+                    )
+                conn.execute(
+                    "INSERT INTO refunds (out_refund_no, out_trade_no, amount, status, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (out_refund_no, out_trade_no, amount, RESERVED, now, now),
+                )
+                conn.execute(
+                    "UPDATE refund_orders SET reserved = reserved + ? WHERE out_trade_no = ?", (amount, out_trade_no)
+                )
+                row = (out_trade_no, amount, RESERVED)
+
+            out_trade_no, amount, current = row
+            if current in SETTLED_STATES or current == status:
+                return
+            if status == SUCCESS:
+                change = "reserved = reserved - ?, refunded = refunded + ?"
+                params = (amount, amount)
+            elif status in RELEASED_STATES:
+                change = "reserved = reserved - ?"
+                params = (amount,)
+            else:
+                change, params = None, ()
+            if change:
+                conn.execute(
+                    f"UPDATE refund_orders SET {change}, updated_at = ? WHERE out_trade_no = ?",
+                    (*params, now, out_trade_no),
+                )
+            conn.execute(
+                "UPDATE refunds SET status = ?, updated_at = ? WHERE out_refund_no = ?", (status, now, out_refund_no)
+            )
+        logger.info("退款台账结算 - 退款单号: {}, 状态: {} -> {}", out_refund_no, current, status)
+
+    def settle_response(self, out_refund_no, status_code, result):
+        """根据退款申请的应答结算：有退款状态时按状态结算，4XX(429除外)说明请求被拒绝、释放预留"""
+        if status_code is not None and 200 <= status_code < 300 and result.get("status"):
+            self.settle(out_refund_no, result["status"])
+        elif status_code is not None and 400 <= status_code < 500 and status_code != 429:
+            self.settle(out_refund_no, FAILED)
+        else:
+            logger.warning("退款结果未知，保持预留等待查询或回调 - 退款单号: {}", out_refund_no)
+
+    def pending_refunds(self, older_than=0, limit=100):
+        """超过 older_than 秒仍未结算的退款单，返回 [(out_refund_no, out_trade_no)]，用于定期查询补偿
+
+        返回前把这些退款单的 updated_at 更新为当前时间，其他进程在 older_than 秒内不会再取到
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT out_refund_no, out_trade_no FROM refunds WHERE status IN (?, ?, ?) AND updated_at < ? "
+                "ORDER BY updated_at LIMIT ?",
+                (RESERVED, PROCESSING, ABNORMAL, now - older_than, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE refunds SET updated_at = ? WHERE out_refund_no = ?", [(now, row[0]) for row in rows]
+            )
+        return rows
+
+
+class RefundReconciler:
+    """定期查询未结算的退款单并结算台账，后台线程由 start() 启动"""
+
+    def __init__(self, ledger, interval=None, older_than=None):
+        self.ledger = ledger
+        self.interval = (
+            float(os.getenv("REFUND_RECONCILE_INTERVAL", DEFAULT_RECONCILE_INTERVAL)) if interval is None else interval
+        )
+        self.older_than = (
+            float(os.getenv("REFUND_RECONCILE_AFTER", DEFAULT_RECONCILE_AFTER)) if older_than is None else older_than
+        )
+        self._thread = None
+        self._lock = threading.Lock()
+        self.checked = self.settled = self.errors = 0
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="refund-reconcile", daemon=True)
+            self._thread.start()
+        logger.info("退款对账已启动 - 间隔: {}秒, 未结算超过: {}秒", self.interval, self.older_than)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.exception("退款对账异常: {}", e)
+
+    def run_once(self):
+        """对账一批退款单，返回本批结算的数量"""
+        from services.pay.order_expiry import order_expiry
+        from services.pay.wechat_pay import get_wechat_pay
+
+        settled = 0
+        for out_refund_no, out_trade_no in self.ledger.pending_refunds(self.older_than, RECONCILE_BATCH):
+            self.checked += 1
+            try:
+                # 订单不是本服务创建时查不到商户号，使用默认商户
+                status = get_wechat_pay(order_expiry().store.mch_id(out_trade_no)).reconcile_refund(out_refund_no)
+            except Exception as e:
+                self.errors += 1
+                logger.warning("退款对账查询失败 - 退款单号: {}, 错误: {}", out_refund_no, e)
+                continue
+            if status in SETTLED_STATES:
+                settled += 1
+        self.settled += settled
+        return settled
+
+    def stats(self):
+        return {"checked": self.checked, "settled": self.settled, "errors": self.errors}
+
+
+_ledger = None
+_reconciler = None
+_ledger_lock = threading.Lock()
+
+
+def refund_ledger():
+    """获取全局退款台账，首次调用时打开数据库"""
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = RefundLedger(os.getenv("REFUND_LEDGER_PATH", DEFAULT_LEDGER_PATH))
+    return _ledger
+
+
+def refund_reconciler():
+    """获取全局退款对账器"""
+    global _reconciler
+    if _reconciler is None:
+        ledger = refund_ledger()
+        with _ledger_lock:
+            if _reconciler is None:
+                _reconciler = RefundReconciler(ledger)
+    return _reconciler
@@ -2,32 +2,34 @@ import json
 import time
 import random
 import string
-import hashlib
-import requests
-from datetime import datetime
-from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
-from Crypto.Hash import SHA256
-from base64 import b64decode, b64encode
-import os
-from dotenv import load_dotenv
+from base64 import b64encode
 from loguru import logger
-from Crypto.Cipher import AES
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from services.ids import new_out_refund_no, new_out_trade_no
+from services.log import payload
+from services.merchant import merchant_registry
+from services.notification import Notification
+from services.pay.constants import API_CONFIGS
+from services.pay.order_expiry import order_expiry, time_expire
+from services.pay.refund_ledger import FAILED, refund_ledger
 from services.wechat_pay_base import WeChatPayBase
-# 加载环境变量
-load_dotenv()
+
+
+def get_wechat_pay(mch_id=None):
+    """获取商户的 WeChatPay 实例，首次调用时才加载配置和密钥；不传商户号时使用默认商户"""
+    return merchant_registry().client(WeChatPay, mch_id)
+
 
 class WeChatPay(WeChatPayBase):
 
+    API_CONFIGS = API_CONFIGS
+
     def create_jsapi_order(self, openid, total_amount, description):
         """创建JSAPI支付订单"""
-        logger.info(f"开始创建JSAPI支付订单 - openid: {openid}, 金额: {total_amount}分")
-        url = "https://api.mch.weixin.qq.com/v3/pay/transactions/jsapi"
+        logger.info("开始创建JSAPI支付订单 - openid: {}, 金额: {}分", payload(openid), total_amount)
         
         # 生成商户订单号
-        out_trade_no = datetime.now().strftime('%Y%m%d%H%M%S') + str(random.randint(1000, 9999))
-        logger.info(f"生成商户订单号: {out_trade_no}")
+        out_trade_no = new_out_trade_no()
+        logger.info("生成商户订单号: {}", out_trade_no)
         
         body = {
             "appid": self.app_id,
@@ -43,34 +45,21 @@ class WeChatPay(WeChatPayBase):
                 "openid": openid
             }
         }
-        
-        body_str = json.dumps(body)
-        logger.debug(f"JSAPI支付请求参数: {body_str}")
-        
-        sign_data = self.generate_sign('POST', '/v3/pay/transactions/jsapi', body_str)
-        
-        # 构建认证头
-        token = (f'WECHATPAY2-SHA256-RSA2048 mchid="{self.mch_id}",'
-                f'serial_no="{self.serial_no}",'
-                f'nonce_str="{sign_data["nonce"]}",'
-                f'timestamp="{sign_data["timestamp"]}",'
-                f'signature="{sign_data["signature"]}"')
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': token
-        }
-        
-        logger.debug(f"发送JSAPI支付请求 - URL: {url}")
-        response = requests.post(url, data=body_str, headers=headers)
-        logger.info(f"JSAPI支付响应状态码: {response.status_code}")
-        logger.debug(f"JSAPI支付响应内容: {response.text}")
-        
-        return response.json()
+        created_at = self._set_time_expire(body)
+        logger.debug("JSAPI支付请求参数: {}", payload(body))
+        
+        status_code, result = self._call_api('create_jsapi_order', data=body)
+        logger.info("JSAPI支付响应状态码: {}", status_code)
+        if "prepay_id" in result:
+            refund_ledger().record_order(out_trade_no, total_amount)
+            result['expire_at'] = order_expiry().track(self.mch_id, out_trade_no, created_at)
+        return result
 
     def generate_js_config(self, prepay_id):
         """生成JSAPI调起支付所需的参数"""
+        from Crypto.Hash import SHA256
+        from Crypto.Signature import pkcs1_15
+
         timestamp = str(int(time.time()))
         nonce = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(32))
         
@@ -90,81 +79,64 @@ class WeChatPay(WeChatPayBase):
 
     def create_native_order(self, total_amount, description):
         """创建Native支付订单"""
-        logger.info(f"开始创建Native支付订单 - 金额: {total_amount}分")
-        url = "https://api.mch.weixin.qq.com/v3/pay/transactions/native"
+        logger.info("开始创建Native支付订单 - 金额: {}分", total_amount)
         
         # 生成商户订单号
-        out_trade_no = datetime.now().strftime('%Y%m%d%H%M%S') + str(random.randint(1000, 9999))
-        logger.info(f"生成商户订单号: {out_trade_no}")
+        out_trade_no = new_out_trade_no()
+        logger.info("生成商户订单号: {}", out_trade_no)
         
         body = {
             "appid": self.app_id,
             "mchid": self.mch_id,
             "description": description,
             "out_trade_no": out_trade_no,
-            "notify_url": os.getenv("NOTIFY_URL"),
+            "notify_url": self.notify_url,
             "amount": {
                 "total": total_amount,
                 "currency": "CNY"
             }
         }
-        
-        body_str = json.dumps(body)
-        logger.debug(f"Native支付请求参数: {body_str}")
-        
-        sign_data = self.generate_sign('POST', '/v3/pay/transactions/native', body_str)
-        
-        # 构建认证头
-        token = (f'WECHATPAY2-SHA256-RSA2048 mchid="{self.mch_id}",'
-                f'serial_no="{self.serial_no}",'
-                f'nonce_str="{sign_data["nonce"]}",'
-                f'timestamp="{sign_data["timestamp"]}",'
-                f'signature="{sign_data["signature"]}"')
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': token
-        }
-        
-        logger.debug(f"发送Native支付请求 - URL: {url}")
-        response = requests.post(url, data=body_str, headers=headers)
-        logger.info(f"Native支付响应状态码: {response.status_code}")
-        logger.debug(f"Native支付响应内容: {response.text}")
-        response_json = response.json()
-        response_json['out_trade_no'] = out_trade_no
-        return response_json
+        created_at = self._set_time_expire(body)
+        logger.debug("Native支付请求参数: {}", payload(body))
+        
+        status_code, result = self._call_api('create_native_order', data=body)
+        logger.info("Native支付响应状态码: {}", status_code)
+        if "code_url" in result:
+            refund_ledger().record_order(out_trade_no, total_amount)
+            result['expire_at'] = order_expiry().track(self.mch_id, out_trade_no, created_at)
+        result['out_trade_no'] = out_trade_no
+        return result
 
     def query_order_status(self, out_trade_no):
         """查询订单状态"""
-        logger.info(f"开始查询订单状态 - 商户订单号: {out_trade_no}")
-        
-        # 构建请求URL,注意URL编码
-        url_path = f"/v3/pay/transactions/out-trade-no/{out_trade_no}?mchid={self.mch_id}"
-        url = f"https://api.mch.weixin.qq.com{url_path}"
-        
-        # 生成签名,注意这里不要对URL进行编码
-        sign_data = self.generate_sign('GET', url_path, '')
-        
-        # 构建认证头,注意各个字段之间不能有空格
-        token = (f'WECHATPAY2-SHA256-RSA2048 mchid="{self.mch_id}",'
-                f'serial_no="{self.serial_no}",'
-                f'nonce_str="{sign_data["nonce"]}",'
-                f'timestamp="{sign_data["timestamp"]}",'
-                f'signature="{sign_data["signature"]}"')
-        
-        headers = {
-            'Accept': 'application/json',
-            'Authorization': token,
-        }
-        
-        logger.debug(f"发送订单查询请求 - URL: {url}")
-        logger.debug(f"请求头: {headers}")
-        
-        response = requests.get(url, headers=headers)
-        logger.info(f"订单查询响应状态码: {response.status_code}")
-        logger.debug(f"订单查询响应内容: {response.text}")
-        return response.json()
+        logger.info("开始查询订单状态 - 商户订单号: {}", out_trade_no)
+        
+        # 签名时不要对URL进行编码
+        status_code, result = self._call_api('query_order', out_trade_no=out_trade_no, mchid=self.mch_id)
+        logger.info("订单查询响应状态码: {}", status_code)
+        if result.get("trade_state"):
+            order_expiry().finish(self.mch_id, out_trade_no, result["trade_state"])
+        return result
+
+    def close_order(self, out_trade_no):
+        """关闭未支付的订单，关单成功(应答 204 无包体)时返回 trade_state 为 CLOSED 的结果"""
+        logger.info("开始关闭订单 - 商户订单号: {}", out_trade_no)
+        status_code, result = self._call_api(
+            'close_order', data={"mchid": self.mch_id}, out_trade_no=out_trade_no
+        )
+        logger.info("关闭订单响应状态码: {}", status_code)
+        if status_code == 204:
+            order_expiry().finish(self.mch_id, out_trade_no, "CLOSED")
+            return {"out_trade_no": out_trade_no, "trade_state": "CLOSED"}
+        return result
+
+    def _set_time_expire(self, body):
+        """按订单有效期设置下单参数 time_expire，返回下单时间"""
+        created_at = time.time()
+        ttl = order_expiry().ttl
+        if ttl > 0:
+            body["time_expire"] = time_expire(created_at, ttl)
+        return created_at
 
     def test_native_pay(self):
         """测试Native支付功能"""
@@ -208,107 +180,89 @@ class WeChatPay(WeChatPayBase):
         except Exception as e:
             print(f"测试过程发生错误: {str(e)}")
 
-    def refund_order(self, out_trade_no, amount, reason=""):
-        """申请退款"""
-        logger.info(f"开始处理退款请求 - 商户订单号: {out_trade_no}, 金额: {amount}分")
-        url = "https://api.mch.weixin.qq.com/v3/refund/domestic/refunds"
-        
-        # 生成退款单号
-        out_refund_no = datetime.now().strftime('R%Y%m%d%H%M%S') + str(random.randint(1000, 9999))
-        
+    def refund_order(self, out_trade_no, amount, reason="", out_refund_no=None):
+        """申请退款，先在退款台账中预留可退余额，余额不足时不发起请求
+
+        Args:
+            out_refund_no (str, optional): 重试时传入原退款单号，不会重复预留
+        """
+        logger.info("开始处理退款请求 - 商户订单号: {}, 金额: {}分", out_trade_no, amount)
+        ledger = refund_ledger()
+
+        # 台账中没有订单金额时（例如订单不是本服务创建的）先查单获取
+        total = ledger.order_total(out_trade_no)
+        if total is None:
+            order = self.query_order_status(out_trade_no)
+            total = (order.get("amount") or {}).get("total")
+            if total is None:
+                logger.error("无法获取订单金额 - 商户订单号: {}, 查单结果: {}", out_trade_no, payload(order))
+                return {"code": order.get("code", "ORDER_NOT_FOUND"), "message": order.get("message", "无法获取订单金额")}
+            ledger.record_order(out_trade_no, total)
+
+        # 生成退款单号，并预留可退余额
+        out_refund_no = out_refund_no or new_out_refund_no()
+        reserved, available = ledger.reserve(out_trade_no, out_refund_no, amount)
+        if not reserved:
+            logger.warning("可退余额不足 - 商户订单号: {}, 申请: {}分, 可退: {}分", out_trade_no, amount, available)
+            return {"code": "REFUND_AMOUNT_EXCEEDED", "message": f"可退余额不足，剩余可退 {available} 分"}
+
         body = {
             "out_trade_no": out_trade_no,
             "out_refund_no": out_refund_no,
             "reason": reason,
-            "notify_url": os.getenv("NOTIFY_URL"),
+            "notify_url": self.notify_url,
             "amount": {
                 "refund": amount,
-                "total": amount,
+                "total": total,
                 "currency": "CNY"
             }
         }
+        logger.debug("退款请求参数: {}", payload(body))
         
-        body_str = json.dumps(body)
-        logger.debug(f"退款请求参数: {body_str}")
-        
-        sign_data = self.generate_sign('POST', '/v3/refund/domestic/refunds', body_str)
-        
-        # 构建认证头
-        token = (f'WECHATPAY2-SHA256-RSA2048 mchid="{self.mch_id}",'
-                f'serial_no="{self.serial_no}",'
-                f'nonce_str="{sign_data["nonce"]}",'
-                f'timestamp="{sign_data["timestamp"]}",'
-                f'signature="{sign_data["signature"]}"')
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': token
-        }
-        
-        logger.debug(f"发送退款请求 - URL: {url}")
-        response = requests.post(url, data=body_str, headers=headers)
-        logger.info(f"退款响应状态码: {response.status_code}")
-        logger.debug(f"退款响应内容: {response.text}")
-        
-        return response.json()
+        status_code, result = self._call_api('refund', data=body)
+        logger.info("退款响应状态码: {}", status_code)
+        ledger.settle_response(out_refund_no, status_code, result)
+        return result
+
+    def query_refund(self, out_refund_no):
+        """查询单笔退款，并按退款状态结算台账"""
+        logger.info("开始查询退款 - 退款单号: {}", out_refund_no)
+        status_code, result = self._call_api('query_refund', out_refund_no=out_refund_no)
+        if status_code == 200 and result.get("status"):
+            self._settle_refund(out_refund_no, result)
+        return result
+
+    def reconcile_refund(self, out_refund_no):
+        """对账: 查询台账中未结算的退款单并结算，返回结算后的状态，查询失败时返回 None
+
+        只用于超过一段时间仍未结算的退款单，此时退款单不存在说明申请没有被受理，释放预留
+        """
+        status_code, result = self._call_api('query_refund', out_refund_no=out_refund_no)
+        if status_code == 200 and result.get("status"):
+            self._settle_refund(out_refund_no, result)
+            return result["status"]
+        if status_code == 404:
+            logger.warning("退款单不存在，释放预留 - 退款单号: {}", out_refund_no)
+            refund_ledger().settle(out_refund_no, FAILED)
+            return FAILED
+        logger.warning("退款对账查询失败 - 退款单号: {}, 状态码: {}, 应答: {}", out_refund_no, status_code, payload(result))
+        return None
+
+    def _settle_refund(self, out_refund_no, result):
+        refund_ledger().settle(
+            out_refund_no,
+            result["status"],
+            out_trade_no=result.get("out_trade_no"),
+            amount=(result.get("amount") or {}).get("refund"),
+            total=(result.get("amount") or {}).get("total"),
+        )
 
     def verify_notify_sign(self, headers, body):
         """验证回调通知签名"""
-        timestamp = headers.get('Wechatpay-Timestamp')
-        nonce = headers.get('Wechatpay-Nonce')
-        signature = headers.get('Wechatpay-Signature')
-        serial_no = headers.get('Wechatpay-Serial')
-        body_str = body.decode('utf-8')
-        logger.info(f"收到回调通知头部信息: timestamp={timestamp}, nonce={nonce}, "
-                    f"signature={signature}, serial_no={serial_no}")     
-        
-        if not all([timestamp, nonce, signature, serial_no]):
-            logger.error("回调通知缺少必要的头部信息")
-            return False
-   
-        # 构造验签名串
-        message = f"{timestamp}\n{nonce}\n{body_str}\n"
-        logger.debug(f"验签名串: {message}")
-        
-        try:
-            # 从证书管理器获取微信支付平台证书
-            wechatpay_cert_path = os.getenv("WECHAT_PAY_PLAT_CERT_PATH")
-            with open(wechatpay_cert_path) as f:  # 需要下载微信支付平台证书
-                cert = RSA.import_key(f.read())
-            # 验证签名
-            message_hash = SHA256.new(message.encode('utf-8'))
-            signature_bytes = b64decode(signature)
-            pkcs1_15.new(cert).verify(message_hash, signature_bytes)
-            logger.info("签名验证成功")
-            return True
-        except Exception as e:
-            logger.error(f"验证签名失败: {str(e)}")
-            return False
+        return self.verify_notification(Notification(headers, body))
 
     def decrypt_notify_data(self, body):
         """解密回调通知数据"""
-        try:
-            data = json.loads(body)
-            resource = data.get('resource', {})
-            nonce = resource.get('nonce')
-            ciphertext = resource.get('ciphertext')
-            associated_data = resource.get('associated_data')
-
-            # Base64解码密文
-            ciphertext_bytes = b64decode(ciphertext)
-            
-            # 使用AEAD_AES_256_GCM算法解密
-            key_bytes = self.api_v3_key.encode('utf-8')
-            nonce_bytes = nonce.encode('utf-8')
-            ad_bytes = associated_data.encode('utf-8') if associated_data else b''
-            
-            aesgcm = AESGCM(key_bytes)
-            decrypted_data = aesgcm.decrypt(nonce_bytes, ciphertext_bytes, ad_bytes)
-            
-            return json.loads(decrypted_data)
-        except Exception as e:
-            logger.error(f"解密回调数据失败: {str(e)}")
-            return None
+        return self.decrypt_notification(Notification({}, body))
 
 
@@ -0,0 +1,226 @@
+"""转账、支付的实时汇总
+
+按 类型(转账/支付) × 状态 × 转账场景 统计笔数和金额，分为累计值和按小时的环形时间桶，供 /stats 直接读取:
+
+- 计数器是 mmap 文件(ROLLUP_PATH)中的 int64 数组，同一台机器的 worker 共享，读取的开销只与桶数有关
+- 状态变化（TransferBase.handle_transfer_state、支付/退款通知）先写入事件表(ROLLUP_EVENTS_PATH)，
+  同一单号的同一状态只计一次，重复查询、重复通知不会重复累加
+- 事件表即历史记录，``python -m tools.rebuild_rollups`` 可据此重建计数器，并可从订单、退款、发件箱记录补录历史；
+  计数器文件丢失或布局变化时也会自动重建
+- 时间桶保留最近 ROLLUP_HOURS 小时，更早的事件只计入累计值
+"""
+
+import datetime
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from loguru import logger
+
+from services.mapped_file import HEADER_SIZE, MappedFile
+from services.sqlite_store import SQLiteStore
+from services.transfer.constants import STATE_MAP, TRANSFER_SCENES
+
+MAGIC = b"WXRU"
+VERSION = 1
+
+DEFAULT_ROLLUP_PATH = "data/rollups.bin"
+DEFAULT_EVENTS_PATH = "data/rollups.db"
+
+# 默认保留的小时桶数
+DEFAULT_HOURS = 72
+
+# 类型
+TRANSFER = "transfer"
+PAYMENT = "payment"
+KINDS = (TRANSFER, PAYMENT)
+
+# 状态维度: 转账状态、交易状态，其余状态计入 OTHER
+TRADE_STATES = ("SUCCESS", "REFUND", "NOTPAY", "CLOSED", "REVOKED", "USERPAYING", "PAYERROR")
+OTHER = "OTHER"
+STATES = tuple(dict.fromkeys((*STATE_MAP, *TRADE_STATES, OTHER)))
+
+# 场景维度: 转账场景名称，支付及未知场景为空字符串
+SCENES = (*TRANSFER_SCENES, "")
+SCENE_BY_ID = {scene["transfer_scene_id"]: name for name, scene in TRANSFER_SCENES.items()}
+
+# 每个桶的单元格数，每个单元格两个计数器: 笔数、金额(分)
+CELLS = len(KINDS) * len(STATES) * len(SCENES)
+BLOCK = CELLS * 2
+
+# 本进程记住的已计数 (类型, 单号) -> 状态，避免重复查询时每次都访问事件表
+SEEN_SIZE = 10000
+
+_KIND_INDEX = {kind: i for i, kind in enumerate(KINDS)}
+_STATE_INDEX = {state: i for i, state in enumerate(STATES)}
+_SCENE_INDEX = {scene: i for i, scene in enumerate(SCENES)}
+
+
+def _cell(kind, state, scene):
+    state_index = _STATE_INDEX.get(state, _STATE_INDEX[OTHER])
+    scene_index = _SCENE_INDEX.get(scene or "", _SCENE_INDEX[""])
+    return ((_KIND_INDEX[kind] * len(STATES) + state_index) * len(SCENES) + scene_index) * 2
+
+
+def scene_of(transfer_scene_id):
+    """转账场景 ID 对应的场景名称，未配置的场景返回空字符串"""
+    return SCENE_BY_ID.get(transfer_scene_id, "")
+
+
+class RollupEvents(SQLiteStore):
+    """状态变化事件，(类型, 单号, 状态) 唯一"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS rollup_events ("
+        "kind TEXT NOT NULL, ref TEXT NOT NULL, state TEXT NOT NULL, scene TEXT NOT NULL DEFAULT '', "
+        "amount INTEGER NOT NULL DEFAULT 0, ts REAL NOT NULL, PRIMARY KEY (kind, ref, state))",
+    )
+
+    def insert(self, kind, ref, state, scene, amount, ts):
+        """写入事件，已存在时返回 False"""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO rollup_events (kind, ref, state, scene, amount, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, ref, state, scene, amount, ts),
+            )
+        return cursor.rowcount > 0
+
+    def iter_events(self):
+        return self._conn().execute("SELECT kind, state, scene, amount, ts FROM rollup_events")
+
+
+class Rollups:
+    """mmap 计数器
+
+    布局(int64): 文件头 | 各小时桶对应的小时序号 [hours] | 累计值 [BLOCK] | 小时桶 [hours × BLOCK]
+    """
+
+    def __init__(self, path, events, hours=DEFAULT_HOURS):
+        self.events = events
+        self.hours = hours
+        layout = zlib.crc32(repr((KINDS, STATES, SCENES, hours)).encode("utf-8"))
+        self._file = MappedFile(path, MAGIC, VERSION, layout, (hours + BLOCK * (hours + 1)) * 8)
+        self._counters = memoryview(self._file.mm)[HEADER_SIZE:].cast("q")
+        self._totals = hours
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+        self.recorded = self.duplicates = 0
+        if self._file.created:
+            self.rebuild()
+
+    def _bucket(self, hour):
+        return self.hours + BLOCK * (1 + hour % self.hours)
+
+    def _add(self, kind, state, scene, amount, ts):
+        """累加一个事件（调用方持有写锁）"""
+        counters = self._counters
+        cell = _cell(kind, state, scene)
+        counters[self._totals + cell] += 1
+        counters[self._totals + cell + 1] += amount
+
+        hour = int(ts // 3600)
+        slot = hour % self.hours
+        if counters[slot] > hour:
+            # 超出保留范围的事件只计入累计值
+            return
+        base = self._bucket(hour)
+        if counters[slot] != hour:
+            counters[base : base + BLOCK] = memoryview(bytes(BLOCK * 8)).cast("q")
+            counters[slot] = hour
+        counters[base + cell] += 1
+        counters[base + cell + 1] += amount
+
+    def record(self, kind, ref, state, amount=None, scene=None, ts=None):
+        """记录状态变化，同一单号的同一状态只计一次；统计失败不影响业务处理"""
+        if not ref or not state:
+            return
+        with self._seen_lock:
+            if self._seen.get((kind, ref)) == state:
+                self.duplicates += 1
+                return
+        ts = ts or time.time()
+        try:
+            with self._file.locked():
+                inserted = self.events.insert(kind, ref, state, scene or "", amount or 0, ts)
+                if inserted:
+                    self._add(kind, state, scene, amount or 0, ts)
+        except Exception as e:
+            logger.exception("记录汇总统计失败 - 单号: {}, 状态: {}, 错误: {}", ref, state, e)
+            return
+        with self._seen_lock:
+            self._seen[(kind, ref)] = state
+            self._seen.move_to_end((kind, ref))
+            if len(self._seen) > SEEN_SIZE:
+                self._seen.popitem(last=False)
+        if inserted:
+            self.recorded += 1
+        else:
+            self.duplicates += 1
+
+    def rebuild(self):
+        """按事件表重新计算全部计数器，返回事件数"""
+        count = 0
+        with self._file.locked():
+            self._counters[:] = memoryview(bytes(len(self._counters) * 8)).cast("q")
+            for kind, state, scene, amount, ts in self.events.iter_events():
+                if kind in _KIND_INDEX:
+                    self._add(kind, state, scene, amount, ts)
+                    count += 1
+        logger.info("汇总统计已重建 - 事件数: {}", count)
+        return count
+
+    def _block(self, base):
+        """把一个桶转换为 {类型: {状态: {count, amount}}} 和 {场景: {状态: {count, amount}}}，省略为 0 的项"""
+        counters = self._counters
+        by_kind, by_scene = {}, {}
+        for kind in KINDS:
+            for state in STATES:
+                for scene in SCENES:
+                    cell = base + _cell(kind, state, scene)
+                    count = counters[cell]
+                    if not count:
+                        continue
+                    amount = counters[cell + 1]
+                    total = by_kind.setdefault(kind, {}).setdefault(state, {"count": 0, "amount": 0})
+                    total["count"] += count
+                    total["amount"] += amount
+                    if kind == TRANSFER:
+                        by_scene.setdefault(scene, {})[state] = {"count": count, "amount": amount}
+        return by_kind, by_scene
+
+    def snapshot(self, hours=24):
+        """累计值、按场景的转账累计值，以及最近 hours 小时的逐小时统计"""
+        totals, by_scene = self._block(self._totals)
+        current = int(time.time() // 3600)
+        hourly = []
+        for hour in range(current - min(hours, self.hours) + 1, current + 1):
+            if self._counters[hour % self.hours] != hour:
+                continue
+            by_kind, _ = self._block(self._bucket(hour))
+            if by_kind:
+                start = datetime.datetime.fromtimestamp(hour * 3600).astimezone()
+                hourly.append({"hour": start.isoformat(timespec="seconds"), **by_kind})
+        return {"totals": totals, "by_scene": by_scene, "hourly": hourly}
+
+    def stats(self):
+        return {"recorded": self.recorded, "duplicates": self.duplicates}
+
+
+_rollups = None
+_rollups_lock = threading.Lock()
+
+
+def rollups():
+    """获取全局汇总统计，首次调用时映射计数器文件并打开事件表"""
+    global _rollups
+    if _rollups is None:
+        with _rollups_lock:
+            if _rollups is None:
+                _rollups = Rollups(
+                    os.getenv("ROLLUP_PATH", DEFAULT_ROLLUP_PATH),
+                    RollupEvents(os.getenv("ROLLUP_EVENTS_PATH", DEFAULT_EVENTS_PATH)),
+                    int(os.getenv("ROLLUP_HOURS", DEFAULT_HOURS)),
+                )
+    return _rollups
@@ -0,0 +1,343 @@
+"""会话存储后端
+
+Flask-Session 的 filesystem 后端每个会话一个文件，高并发下目录膨胀、文件锁竞争严重，
+过期文件也只能被动清理。这里基于 cachelib 接口提供两种可替换的后端，
+通过 Flask-Session 的 ``SESSION_TYPE = "cachelib"`` 接入：
+
+- memory: 进程内 LRU + TTL 缓存，适合单进程/单 worker 部署
+- sqlite: SQLite(WAL + mmap) 共享存储，多个 worker 共享同一个数据库文件
+- filesystem: 与 Flask-Session 原有的文件存储相同（cachelib FileSystemCache，每个会话一个文件），增加统计
+
+通过环境变量 ``SESSION_BACKEND`` 选择后端，每个后端都可以通过 ``stats()`` 获取命中率和淘汰统计。
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from cachelib import BaseCache, FileSystemCache
+from loguru import logger
+
+# 默认会话有效期(秒)，与 Flask 的 PERMANENT_SESSION_LIFETIME 默认值一致
+DEFAULT_SESSION_TIMEOUT = 31 * 24 * 3600
+
+# 默认最多保存的会话数量
+DEFAULT_MAX_ENTRIES = 10000
+
+# filesystem 后端的默认目录与文件数上限，与 Flask-Session 的 SESSION_FILE_DIR / SESSION_FILE_THRESHOLD 默认值一致
+DEFAULT_FILE_DIR = "flask_session"
+DEFAULT_FILE_THRESHOLD = 500
+
+
+class _StatsMixin:
+    """会话缓存统计"""
+
+    backend = "unknown"
+
+    def _init_stats(self):
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expired = 0
+
+    def stats(self):
+        """返回缓存统计信息"""
+        lookups = self._hits + self._misses
+        return {
+            "size": self._size(),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "expired": self._expired,
+            "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class LRUTTLCache(_StatsMixin, BaseCache):
+    """进程内 LRU + TTL 会话缓存
+
+    - 读取时惰性检查过期时间，命中后移动到队尾
+    - 写入超过 max_entries 时淘汰最久未使用的会话
+    """
+
+    backend = "memory"
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, default_timeout=DEFAULT_SESSION_TIMEOUT):
+        super().__init__(default_timeout=default_timeout)
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._init_stats()
+
+    def _expires_at(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.monotonic() + timeout if timeout > 0 else None
+
+    def _size(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._misses += 1
+                return None
+            expires_at, value = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self._expired += 1
+                self._misses += 1
+                return None
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires_at = self._expires_at(timeout)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._evictions += 1
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[0] is None or item[0] > time.monotonic()):
+                return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def has(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and (item[0] is None or item[0] > time.monotonic())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+
+class SQLiteCache(_StatsMixin, BaseCache):
+    """基于 SQLite 的共享会话缓存
+
+    - 使用 WAL 模式和 mmap，多个 worker 进程可以并发读取同一个数据库文件
+    - 每个线程持有独立连接，避免跨线程共享连接
+    - 超过 max_entries 时按过期时间淘汰最早过期的会话（每次请求都会刷新过期时间，近似 LRU）
+    - 读取不产生写操作，过期数据每 purge_interval 次写入批量清理一次
+    """
+
+    backend = "sqlite"
+
+    def __init__(
+        self,
+        path="flask_session.db",
+        max_entries=DEFAULT_MAX_ENTRIES,
+        default_timeout=DEFAULT_SESSION_TIMEOUT,
+        mmap_size=64 * 1024 * 1024,
+        purge_interval=100,
+    ):
+        super().__init__(default_timeout=default_timeout)
+        self.path = path
+        self.max_entries = max_entries
+        self.mmap_size = mmap_size
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._init_stats()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+            self._local.conn = conn
+        return conn
+
+    def _expires_at(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        # 0 表示永不过期，用一个足够大的时间戳表示
+        return time.time() + timeout if timeout > 0 else float(2**62)
+
+    def _size(self):
+        return self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value, expires_at FROM sessions WHERE key = ?", (key,)
+        ).fetchone()
+        with self._lock:
+            if row is None:
+                self._misses += 1
+                return None
+            if row[1] <= time.time():
+                self._expired += 1
+                self._misses += 1
+                return None
+            self._hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key, value, timeout=None):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expires_at(timeout)),
+        )
+        with self._lock:
+            self._writes += 1
+            should_purge = self._writes % self.purge_interval == 0
+        if should_purge:
+            self._purge(conn)
+        return True
+
+    def _purge(self, conn):
+        """清理过期会话，并在超出容量时淘汰最早过期的会话"""
+        expired = conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+        overflow = self._size() - self.max_entries
+        evicted = 0
+        if overflow > 0:
+            evicted = conn.execute(
+                "DELETE FROM sessions WHERE key IN "
+                "(SELECT key FROM sessions ORDER BY expires_at LIMIT ?)",
+                (overflow,),
+            ).rowcount
+        with self._lock:
+            self._expired += expired
+            self._evictions += evicted
+        if expired or evicted:
+            logger.debug("清理会话存储: 过期 {} 条, 淘汰 {} 条", expired, evicted)
+
+    def add(self, key, value, timeout=None):
+        cursor = self._conn().execute(
+            "INSERT INTO sessions (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+            "WHERE sessions.expires_at <= ?",
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expires_at(timeout), time.time()),
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, key):
+        return self._conn().execute("DELETE FROM sessions WHERE key = ?", (key,)).rowcount > 0
+
+    def has(self, key):
+        row = self._conn().execute(
+            "SELECT 1 FROM sessions WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row is not None
+
+    def clear(self):
+        self._conn().execute("DELETE FROM sessions")
+        return True
+
+
+class FileSystemSessionCache(_StatsMixin, FileSystemCache):
+    """Flask-Session 原有的文件存储（每个会话一个文件），增加命中率与淘汰统计
+
+    文件数超过 max_entries 时 cachelib 先删除过期文件，仍超出时按过期时间删除最早的，分别计入 expired / evictions。
+    """
+
+    backend = "filesystem"
+
+    def __init__(
+        self,
+        cache_dir=DEFAULT_FILE_DIR,
+        max_entries=DEFAULT_FILE_THRESHOLD,
+        default_timeout=DEFAULT_SESSION_TIMEOUT,
+        mode=0o600,
+    ):
+        super().__init__(cache_dir, threshold=max_entries, default_timeout=default_timeout, mode=mode)
+        self._lock = threading.Lock()
+        self._init_stats()
+
+    def _size(self):
+        return sum(1 for _ in self._list_dir())
+
+    def get(self, key):
+        value = super().get(key)
+        if key == self._fs_count_file:
+            # cachelib 的文件计数也保存在缓存中，不计入统计
+            return value
+        with self._lock:
+            if value is not None:
+                self._hits += 1
+                return value
+            self._misses += 1
+        # 文件仍在说明会话已过期，过期文件在超出文件数上限时才会被删除
+        if os.path.exists(self._get_filename(key)):
+            with self._lock:
+                self._expired += 1
+        return None
+
+    def _prune(self):
+        if not self._over_threshold():
+            return
+        before = self._file_count
+        self._remove_expired(time.time())
+        after_expired = self._file_count
+        if self._over_threshold():
+            self._remove_older()
+        after = self._file_count
+        with self._lock:
+            self._expired += before - after_expired
+            self._evictions += after_expired - after
+
+
+def create_session_cache(backend, **options):
+    """根据后端名称创建会话缓存实例"""
+    match backend:
+        case "memory":
+            return LRUTTLCache(**options)
+        case "sqlite":
+            return SQLiteCache(**options)
+        case "filesystem":
+            return FileSystemSessionCache(**options)
+        case _:
+            raise ValueError(f"不支持的会话存储后端: {backend}")
+
+
+def configure_session(app):
+    """按环境变量配置 Flask-Session，需在 Session(app) 之前调用
+
+    环境变量:
+    - SESSION_BACKEND: memory | sqlite | filesystem，默认 filesystem
+    - SESSION_MAX_ENTRIES: 最多保存的会话数量，filesystem 后端默认 500，其他后端默认 10000
+    - SESSION_SQLITE_PATH: sqlite 后端的数据库文件路径
+    - SESSION_FILE_DIR: filesystem 后端的目录
+    """
+    backend = os.getenv("SESSION_BACKEND", "filesystem").lower()
+    options = {}
+    if backend == "filesystem":
+        options["cache_dir"] = os.getenv("SESSION_FILE_DIR", DEFAULT_FILE_DIR)
+        options["max_entries"] = int(os.getenv("SESSION_MAX_ENTRIES", DEFAULT_FILE_THRESHOLD))
+    else:
+        options["max_entries"] = int(os.getenv("SESSION_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+    if backend == "sqlite":
+        options["path"] = os.getenv("SESSION_SQLITE_PATH", "flask_session/sessions.db")
+
+    cache = create_session_cache(backend, **options)
+    app.config["SESSION_TYPE"] = "cachelib"
+    app.config["SESSION_CACHELIB"] = cache
+    app.extensions["session_store"] = cache
+    logger.info("会话存储后端: {}", backend)
+    return cache
@@ -0,0 +1,206 @@
+"""同一台机器上各 worker 共享的订单/转账单状态表
+
+基于 mmap 的定长哈希表，商户号 + 商户单号(out_trade_no / out_bill_no) -> (状态, 更新时间)。
+商户单号只在同一商户内唯一，键由 state_key(mch_id, 单号) 生成；包含非 ASCII 字符的键不缓存，读写时直接忽略:
+
+- 文件默认放在 /dev/shm（SHARED_STATE_PATH），所有 worker 映射同一个文件，内存占用固定
+- 组相联结构: 单号的 CRC32 决定所在的桶，每个桶 WAYS 个槽位；桶满时按 CLOCK 算法淘汰最近未被访问的槽位
+- 写入方（支付回调、关单/查单对账）之间用 flock 互斥；读取不加锁，每个槽位带一个序号(seqlock)，
+  写入前后各加一，读到奇数或前后不一致时重读
+- 读取时设置槽位的访问位，供 CLOCK 淘汰参考
+
+槽位布局(88 字节): seq(u32) | 访问位(u8) | 键长度(u8) | 状态长度(u8) | 保留(u8) | 更新时间(f64) | 键(48s) | 状态(24s)
+"""
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+from services.mapped_file import HEADER_SIZE, MappedFile
+
+MAGIC = b"WXST"
+VERSION = 2
+
+# 默认槽位数，每个槽位 88 字节，65536 个槽位约 5.5MB
+DEFAULT_SLOTS = 65536
+
+# 每个桶的槽位数
+WAYS = 8
+
+SLOT = struct.Struct("<IBBBxd48s24s")
+
+# 键(商户号:单号)和状态的最大长度
+MAX_KEY = 48
+MAX_STATE = 24
+SEQ = struct.Struct("<I")
+
+# 槽位内各字段的偏移
+_REF_OFFSET = 4
+
+# 读取遇到并发写入时的最大重试次数
+MAX_READ_RETRIES = 16
+
+# 中间状态(未支付、转账中等)的有效期(秒)，超过后仍查询微信支付；最终状态一直有效
+DEFAULT_MAX_AGE = 2.0
+
+
+def max_age():
+    return float(os.getenv("SHARED_STATE_MAX_AGE", DEFAULT_MAX_AGE))
+
+
+def state_key(mch_id, out_no):
+    """共享状态表的键: 商户号:商户单号"""
+    return f"{mch_id or ''}:{out_no}"
+
+
+def _encode(key):
+    """键的字节串，包含非 ASCII 字符或超长时返回 None"""
+    try:
+        key_bytes = key.encode("ascii")
+    except UnicodeEncodeError:
+        return None
+    return key_bytes if len(key_bytes) <= MAX_KEY else None
+
+
+def _default_path():
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else "data"
+    return os.path.join(directory, "wxpay_shared_state.bin")
+
+
+class SharedStateTable:
+    """mmap 共享状态表，读线程安全且不加锁，写入跨进程互斥"""
+
+    def __init__(self, path, slots=DEFAULT_SLOTS):
+        self.path = path
+        self.slots = max(slots // WAYS, 1) * WAYS
+        self.buckets = self.slots // WAYS
+        # 每个桶一个字节的 CLOCK 指针，放在文件头之后
+        self._slots_offset = HEADER_SIZE + self.buckets
+        self._file = MappedFile(path, MAGIC, VERSION, self.slots, self.buckets + self.slots * SLOT.size)
+        self._mm = self._file.mm
+        self.hits = self.misses = self.evictions = self.writes = 0
+
+    def _bucket(self, key_bytes):
+        return zlib.crc32(key_bytes) % self.buckets
+
+    def _offset(self, bucket, way):
+        return self._slots_offset + (bucket * WAYS + way) * SLOT.size
+
+    def _read_slot(self, offset):
+        """一致地读取一个槽位，返回 (访问位, 键, 状态, 更新时间)，重试次数用尽时返回 None"""
+        mm = self._mm
+        for _ in range(MAX_READ_RETRIES):
+            seq, ref, key_len, state_len, updated_at, key, state = SLOT.unpack_from(mm, offset)
+            if seq & 1 or SEQ.unpack_from(mm, offset)[0] != seq:
+                continue
+            return ref, key[:key_len], state[:state_len], updated_at
+        return None
+
+    def get(self, key):
+        """返回 (状态, 更新时间)，不存在或键不能缓存时返回 None"""
+        key_bytes = _encode(key)
+        if key_bytes is None:
+            self.misses += 1
+            return None
+        bucket = self._bucket(key_bytes)
+        for way in range(WAYS):
+            offset = self._offset(bucket, way)
+            slot = self._read_slot(offset)
+            if slot is not None and slot[1] == key_bytes:
+                if not slot[0]:
+                    self._mm[offset + _REF_OFFSET] = 1
+                self.hits += 1
+                return slot[2].decode("ascii"), slot[3]
+        self.misses += 1
+        return None
+
+    def put(self, key, state, updated_at=None):
+        """写入或更新状态；键或状态超长、包含非 ASCII 字符时忽略"""
+        key_bytes = _encode(key)
+        state_bytes = state.encode("ascii", "replace")
+        if key_bytes is None or len(state_bytes) > MAX_STATE:
+            return
+        bucket = self._bucket(key_bytes)
+        with self._file.locked():
+            offset = self._find_slot(bucket, key_bytes)
+            mm = self._mm
+            seq = SEQ.unpack_from(mm, offset)[0]
+            SEQ.pack_into(mm, offset, seq + 1)
+            SLOT.pack_into(
+                mm,
+                offset,
+                seq + 1,
+                1,
+                len(key_bytes),
+                len(state_bytes),
+                updated_at or time.time(),
+                key_bytes,
+                state_bytes,
+            )
+            SEQ.pack_into(mm, offset, seq + 2)
+            self.writes += 1
+
+    def _find_slot(self, bucket, key_bytes):
+        """已有的槽位、空槽位，或按 CLOCK 淘汰一个槽位（调用方持有写锁）"""
+        mm = self._mm
+        empty = None
+        for way in range(WAYS):
+            offset = self._offset(bucket, way)
+            key_len = mm[offset + 5]
+            if key_len == 0:
+                if empty is None:
+                    empty = offset
+            elif mm[offset + 16 : offset + 16 + key_len] == key_bytes:
+                return offset
+        if empty is not None:
+            return empty
+
+        hand_offset = HEADER_SIZE + bucket
+        hand = mm[hand_offset]
+        while True:
+            offset = self._offset(bucket, hand % WAYS)
+            hand = (hand + 1) % WAYS
+            if mm[offset + _REF_OFFSET]:
+                mm[offset + _REF_OFFSET] = 0
+                continue
+            mm[hand_offset] = hand
+            self.evictions += 1
+            return offset
+
+    def fresh_state(self, key, final_states, max_age):
+        """最终状态，或更新时间在 max_age 秒内的中间状态；其余情况返回 None"""
+        cached = self.get(key)
+        if cached is None:
+            return None
+        state, updated_at = cached
+        if state in final_states or time.time() - updated_at <= max_age:
+            return state
+        return None
+
+    def stats(self):
+        return {
+            "slots": self.slots,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def shared_state():
+    """获取共享状态表，首次调用时映射文件"""
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                _table = SharedStateTable(
+                    os.getenv("SHARED_STATE_PATH") or _default_path(),
+                    int(os.getenv("SHARED_STATE_SLOTS", DEFAULT_SLOTS)),
+                )
+    return _table
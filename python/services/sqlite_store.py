@@ -0,0 +1,82 @@
+"""多进程共享的 SQLite 存储基类
+
+- 使用 WAL 模式，多个 worker 进程可以同时读、串行写同一个数据库文件
+- 每个线程持有独立连接，避免跨线程共享连接
+- ``transaction()`` 使用 BEGIN IMMEDIATE，检查和更新之间不会被其他进程插入写操作
+- 表的主键变化时在 PRIMARY_KEYS 中声明，打开旧版本建的数据库时按新的 SCHEMA 重建该表并复制数据，
+  新主键中的列为 NULL 时复制为空字符串
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """子类在 SCHEMA 中声明建表语句"""
+
+    SCHEMA = ()
+
+    # 表名 -> 主键列，与已有的表不一致时重建
+    PRIMARY_KEYS = {}
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.transaction() as conn:
+            legacy = [table for table, key in self.PRIMARY_KEYS.items() if _primary_key(conn, table) not in ([], key)]
+            for table in legacy:
+                conn.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            for table in legacy:
+                self._copy_legacy(conn, table)
+            if legacy:
+                # 旧表上的同名索引随旧表删除，重新创建
+                for statement in self.SCHEMA:
+                    conn.execute(statement)
+
+    def _copy_legacy(self, conn, table):
+        key = self.PRIMARY_KEYS[table]
+        old_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table}_legacy)")}
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})") if row[1] in old_columns]
+        values = [f"COALESCE({column}, '')" if column in key else column for column in columns]
+        conn.execute(
+            f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) SELECT {', '.join(values)} FROM {table}_legacy"
+        )
+        conn.execute(f"DROP TABLE {table}_legacy")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def transaction(self):
+        """写事务: ``with store.transaction() as conn: ...``，异常时回滚"""
+        return _Transaction(self._conn())
+
+
+def _primary_key(conn, table):
+    """表的主键列（按主键中的顺序），表不存在时返回 []"""
+    rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    return [row[1] for row in sorted((row for row in rows if row[5]), key=lambda row: row[5])]
+
+
+class _Transaction:
+    __slots__ = ("conn",)
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
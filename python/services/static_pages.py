@@ -0,0 +1,187 @@
+"""预编译的页面
+
+首页、支付、退款、转账等页面几乎是静态的，首次访问（或 warm_up）时渲染一次并缓存，之后不再调用 render_template:
+
+- 模板变量(例如 pay.html 的 openid)渲染为占位符，按占位符把页面切分为若干段，请求时只把转义后的变量值填入
+- 完全静态的页面预先压缩为 gzip / brotli(安装了 brotli 时)，按 Accept-Encoding 直接返回压缩后的字节
+- 带变量的页面每段预先压缩为独立的 deflate 块（块之间 full flush，不引用前面的数据），请求时只压缩变量值，
+  再拼接为完整的 gzip 流，不需要重新压缩整个页面
+- 强 ETag 由页面内容(静态页面)或模板摘要 + 变量值(带变量的页面)计算，If-None-Match 命中时返回 304
+- app.debug 时每次请求重新编译，修改模板后刷新即可生效
+"""
+
+import hashlib
+import re
+import struct
+import threading
+import zlib
+
+from loguru import logger
+from markupsafe import escape
+
+# 需要预编译的模板及其变量
+PAGES = {
+    "index.html": (),
+    "native_pay.html": (),
+    "refund.html": (),
+    "transfer.html": (),
+    "pay.html": ("openid",),
+}
+
+# 压缩级别，只在编译时压缩一次，使用最高级别
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+_PLACEHOLDER = "\x00PAGE:{}\x00"
+_PLACEHOLDER_RE = re.compile("\x00PAGE:(\\w+)\x00")
+
+# 固定的 gzip 头: 无文件名、mtime 为 0，相同内容的压缩结果相同
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff"
+
+
+def _deflate(data, finish):
+    """压缩为独立的原始 deflate 块，finish 为 False 时以 full flush 结束，后面可以继续拼接"""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if finish else zlib.Z_FULL_FLUSH)
+
+
+def _brotli():
+    try:
+        import brotli
+
+        return brotli
+    except ImportError:
+        return None
+
+
+class CompiledPage:
+    """编译后的页面: 静态段与变量交替，segments 比 variables 多一个"""
+
+    __slots__ = ("segments", "variables", "digest", "gzip_segments", "identity", "gzip", "br")
+
+    def __init__(self, html, variables):
+        parts = _PLACEHOLDER_RE.split(html)
+        self.segments = [part.encode("utf-8") for part in parts[::2]]
+        self.variables = tuple(parts[1::2])
+        self.digest = hashlib.sha256(html.encode("utf-8")).hexdigest()[:32]
+        self.identity = self.gzip = self.br = None
+        self.gzip_segments = None
+        if self.variables:
+            last = len(self.segments) - 1
+            self.gzip_segments = [_deflate(segment, i == last) for i, segment in enumerate(self.segments)]
+        else:
+            self.identity = self.segments[0]
+            self.gzip = _GZIP_HEADER + _deflate(self.identity, True) + self._trailer(self.segments)
+            brotli = _brotli()
+            if brotli is not None:
+                self.br = brotli.compress(self.identity, quality=BROTLI_QUALITY)
+        missing = set(variables) - set(self.variables)
+        if missing:
+            logger.warning("模板中没有使用的变量: {}", ", ".join(sorted(missing)))
+
+    @staticmethod
+    def _trailer(pieces):
+        crc, size = 0, 0
+        for piece in pieces:
+            crc = zlib.crc32(piece, crc)
+            size += len(piece)
+        return struct.pack("<II", crc, size & 0xFFFFFFFF)
+
+    def etag(self, values):
+        """页面内容的强 ETag（不含引号），带变量的页面按模板摘要和变量值计算"""
+        if not self.variables:
+            return self.digest
+        digest = hashlib.sha256(self.digest.encode("ascii"))
+        for value in values:
+            digest.update(b"\x00" + value)
+        return digest.hexdigest()[:32]
+
+    def render(self, values, encoding):
+        """按内容编码返回页面字节: identity / gzip / br(仅静态页面)"""
+        if not self.variables:
+            return {"identity": self.identity, "gzip": self.gzip, "br": self.br}[encoding]
+        if encoding == "identity":
+            pieces = [self.segments[0]]
+            for value, segment in zip(values, self.segments[1:]):
+                pieces += (value, segment)
+            return b"".join(pieces)
+        chunks = [_GZIP_HEADER, self.gzip_segments[0]]
+        pieces = [self.segments[0]]
+        for value, segment, compressed in zip(values, self.segments[1:], self.gzip_segments[1:]):
+            chunks += (_deflate(value, False), compressed)
+            pieces += (value, segment)
+        chunks.append(self._trailer(pieces))
+        return b"".join(chunks)
+
+
+class StaticPages:
+    """按模板缓存的编译结果"""
+
+    def __init__(self, app, cache_control="no-cache"):
+        self.app = app
+        self.cache_control = cache_control
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def compile(self, template):
+        """渲染模板（变量渲染为占位符）并预先压缩"""
+        from flask import render_template
+
+        variables = PAGES.get(template, ())
+        with self.app.app_context():
+            html = render_template(template, **{name: _PLACEHOLDER.format(name) for name in variables})
+        page = CompiledPage(html, variables)
+        logger.info(
+            "页面已预编译 - 模板: {}, 大小: {}B, gzip: {}B, br: {}B",
+            template,
+            sum(len(segment) for segment in page.segments),
+            len(page.gzip) if page.gzip else "-",
+            len(page.br) if page.br else "-",
+        )
+        return page
+
+    def page(self, template):
+        if self.app.debug:
+            return self.compile(template)
+        page = self._pages.get(template)
+        if page is None:
+            with self._lock:
+                page = self._pages.get(template)
+                if page is None:
+                    page = self._pages[template] = self.compile(template)
+        return page
+
+    def warm_up(self):
+        for template in PAGES:
+            self.page(template)
+
+    def respond(self, template, **values):
+        """返回页面应答，If-None-Match 命中时返回 304"""
+        from flask import Response, request
+
+        page = self.page(template)
+        encoded = [str(escape(values.get(name, ""))).encode("utf-8") for name in page.variables]
+        etag = page.etag(encoded)
+        encoding = self._negotiate(page, request.accept_encodings)
+        headers = {
+            "ETag": f'"{etag}-{encoding}"' if encoding != "identity" else f'"{etag}"',
+            "Vary": "Accept-Encoding",
+            # 带变量的页面按会话生成，不允许共享缓存
+            "Cache-Control": f"private, {self.cache_control}" if page.variables else self.cache_control,
+        }
+        # 同一内容的各个编码共用摘要，客户端缓存的任一编码都可以复用
+        if request.if_none_match and any(
+            request.if_none_match.contains(etag + suffix) for suffix in ("", "-gzip", "-br")
+        ):
+            return Response(status=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(page.render(encoded, encoding), mimetype="text/html", headers=headers)
+
+    @staticmethod
+    def _negotiate(page, accept_encodings):
+        if page.br is not None and accept_encodings["br"]:
+            return "br"
+        if accept_encodings["gzip"]:
+            return "gzip"
+        return "identity"
@@ -0,0 +1,328 @@
+"""请求链路追踪
+
+默认不开启（no-op，开销仅为一次函数调用），通过环境变量 ``TRACING_EXPORTER`` 选择导出方式：
+
+- file: 内置的轻量 tracer，span 以 JSON Lines 格式由后台线程写入 ``TRACING_FILE``
+- otel: 使用 OpenTelemetry SDK（需安装 opentelemetry-sdk 与 opentelemetry-exporter-otlp），
+  通过 OTLP 导出到本地 collector，地址由 OTEL_EXPORTER_OTLP_ENDPOINT 等标准环境变量配置
+
+span 属性统一以 ``wechatpay.`` 为前缀，例如 wechatpay.request_id / wechatpay.out_trade_no / wechatpay.out_bill_no，
+按商户单号即可串起浏览器轮询、上游调用与回调通知的完整链路。
+"""
+
+import atexit
+import contextvars
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+
+from loguru import logger
+
+ATTRIBUTE_PREFIX = "wechatpay."
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _attributes(attributes):
+    return {
+        key if "." in key else f"{ATTRIBUTE_PREFIX}{key}": value
+        for key, value in attributes.items()
+        if value is not None
+    }
+
+
+class _NoopSpan:
+    """未开启追踪时使用的空 span"""
+
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def record_exception(self, exc):
+        pass
+
+    def set_error(self, description=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _NoopTracer:
+    def start_span(self, name, parent=None, **attributes):
+        return NOOP_SPAN
+
+    def current_span(self):
+        return NOOP_SPAN
+
+    def shutdown(self):
+        pass
+
+
+class Span:
+    """内置 tracer 的 span，字段命名与 OpenTelemetry 保持一致"""
+
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "start", "end", "attributes", "status", "_token")
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.status = "OK"
+        self.start = self.end = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.attributes[key if "." in key else f"{ATTRIBUTE_PREFIX}{key}"] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(_attributes(attributes))
+
+    def record_exception(self, exc):
+        self.attributes["exception.type"] = type(exc).__name__
+        self.attributes["exception.message"] = str(exc)
+        self.status = "ERROR"
+
+    def set_error(self, description=None):
+        self.status = "ERROR"
+        if description:
+            self.attributes["status.description"] = description
+
+    def __enter__(self):
+        self.start = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.record_exception(exc)
+        self.end = time.time_ns()
+        _current_span.reset(self._token)
+        self.tracer.export(self)
+        return False
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start,
+            "end_time": self.end,
+            "duration_ms": round((self.end - self.start) / 1e6, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class FileTracer:
+    """内置 tracer，span 结束后放入队列，由后台线程批量写入 JSON Lines 文件"""
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._writer = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.shutdown)
+
+    def start_span(self, name, parent=None, **attributes):
+        parent = parent if parent is not None else _current_span.get()
+        if parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        else:
+            trace_id, parent_id = secrets.token_hex(16), None
+        return Span(self, name, trace_id, parent_id, _attributes(attributes))
+
+    def current_span(self):
+        return _current_span.get() or NOOP_SPAN
+
+    def export(self, span):
+        self._queue.put(span.to_dict())
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                f.write(json.dumps(item, ensure_ascii=False, default=str) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+    def shutdown(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=2)
+
+
+class _OTelSpan:
+    """OpenTelemetry span 的适配层，统一 set_error 等接口"""
+
+    __slots__ = ("_cm", "_span")
+
+    def __init__(self, cm):
+        self._cm = cm
+        self._span = None
+
+    def __enter__(self):
+        self._span = self._cm.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._cm.__exit__(exc_type, exc, tb)
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self._span.set_attribute(key if "." in key else f"{ATTRIBUTE_PREFIX}{key}", value)
+
+    def set_attributes(self, **attributes):
+        self._span.set_attributes(_attributes(attributes))
+
+    def record_exception(self, exc):
+        self._span.record_exception(exc)
+
+    def set_error(self, description=None):
+        from opentelemetry.trace import Status, StatusCode
+
+        self._span.set_status(Status(StatusCode.ERROR, description))
+
+    @property
+    def trace_id(self):
+        return format(self._span.get_span_context().trace_id, "032x")
+
+    @property
+    def span_id(self):
+        return format(self._span.get_span_context().span_id, "016x")
+
+
+class OTelTracer:
+    """基于 OpenTelemetry SDK 的 tracer，使用 OTLP 导出到本地 collector"""
+
+    def __init__(self):
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        provider = TracerProvider(resource=Resource.create({"service.name": "wechatpay-demo"}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(provider)
+        self._provider = provider
+        self._tracer = trace.get_tracer("wechatpay")
+
+    def start_span(self, name, parent=None, **attributes):
+        context = None
+        if parent is not None:
+            from opentelemetry import trace
+
+            context = trace.set_span_in_context(parent._span if isinstance(parent, _OTelSpan) else parent)
+        return _OTelSpan(self._tracer.start_as_current_span(name, context=context, attributes=_attributes(attributes)))
+
+    def current_span(self):
+        from opentelemetry import trace
+
+        span = _OTelSpan(None)
+        span._span = trace.get_current_span()
+        return span
+
+    def shutdown(self):
+        self._provider.shutdown()
+
+
+def _create_tracer():
+    exporter = os.getenv("TRACING_EXPORTER", "none").lower()
+    try:
+        match exporter:
+            case "file":
+                return FileTracer(os.getenv("TRACING_FILE", "logs/traces.jsonl"))
+            case "otel":
+                return OTelTracer()
+            case _:
+                return _NoopTracer()
+    except ImportError as e:
+        logger.warning("OpenTelemetry 未安装，链路追踪已关闭: {}", e)
+        return _NoopTracer()
+
+
+_tracer = None
+
+
+def get_tracer():
+    global _tracer
+    if _tracer is None:
+        _tracer = _create_tracer()
+    return _tracer
+
+
+def start_span(name, **attributes):
+    """开始一个 span，作为上下文管理器使用，属性名会自动加上 wechatpay. 前缀"""
+    return get_tracer().start_span(name, **attributes)
+
+
+def current_span():
+    """获取当前 span，未开启追踪时返回 no-op span"""
+    return get_tracer().current_span()
+
+
+def _parse_traceparent(value):
+    """解析 W3C traceparent 请求头: 00-{trace_id}-{span_id}-{flags}"""
+    parts = (value or "").split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None
+
+
+def install_tracing(app):
+    """为每个 Flask 请求创建 server span，并沿用浏览器传入的 traceparent"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_request_span():
+        tracer = get_tracer()
+        if isinstance(tracer, _NoopTracer):
+            return
+        rule = request.url_rule.rule if request.url_rule else request.path
+        attributes = {"http.method": request.method, "http.route": rule}
+        parent = None
+        remote = _parse_traceparent(request.headers.get("traceparent"))
+        if remote and isinstance(tracer, FileTracer):
+            # 内置 tracer 直接沿用远端的 trace_id 作为父级
+            parent = Span(tracer, "remote", remote[0], None, {})
+            parent.span_id = remote[1]
+        span = tracer.start_span(f"{request.method} {rule}", parent=parent, **attributes)
+        g._trace_span = span.__enter__()
+
+    @app.after_request
+    def _tag_request_span(response):
+        span = g.get("_trace_span")
+        if span is not None:
+            span.set_attribute("http.status_code", response.status_code)
+            if response.status_code >= 500:
+                span.set_error()
+            response.headers["traceparent"] = f"00-{span.trace_id}-{span.span_id}-01"
+        return response
+
+    @app.teardown_request
+    def _end_request_span(exc):
+        span = g.pop("_trace_span", None)
+        if span is not None:
+            span.__exit__(type(exc) if exc else None, exc, None)
@@ -0,0 +1,102 @@
+"""请求流量录制
+
+设置 ``TRAFFIC_RECORD_FILE`` 后，每个请求的方法、路径、部分请求头和请求体会以 JSON Lines
+格式追加写入该文件，由后台线程落盘，供 ``tools/loadgen.py`` 回放。
+
+- TRAFFIC_RECORD_FILE: 录制文件路径，未设置时不录制
+- TRAFFIC_RECORD_RATE: 录制采样率，默认 1
+"""
+
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+from base64 import b64encode
+
+from loguru import logger
+
+# 回放时需要保留的请求头，Cookie 等身份信息不录制
+RECORDED_HEADERS = (
+    "Content-Type",
+    "Idempotency-Key",
+    "Wechatpay-Timestamp",
+    "Wechatpay-Nonce",
+    "Wechatpay-Signature",
+    "Wechatpay-Serial",
+)
+
+# 不录制的路由
+SKIPPED_PATHS = ("/metrics", "/static/")
+
+
+class TrafficRecorder:
+    """异步写入录制文件"""
+
+    def __init__(self, path, rate=1.0):
+        self.path = path
+        self.rate = rate
+        self._queue = queue.SimpleQueue()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._writer = threading.Thread(target=self._run, name="traffic-recorder", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def record(self, method, path, query, headers, body):
+        if self.rate < 1.0 and random.random() >= self.rate:
+            return
+        entry = {
+            "ts": time.time(),
+            "method": method,
+            "path": path,
+            "query": query,
+            "headers": {name: headers[name] for name in RECORDED_HEADERS if name in headers},
+        }
+        if body:
+            try:
+                entry["body"] = body.decode("utf-8")
+            except UnicodeDecodeError:
+                entry["body_b64"] = b64encode(body).decode("ascii")
+        self._queue.put(entry)
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                entry = self._queue.get()
+                if entry is None:
+                    break
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=2)
+
+
+def install_traffic_recorder(app):
+    """按环境变量开启流量录制，返回录制器（未开启时返回 None）"""
+    path = os.getenv("TRAFFIC_RECORD_FILE")
+    if not path:
+        return None
+    recorder = TrafficRecorder(path, float(os.getenv("TRAFFIC_RECORD_RATE", "1")))
+    logger.info("流量录制已开启: {}", path)
+
+    @app.before_request
+    def _record_traffic():
+        from flask import request
+
+        if request.path.startswith(SKIPPED_PATHS):
+            return
+        recorder.record(
+            request.method,
+            request.path,
+            request.query_string.decode("utf-8"),
+            request.headers,
+            request.get_data(cache=True),
+        )
+
+    return recorder
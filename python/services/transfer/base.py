@@ -1,6 +1,7 @@
 """微信转账基础类"""
 import time
 from loguru import logger
+from services.rollups import TRANSFER, rollups, scene_of
 from services.wechat_pay_base import WeChatPayBase
 from .constants import (
     HTTP_STATUS_MAP, STATE_MAP, NEED_CONFIRM_STATES,
@@ -9,44 +10,49 @@ from .constants import (
 
 class TransferBase(WeChatPayBase):
     """微信商家转账基础类"""
-    def __init__(self):
-        super().__init__()
+    def __init__(self, merchant=None, rate_limiter=None):
+        super().__init__(merchant, rate_limiter)
 
-    def handle_transfer_state(self, state, result, out_bill_no):
-        """处理转账状态"""
+    def handle_transfer_state(self, bill, out_bill_no):
+        """处理转账状态
+
+        Args:
+            bill (TransferBill): 转账单（应答、回调通知或本地记录的状态）
+            out_bill_no (str): 商户单号
+        """
+        state = bill.state
         try:
             state_msg = STATE_MAP.get(state, "未知状态")
-            
-            base_response = {
-                "code": 0,
-                "data": result,
-                "out_bill_no": out_bill_no,
-                "state": state,
-                "state_msg": state_msg,
-                "need_confirm": False
-            }
-
-            if not state:
-                logger.warning(f"转账状态为空，商户单号: {out_bill_no}")
-                return {**base_response, "code": -1, "msg": "转账状态未知"}
+            need_confirm = False
 
             match state:
+                case None | "":
+                    logger.warning(f"转账状态为空，商户单号: {out_bill_no}")
+                    code, msg = -1, "转账状态未知"
                 case "ACCEPTED":
-                    return {**base_response, "msg": "转账申请已受理"}
-                    
+                    code, msg = 0, "转账申请已受理"
                 case state if state in NEED_CONFIRM_STATES:
-                    return {**base_response, "msg": "请在微信中确认收款", "need_confirm": True}
-                    
+                    code, msg, need_confirm = 0, "请在微信中确认收款", True
                 case state if state in RETRIABLE_STATES:
-                    return {**base_response, "code": -1, "msg": state_msg}
-                    
+                    code, msg = -1, state_msg
                 case state if state in FINAL_STATES:
-                    is_success = state == "SUCCESS"
-                    return {**base_response, "code": 0 if is_success else -2, "msg": state_msg}
-                    
+                    code, msg = (0 if state == "SUCCESS" else -2), state_msg
                 case _:
-                    return {**base_response, "code": -1, "msg": f"未知状态: {state}"}
-                    
+                    code, msg = -1, f"未知状态: {state}"
+
+            if state:
+                rollups().record(TRANSFER, out_bill_no, state, bill.transfer_amount, scene_of(bill.transfer_scene_id))
+
+            return {
+                "code": code,
+                "data": bill.to_wire(),
+                "out_bill_no": out_bill_no,
+                "state": state,
+                "state_msg": state_msg,
+                "need_confirm": need_confirm,
+                "msg": msg,
+            }
+
         except Exception as e:
             logger.exception(f"处理转账状态异常: {str(e)}")
             return {
@@ -54,7 +60,7 @@ class TransferBase(WeChatPayBase):
                 "msg": f"处理状态异常: {str(e)}",
                 "out_bill_no": out_bill_no,
                 "state": "未知状态",
-                "data": result,
+                "data": bill.to_wire(),
             }
 
     def handle_http_status(self, status_code, result):
@@ -39,7 +39,42 @@ FINAL_STATES = {
     "CANCELLED",
 }
 
+# HTTP状态码说明
+HTTP_STATUS_MAP = {
+    200: "请求成功",
+    202: "请求已受理",
+    204: "处理成功，无返回Body",
+    400: "参数错误或请求不符合业务规则",
+    401: "签名验证不通过",
+    403: "权限异常",
+    404: "请求的资源不存在",
+    429: "请求频率超限",
+    500: "系统错误",
+    502: "服务下线，暂时不可用",
+    503: "服务不可用，过载保护",
+    504: "网关超时",
+}
 
+# 转账场景配置，参考 https://pay.weixin.qq.com/doc/v3/merchant/4012711988
+# user_recv_perception 只能从列表中选择一个传入，transfer_scene_report_infos 需填写全部报备字段
+TRANSFER_SCENES = {
+    "现金营销": {
+        "transfer_scene_id": "1000",
+        "user_recv_perception": ["活动奖励", "现金奖励"],
+        "transfer_scene_report_infos": [
+            {"info_type": "活动名称", "desc": "用户参与活动的名称，如新会员有礼"},
+            {"info_type": "奖励说明", "desc": "用户因为什么奖励获取这笔资金，如注册会员抽奖一等奖"},
+        ],
+    },
+    "佣金报酬": {
+        "transfer_scene_id": "1002",
+        "user_recv_perception": ["劳务报酬", "报销款", "企业补贴", "开工利是"],
+        "transfer_scene_report_infos": [
+            {"info_type": "岗位类型", "desc": "收款用户的岗位类型，如外卖员、专家顾问"},
+            {"info_type": "报酬说明", "desc": "用户接收当前这笔报酬的原因，如7月份配送费，高温补贴"},
+        ],
+    },
+}
 
 # 可重试的业务错误码
 RETRIABLE_BIZ_CODES = {
@@ -59,10 +94,16 @@ API_CONFIGS = {
         "path": "/v3/fund-app/mch-transfer/transfer-bills",
         # 接口描述
         "desc": "创建商家转账API",
+        # (连接, 读取) 超时(秒)，未配置时使用 wechat_pay_base.DEFAULT_TIMEOUT
+        "timeout": (3.05, 10),
+        # 超时、连接失败、429/5XX 时使用原商户单号重试的次数
+        "retries": 1,
     },
     "query_transfer": {
         "method": "GET",
         "path": "/v3/fund-app/mch-transfer/transfer-bills/out-bill-no/{out_bill_no}",
         "desc": "查询商家转账API",
+        "timeout": (3.05, 5),
+        "hedge": True,
     },
 }
@@ -0,0 +1,158 @@
+"""商家转账-发起转账与查询转账"""
+
+import os
+from base64 import b64encode
+
+from loguru import logger
+
+from services.ids import new_out_bill_no
+from services.log import payload
+from services.merchant import merchant_registry
+from services.models import TransferBill
+from services.shared_state import max_age as shared_state_max_age
+from services.shared_state import shared_state, state_key
+from services.transfer.base import TransferBase
+from services.transfer.constants import (
+    API_CONFIGS,
+    FINAL_STATES,
+    MAX_TRANSFER_AMOUNT,
+    MIN_TRANSFER_AMOUNT,
+    TRANSFER_SCENES,
+)
+from services.transfer.transfer_store import transfer_store
+
+# 默认转账场景
+DEFAULT_TRANSFER_SCENE = "现金营销"
+
+
+def get_create_transfer(mch_id=None):
+    """获取商户的 CreateTransfer 实例，首次调用时才加载配置和密钥；不传商户号时使用默认商户"""
+    return merchant_registry().client(CreateTransfer, mch_id)
+
+
+class CreateTransfer(TransferBase):
+    """商家转账-发起转账实现类"""
+
+    API_CONFIGS = API_CONFIGS
+
+    def create_transfer_order(
+        self,
+        openid,
+        amount,
+        remark="",
+        transfer_scene=DEFAULT_TRANSFER_SCENE,
+        user_recv_perception=None,
+        report_infos=None,
+        user_name=None,
+        notify_url=None,
+        out_bill_no=None,
+    ):
+        """
+        商家转账-发起转账
+        https://pay.weixin.qq.com/doc/v3/merchant/4012716434
+
+        Args:
+            openid (str): 收款用户的openid
+            amount (int): 转账金额，单位为分
+            remark (str): 转账备注，用户收款时可见，最多32个字符
+            transfer_scene (str): TRANSFER_SCENES 中的场景名称
+            user_recv_perception (str, optional): 用户收款感知，默认取场景配置的第一个
+            report_infos (dict, optional): 报备信息 {info_type: info_content}，未填写的字段使用转账备注
+            user_name (str, optional): 收款用户姓名，转账金额>=2000元时必填，使用平台证书公钥加密
+            notify_url (str, optional): 回调通知地址，默认读取 TRANSFER_NOTIFY_URL
+            out_bill_no (str, optional): 商户单号，重试时传入原单号，不传时生成新单号
+        """
+        out_bill_no = out_bill_no or new_out_bill_no()
+        logger.info("开始发起转账 - 商户单号: {}, 金额: {}分", out_bill_no, amount)
+
+        scene = TRANSFER_SCENES.get(transfer_scene)
+        if scene is None:
+            return {"code": -2, "msg": f"未配置的转账场景: {transfer_scene}", "out_bill_no": out_bill_no}
+        if not MIN_TRANSFER_AMOUNT <= amount <= MAX_TRANSFER_AMOUNT:
+            return {
+                "code": -2,
+                "msg": f"转账金额需在{MIN_TRANSFER_AMOUNT}~{MAX_TRANSFER_AMOUNT}分之间",
+                "out_bill_no": out_bill_no,
+            }
+
+        perception = user_recv_perception or scene["user_recv_perception"][0]
+        remark = remark or perception
+        report_infos = report_infos or {}
+        body = {
+            "appid": self.app_id,
+            "out_bill_no": out_bill_no,
+            "transfer_scene_id": scene["transfer_scene_id"],
+            "openid": openid,
+            "transfer_amount": amount,
+            "transfer_remark": remark[:32],
+            "user_recv_perception": perception,
+            "transfer_scene_report_infos": [
+                {"info_type": info["info_type"], "info_content": report_infos.get(info["info_type"], remark)[:32]}
+                for info in scene["transfer_scene_report_infos"]
+            ],
+        }
+        notify_url = notify_url or os.getenv("TRANSFER_NOTIFY_URL")
+        if notify_url:
+            body["notify_url"] = notify_url
+
+        headers = None
+        if user_name:
+            # 敏感信息加密后，Wechatpay-Serial 需填入加密所用证书的序列号
+            body["user_name"] = self.encrypt(user_name)
+            headers = {"Wechatpay-Serial": self.platform_serial_no or ""}
+        logger.debug("转账请求参数: {}", payload(body))
+
+        status_code, result = self._call_api("create_transfer", data=body, additional_headers=headers)
+        # 受理应答不含金额和场景，补上请求中的值供汇总统计使用
+        return self._handle_result(
+            status_code, result, out_bill_no, transfer_amount=amount, transfer_scene_id=scene["transfer_scene_id"]
+        )
+
+    def cached_transfer_state(self, out_bill_no):
+        """不需要查询微信支付的转账状态: 共享状态表中的最终状态或仍有效的中间状态，以及本地记录的最终状态，
+        按查询结果的格式返回；没有时返回 None
+        """
+        key = state_key(self.mch_id, out_bill_no)
+        state = shared_state().fresh_state(key, FINAL_STATES, shared_state_max_age())
+        if state is None:
+            state = transfer_store().state(self.mch_id, out_bill_no)
+            if state not in FINAL_STATES:
+                return None
+        return self.handle_transfer_state(TransferBill(out_bill_no=out_bill_no, state=state), out_bill_no)
+
+    def apply_notification(self, bill):
+        """处理转账结果回调(MCHTRANSFER.BILL.FINISHED)解密后的转账单(TransferBill): 记录本地状态，按查询结果的格式返回"""
+        logger.info(
+            "转账结果通知 - 商户单号: {}, 微信转账单号: {}, 状态: {}", bill.out_bill_no, bill.transfer_bill_no, bill.state
+        )
+        if bill.out_bill_no and bill.state:
+            transfer_store().record(bill.mch_id or self.mch_id, bill.out_bill_no, bill.state)
+        return self.handle_transfer_state(bill, bill.out_bill_no)
+
+    def query_transfer_order(self, out_bill_no):
+        """商户单号查询转账单"""
+        logger.info("开始查询转账状态 - 商户单号: {}", out_bill_no)
+        status_code, result = self._call_api("query_transfer", out_bill_no=out_bill_no)
+        return self._handle_result(status_code, result, out_bill_no)
+
+    def _handle_result(self, status_code, result, out_bill_no, **defaults):
+        """处理发起/查询转账的应答，defaults 为应答中没有时补上的转账单字段"""
+        if status_code is None:
+            return {"code": -1, "msg": f"请求失败: {result.get('message')}", "out_bill_no": out_bill_no}
+        retriable, error = self.handle_http_status(status_code, result)
+        if error:
+            # 可重试的错误必须使用原商户单号重试
+            return {"code": -1 if retriable else -2, "msg": error, "out_bill_no": out_bill_no, "data": result}
+        bill = TransferBill.from_dict(result)
+        if bill.state:
+            bill = bill.with_defaults(**defaults)
+            transfer_store().record(self.mch_id, out_bill_no, bill.state)
+        return self.handle_transfer_state(bill, out_bill_no)
+
+    def encrypt(self, data):
+        """使用平台证书公钥加密敏感信息，采用 OAEP padding 方式"""
+        from Crypto.Cipher import PKCS1_OAEP
+        from Crypto.Hash import SHA1
+
+        cipher = PKCS1_OAEP.new(self.platform_cert, hashAlgo=SHA1)
+        return b64encode(cipher.encrypt(data.encode("utf-8"))).decode("utf-8")
@@ -1,6 +1,7 @@
 """商家转账-发起转账API - 伪代码实现"""
 
 import json
+import os
 import time
 import uuid
 
@@ -57,7 +58,7 @@ class CreateTransfer:
     """商家转账-发起转账实现类"""
 
     def __init__(self):
-        self.host = "https://api.mch.weixin.qq.com"
+        self.host = os.getenv("WECHAT_PAY_API_BASE", "https://api.mch.weixin.qq.com")
         self.path = "/v3/fund-app/mch-transfer/transfer-bills"
         self.method = "POST"
         self.mch_id = "XXX"  # 商户号，是由微信支付系统生成并分配给每个商户的唯一标识符，商户号获取方式参考https://pay.weixin.qq.com/doc/v3/merchant/4013070756
@@ -149,11 +150,13 @@ class CreateTransfer:
         headers = self.make_request_header(body_str)
 
         # 发送 http 请求 读取 self.method 和 self.url
+        # 必须设置超时，否则连接挂起时会一直占用当前线程；(连接超时, 读取超时) 单位为秒
         http_response = requests.request(
             self.method,
             self.host + self.path,
             headers=headers,
             data=body_str,
+            timeout=(3.05, 10),
         )
         return http_response
 
@@ -324,17 +327,29 @@ class CreateTransfer:
     ):
         """
         验证微信支付回包：使用公钥验证微信支付 API 接口返回的微信支付签名是否正确
+        Request-Id 记录在链路追踪的 span 上，便于与微信支付侧排查问题
         """
-        import json
+        from services.tracing import start_span
+
+        header = http_response.headers
+        request_id = header.get("Request-Id", "").strip()
+        timestamp = int(header.get("Wechatpay-Timestamp", "").strip())
+        with start_span("wechatpay.response.verify", request_id=request_id):
+            self._verify_response_signature(http_response, request_id, timestamp)
+
+    def _verify_response_signature(
+        self,
+        http_response: requests.models.Response,
+        request_id: str,
+        timestamp: int,
+    ):
+        """验证微信支付回包签名，失败时抛出异常"""
         from base64 import b64decode
 
         from Crypto.Hash import SHA256
         from Crypto.Signature import pkcs1_15
 
         header = http_response.headers
-        request_id = header.get("Request-Id", "").strip()
-        timestamp = int(header.get("Wechatpay-Timestamp", "").strip())
-        print("header=", header)
         # 验证时间戳
         if abs(time.time() - timestamp) >= 300:  # 5 minutes
             raise ValueError(f"Timestamp=[{timestamp}] expires, request-id=[{request_id}]")
@@ -352,7 +367,6 @@ class CreateTransfer:
         message_hash = SHA256.new(message.encode("utf-8"))
         signature_bytes = b64decode(signature)
         pkcs1_15.new(self.public_key).verify(message_hash, signature_bytes)
-        print("签名验证成功")
 
     def encrypt(self, data):
         """
@@ -0,0 +1,70 @@
+"""转账单本地状态
+
+发起转账、查询转账和转账结果回调(/wxpay/transfer_notify)得到的状态记录在 SQLite（TRANSFER_STORE_PATH）中，
+按 商户号 + 商户单号 索引（商户单号只在同一商户内唯一），多个 worker 共享，同时写入共享状态表(services.shared_state)：
+
+- /query_transfer 优先读取共享状态表，被淘汰时以本地记录的最终状态为准，不再查询微信支付
+- 已是最终状态(FINAL_STATES)的转账单不会被晚到的中间状态(例如先发出的查询的应答)覆盖
+"""
+
+import os
+import threading
+import time
+
+from services.shared_state import shared_state, state_key
+from services.sqlite_store import SQLiteStore
+from services.transfer.constants import FINAL_STATES
+
+DEFAULT_STORE_PATH = "data/transfers.db"
+
+
+class TransferStore(SQLiteStore):
+    """转账单状态"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS transfers ("
+        "mch_id TEXT NOT NULL DEFAULT '', out_bill_no TEXT NOT NULL, state TEXT NOT NULL, updated_at REAL NOT NULL, "
+        "PRIMARY KEY (mch_id, out_bill_no))",
+    )
+
+    PRIMARY_KEYS = {"transfers": ["mch_id", "out_bill_no"]}
+
+    _FINAL_PLACEHOLDERS = ", ".join("?" * len(FINAL_STATES))
+
+    def record(self, mch_id, out_bill_no, state):
+        """记录状态，返回记录后的状态（已是最终状态时保持不变）"""
+        mch_id = mch_id or ""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO transfers (mch_id, out_bill_no, state, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(mch_id, out_bill_no) DO UPDATE SET state = excluded.state, "
+                "updated_at = excluded.updated_at "
+                f"WHERE transfers.state NOT IN ({self._FINAL_PLACEHOLDERS})",
+                (mch_id, out_bill_no, state, now, *sorted(FINAL_STATES)),
+            )
+            current = conn.execute(
+                "SELECT state FROM transfers WHERE mch_id = ? AND out_bill_no = ?", (mch_id, out_bill_no)
+            ).fetchone()[0]
+        shared_state().put(state_key(mch_id, out_bill_no), current)
+        return current
+
+    def state(self, mch_id, out_bill_no):
+        row = self._conn().execute(
+            "SELECT state FROM transfers WHERE mch_id = ? AND out_bill_no = ?", (mch_id or "", out_bill_no)
+        ).fetchone()
+        return row[0] if row else None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def transfer_store():
+    """获取全局转账单状态存储，首次调用时打开数据库"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = TransferStore(os.getenv("TRANSFER_STORE_PATH", DEFAULT_STORE_PATH))
+    return _store
@@ -0,0 +1,104 @@
+"""微信支付上游的健康状况
+
+_send 每次向微信支付发出请求时记录: 进行中的请求数（按商户，对比连接池大小）、
+耗时和是否失败（连接失败、超时、5XX）的指数加权移动平均(EWMA)，供 /ready 判断是否接流量。
+
+EWMA 按时间衰减(HALF_LIFE 秒)，而不是按样本数：流量少时旧样本也会逐渐失去权重；
+超过 STALE_AFTER 秒没有新样本时视为没有数据，避免摘掉流量后一直停留在不健康的状态。
+"""
+
+import math
+import threading
+import time
+
+# 半衰期(秒)，以及多久没有样本后数据失效
+HALF_LIFE = 10.0
+STALE_AFTER = 30.0
+
+
+class Ewma:
+    """按时间衰减的加权平均"""
+
+    __slots__ = ("half_life", "value", "weight", "updated")
+
+    def __init__(self, half_life=HALF_LIFE):
+        self.half_life = half_life
+        self.value = 0.0
+        self.weight = 0.0
+        self.updated = None
+
+    def add(self, sample, now):
+        if self.updated is not None:
+            decay = math.exp2(-(now - self.updated) / self.half_life)
+            self.weight *= decay
+        self.value = (self.value * self.weight + sample) / (self.weight + 1)
+        self.weight += 1
+        self.updated = now
+
+    def get(self, now, stale_after=STALE_AFTER):
+        """当前值，没有样本或已失效时返回 None"""
+        if self.updated is None or now - self.updated > stale_after:
+            return None
+        return self.value
+
+
+class UpstreamHealth:
+    """上游请求的耗时、失败率与连接池占用"""
+
+    def __init__(self, half_life=HALF_LIFE):
+        self._lock = threading.Lock()
+        self._latency = Ewma(half_life)
+        self._errors = Ewma(half_life)
+        self._inflight = {}
+        self._pool_sizes = {}
+        self.requests = 0
+        self.failures = 0
+
+    def begin(self, mch_id, pool_size):
+        with self._lock:
+            self._inflight[mch_id] = self._inflight.get(mch_id, 0) + 1
+            self._pool_sizes[mch_id] = pool_size
+
+    def end(self, mch_id, seconds, failed):
+        now = time.monotonic()
+        with self._lock:
+            self._inflight[mch_id] -= 1
+            self._latency.add(seconds, now)
+            self._errors.add(1.0 if failed else 0.0, now)
+            self.requests += 1
+            self.failures += failed
+
+    def pool_saturation(self):
+        """各商户连接池中进行中的请求占比的最大值"""
+        with self._lock:
+            return max(
+                (count / self._pool_sizes[mch_id] for mch_id, count in self._inflight.items()),
+                default=0.0,
+            )
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            latency = self._latency.get(now)
+            error_rate = self._errors.get(now)
+            inflight = sum(self._inflight.values())
+        return {
+            "latency_ms": None if latency is None else round(latency * 1000, 1),
+            "error_rate": None if error_rate is None else round(error_rate, 3),
+            "inflight": inflight,
+            "pool_saturation": round(self.pool_saturation(), 3),
+        }
+
+    def stats(self):
+        snapshot = self.snapshot()
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "inflight": snapshot["inflight"],
+            "latency_ms": snapshot["latency_ms"] or 0,
+            "error_rate": snapshot["error_rate"] or 0,
+            "pool_saturation": snapshot["pool_saturation"],
+        }
+
+
+UPSTREAM = UpstreamHealth()
@@ -1,36 +1,85 @@
+import concurrent.futures
 import json
-import logging
 import os
 import random
 import string
 import time
 from base64 import b64decode, b64encode
 
-import requests
-from Crypto.Hash import SHA256
-from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from loguru import logger
 
-logger = logging.getLogger(__name__)
+from services.log import payload
+from services import deadline
+from services.audit_log import ID_FIELDS, Exchange, audit_log
+from services.endpoints import DEFAULT_BACKUP_API_BASE, endpoint_set, first_success, hedge_pool
+from services.merchant import KEY_CACHE, RATE_LIMIT_WAIT, RateLimiter, merchant_from_env
+from services.metrics import observe_stage, record_api_result, timed
+from services.notification import json_loads
+from services.tracing import start_span
+from services.upstream_health import UPSTREAM
+
+# requests 与加密库(pycryptodome / cryptography)导入较慢，在首次使用时才导入，缩短 worker 启动时间
+
+# 微信支付API域名，压测或联调时可通过 WECHAT_PAY_API_BASE 指向本地替身服务
+DEFAULT_API_BASE = "https://api.mch.weixin.qq.com"
+
+# 每个商户连接池的默认大小
+DEFAULT_POOL_SIZE = 10
+
+# 默认的 (连接, 读取) 超时(秒)，单个接口可以在 API_CONFIGS 中用 timeout 覆盖；读取超时为两次收到数据之间的最长间隔
+DEFAULT_TIMEOUT = (
+    float(os.getenv("WECHAT_CONNECT_TIMEOUT", "3.05")),
+    float(os.getenv("WECHAT_READ_TIMEOUT", "10")),
+)
+
+# 默认重试次数，单个接口可以在 API_CONFIGS 中用 retries 覆盖；重试使用相同的请求包体(相同的商户单号)，只重新签名
+DEFAULT_RETRIES = 1
+
+# 可以重试的 HTTP 状态码，以及首次重试前的等待时间(秒)，之后按指数增长
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_BACKOFF = 0.2
 
 
 class WeChatPayBase:
     """微信支付基础类，处理公共功能"""
 
-    def __init__(self):
-        # 从环境变量获取配置信息
-        self.mch_id = os.getenv("WECHAT_MCH_ID")
-        self.app_id = os.getenv("WECHAT_APP_ID")
-        self.app_secret = os.getenv("WECHAT_APP_SECRET")
-        self.api_key = os.getenv("WECHAT_API_KEY")
-        self.api_v3_key = os.getenv("WECHAT_API_V3_KEY")
-        self.private_key_path = os.getenv("WECHAT_PRIVATE_KEY_PATH")
-        self.serial_no = os.getenv("WECHAT_CERT_SERIAL_NO")
-        self.platform_cert_path = os.getenv("WECHAT_PAY_PLAT_CERT_PATH")
-        self.platform_cert = None
-        self.private_key = None
-        logger.info("初始化微信支付配置")
+    # 接口配置，子类按业务覆盖，参考 services/pay/constants.py
+    API_CONFIGS = {}
+
+    def __init__(self, merchant=None, rate_limiter=None):
+        """
+        Args:
+            merchant (dict, optional): 商户配置，字段见 services/merchant.py 中的 MERCHANT_FIELDS，
+                不传时从环境变量读取单商户配置
+            rate_limiter (RateLimiter, optional): 商户共用的限流器（由 MerchantRegistry 按商户号提供），
+                不传时按配置的 rate_limit 创建
+        """
+        merchant = merchant if merchant is not None else merchant_from_env()
+        self.mch_id = merchant.get("mch_id")
+        self.app_id = merchant.get("app_id")
+        self.app_secret = merchant.get("app_secret")
+        self.api_key = merchant.get("api_key")
+        self.api_v3_key = merchant.get("api_v3_key")
+        self.private_key_path = merchant.get("private_key_path")
+        self.serial_no = merchant.get("serial_no")
+        self.platform_cert_path = merchant.get("platform_cert_path")
+        self.platform_serial_no = merchant.get("platform_serial_no")
+        self.notify_url = merchant.get("notify_url") or os.getenv("NOTIFY_URL")
+        self.api_base = (merchant.get("api_base") or os.getenv("WECHAT_PAY_API_BASE", DEFAULT_API_BASE)).rstrip("/")
+        # 备用域名: 未配置时只有使用默认主域名才启用微信支付的备用域名，配置为空字符串时不启用
+        api_backup_base = merchant.get("api_backup_base")
+        if api_backup_base is None:
+            api_backup_base = os.getenv(
+                "WECHAT_PAY_API_BACKUP_BASE", DEFAULT_BACKUP_API_BASE if self.api_base == DEFAULT_API_BASE else ""
+            )
+        self.endpoints = endpoint_set([self.api_base, api_backup_base])
+        if rate_limiter is None and merchant.get("rate_limit"):
+            rate_limiter = RateLimiter(merchant["rate_limit"])
+        self.rate_limiter = rate_limiter
+        self.pool_size = int(merchant.get("pool_size") or DEFAULT_POOL_SIZE)
+        self._http = None
+        self._aesgcm = None
+        logger.info("初始化微信支付配置，商户号: {}", self.mch_id)
         # 验证必要的配置是否存在
         self._validate_config()
 
@@ -40,17 +89,39 @@ class WeChatPayBase:
         # 加载微信支付平台证书
         self._load_platform_cert()
 
+    @property
+    def private_key(self):
+        """商户私钥，从共享的 LRU 缓存中获取，被淘汰后重新从文件加载"""
+        return KEY_CACHE.get(self.private_key_path)
+
+    @property
+    def platform_cert(self):
+        """微信支付平台证书公钥"""
+        return KEY_CACHE.get(self.platform_cert_path)
+
+    @property
+    def http(self):
+        """商户独立的连接池，首次请求时创建"""
+        if self._http is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._http = session
+        return self._http
+
     def _load_platform_cert(self):
         """加载微信支付平台证书"""
         try:
-            platform_cert_path = os.getenv("WECHAT_PAY_PLAT_CERT_PATH")
-            if not platform_cert_path:
+            if not self.platform_cert_path:
                 error_msg = "缺少微信支付平台证书路径配置: WECHAT_PAY_PLAT_CERT_PATH"
                 logger.error(error_msg)
                 raise ValueError(error_msg)
 
-            with open(platform_cert_path) as f:
-                self.platform_cert = RSA.import_key(f.read())
+            KEY_CACHE.get(self.platform_cert_path)
             logger.info("成功加载微信支付平台证书")
         except Exception as e:
             error_msg = f"加载微信支付平台证书失败: {str(e)}"
@@ -71,15 +142,14 @@ class WeChatPayBase:
         missing_configs = [name for name, value in required_configs if not value]
 
         if missing_configs:
-            error_msg = f"缺少必要的配置项: {', '.join(missing_configs)}\n请确保在.env文件中配置了所有必要的环境变量"
+            error_msg = f"缺少必要的配置项: {', '.join(missing_configs)}\n请确保在.env文件或商户配置中配置了所有必要的字段"
             logger.error(error_msg)
             raise ValueError(error_msg)
 
     def _load_private_key(self):
         """加载商户私钥"""
         try:
-            with open(self.private_key_path) as f:
-                self.private_key = RSA.import_key(f.read())
+            KEY_CACHE.get(self.private_key_path)
             logger.info("成功加载商户私钥")
         except Exception as e:
             error_msg = f"加载商户私钥失败: {str(e)}"
@@ -88,20 +158,103 @@ class WeChatPayBase:
 
     def generate_sign(self, method, url_path, body):
         """生成请求签名"""
+        from Crypto.Hash import SHA256
+        from Crypto.Signature import pkcs1_15
+
         timestamp = str(int(time.time()))
         nonce = "".join(random.choice(string.ascii_letters + string.digits) for _ in range(32))
 
         body_str = body if body else ""
         message = f"{method}\n{url_path}\n{timestamp}\n{nonce}\n{body_str}\n"
 
-        logger.debug(f"待签名字符串: {message}")
+        logger.debug("待签名字符串: {}", payload(message))
 
-        message_hash = SHA256.new(message.encode("utf-8"))
-        signature = pkcs1_15.new(self.private_key).sign(message_hash)
-        sign = b64encode(signature).decode("utf-8")
+        with start_span("wechatpay.sign", method=method):
+            message_hash = SHA256.new(message.encode("utf-8"))
+            signature = pkcs1_15.new(self.private_key).sign(message_hash)
+            sign = b64encode(signature).decode("utf-8")
 
         return {"timestamp": timestamp, "nonce": nonce, "signature": sign}
 
+    def verify_notification(self, notification):
+        """用平台证书验证回调通知的签名
+
+        Args:
+            notification (Notification): 见 services/notification.py，同一通知对同一证书只验签一次
+        """
+        from Crypto.Signature import pkcs1_15
+
+        logger.info(
+            "收到回调通知头部信息: timestamp={}, nonce={}, serial_no={}",
+            notification.timestamp,
+            notification.nonce,
+            notification.serial_no,
+        )
+        if not notification.complete:
+            logger.error("回调通知缺少必要的头部信息")
+            return False
+
+        def verify(digest):
+            try:
+                with timed("verify", "notify"), start_span("wechatpay.notify.verify", serial_no=notification.serial_no):
+                    pkcs1_15.new(cert).verify(digest, b64decode(notification.signature))
+                return True
+            except Exception as e:
+                logger.error("验证签名失败: {}", e)
+                return False
+
+        try:
+            # 微信支付平台证书，按商户缓存在 KEY_CACHE 中
+            cert = self.platform_cert
+        except Exception as e:
+            logger.error("加载平台证书失败: {}", e)
+            return False
+        verified = notification.verified_by(cert, verify)
+        if verified:
+            logger.info("签名验证成功")
+        return verified
+
+    def decrypt_resource(self, notification):
+        """解密回调通知的 resource，明文(bytes)保存到 notification.plaintext 并返回，失败时返回 None"""
+        try:
+            with timed("json_decode", "notify"):
+                envelope = notification.envelope
+            resource = envelope.get("resource") or {}
+            associated_data = resource.get("associated_data")
+            with timed("decrypt", "notify"), start_span("wechatpay.notify.decrypt"):
+                notification.plaintext = self._notify_cipher.decrypt(
+                    resource["nonce"].encode("utf-8"),
+                    b64decode(resource["ciphertext"]),
+                    associated_data.encode("utf-8") if associated_data else b"",
+                )
+            return notification.plaintext
+        except Exception as e:
+            logger.error("解密回调数据失败: {}", e)
+            return None
+
+    def decrypt_notification(self, notification):
+        """解密回调通知的 resource，返回明文 dict（外层的 event_type 合并到结果中），失败时返回 None"""
+        plaintext = self.decrypt_resource(notification)
+        if plaintext is None:
+            return None
+        try:
+            result = json_loads(plaintext)
+            # event_type 位于通知外层，合并到解密结果中，便于按事件类型分发
+            result.setdefault("event_type", notification.event_type)
+            return result
+        except Exception as e:
+            logger.error("解密回调数据失败: {}", e)
+            return None
+
+    @property
+    def _notify_cipher(self):
+        """APIv3 密钥对应的 AEAD_AES_256_GCM 实例，解密回调通知时复用"""
+        if self._aesgcm is None:
+            from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+            self._aesgcm = AESGCM(self.api_v3_key.encode("utf-8"))
+        return self._aesgcm
+
     def decrypt_sensitive_data(self, ciphertext, nonce, associated_data):
         """解密微信支付敏感数据
 
@@ -113,6 +266,8 @@ class WeChatPayBase:
         Returns:
             dict: 解密后的明文数据
         """
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
         try:
             # 将密文、随机串、附加数据转换为bytes
             key_bytes = self.api_v3_key.encode("utf-8")
@@ -126,7 +281,7 @@ class WeChatPayBase:
 
             # 将明文转换为字典
             plaintext = plaintext_bytes.decode("utf-8")
-            logger.debug(f"解密得到明文: {plaintext}")
+            logger.debug("解密得到明文: {}", payload(plaintext))
             return json.loads(plaintext)
 
         except Exception as e:
@@ -143,6 +298,8 @@ class WeChatPayBase:
         Returns:
             dict: 包含密文、随机串、附加数据的字典
         """
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
         try:
             # 生成随机串
             nonce = "".join(random.choice(string.ascii_letters + string.digits) for _ in range(16))
@@ -161,7 +318,7 @@ class WeChatPayBase:
 
             result = {"ciphertext": ciphertext_b64, "nonce": nonce, "associated_data": None}
 
-            logger.debug(f"加密结果: {result}")
+            logger.debug("加密结果: {}", payload(result))
             return result
 
         except Exception as e:
@@ -169,12 +326,37 @@ class WeChatPayBase:
             logger.error(error_msg)
             raise ValueError(error_msg)
 
+    def _call_api(self, api_name, data=None, additional_headers=None, **path_params):
+        """
+        按 API_CONFIGS 中的配置调用微信支付API
+
+        Args:
+            api_name (str): API_CONFIGS 中的接口名称，例如 'create_native_order'
+            data (dict, optional): POST请求的数据
+            path_params: 用于填充接口路径中的占位符，例如 out_trade_no
+
+        Returns:
+            tuple: (response_status_code, response_data)
+        """
+        api_config = self.API_CONFIGS[api_name]
+        api_path = api_config["path"].format(**path_params)
+        return self._make_request(
+            api_config["method"],
+            api_path,
+            data=data,
+            additional_headers=additional_headers,
+            api_name=api_name,
+            path_ids=path_params,
+        )
+
     def _make_request(
         self,
         method,
         api_path,
         data=None,
         additional_headers=None,
+        api_name="unknown",
+        path_ids=None,
     ):
         """
         发送请求到微信支付API的通用方法
@@ -183,55 +365,237 @@ class WeChatPayBase:
             method (str): 请求方法，'GET' 或 'POST'
             api_path (str): API路径，例如 '/v3/fund-app/mch-transfer/transfer-bills'
             data (dict, optional): POST请求的数据
+            api_name (str, optional): 接口名称，用于指标统计
+            path_ids (dict, optional): 接口路径中的商户单号等参数，用于链路追踪和审计日志
 
         Returns:
             tuple: (response_status_code, response_data)
         """
+        path_ids = path_ids or {}
+        ids = {}
+        for name in ID_FIELDS:
+            value = (data or {}).get(name) or path_ids.get(name)
+            if value:
+                ids[name] = value
+        exchange = Exchange(api_name, method, self.mch_id, ids)
+        status, result = self._send(method, api_path, data, additional_headers, api_name, exchange)
+        exchange.finish(status, result)
+        log = audit_log()
+        if log is not None:
+            log.append(exchange)
+        return status, result
+
+    def _send(self, method, api_path, data, additional_headers, api_name, exchange):
+        """发送请求（含签名、限流、重试），调用过程记录在 exchange 中"""
+        with start_span(
+            "wechatpay.request",
+            api=api_name,
+            method=method,
+            mch_id=self.mch_id,
+            out_trade_no=exchange.ids.get("out_trade_no"),
+            out_bill_no=exchange.ids.get("out_bill_no"),
+            out_refund_no=exchange.ids.get("out_refund_no"),
+        ) as span:
+            try:
+                # 序列化请求包体，签名和每次重试都使用同一份字符串
+                with timed("json_encode", api_name):
+                    body_str = json.dumps(data) if data else ""
+                exchange.request = body_bytes = body_str.encode("utf-8")
+
+                api_config = self.API_CONFIGS.get(api_name, {})
+                timeout = api_config.get("timeout", DEFAULT_TIMEOUT)
+                retries = api_config.get("retries", DEFAULT_RETRIES)
+                hedge = api_config.get("hedge") and self.endpoints.can_hedge
+
+                for attempt in range(retries + 1):
+                    if deadline.expired():
+                        return self._request_failed(span, api_name, deadline.DEADLINE_EXCEEDED)
+
+                    # 每次尝试重新选择域名，失败后的重试可以发往备用域名
+                    endpoint = self.endpoints.choose()
+                    headers = self._build_headers(method, api_path, body_str, api_name, additional_headers)
+
+                    # 按商户限流，等待超时（不超过请求剩余时间）则不发出请求
+                    left = deadline.remaining()
+                    wait = RATE_LIMIT_WAIT if left is None else min(RATE_LIMIT_WAIT, max(left, 0))
+                    if self.rate_limiter is not None and not self.rate_limiter.acquire(wait):
+                        logger.warning("商户 {} 请求频率超过限制 {}/s", self.mch_id, self.rate_limiter.rate)
+                        span.set_error("rate limited")
+                        record_api_result(api_name, "rate_limited", None)
+                        return None, {"code": "FREQUENCY_LIMITED", "message": "商户请求频率超过本地限制"}
+
+                    request_timeout = deadline.clip_timeout(timeout)
+                    if hedge:
+                        endpoint, response, error, total = self._request_hedged(
+                            endpoint,
+                            method,
+                            api_path,
+                            headers,
+                            body_str,
+                            body_bytes,
+                            request_timeout,
+                            api_name,
+                            additional_headers,
+                        )
+                    else:
+                        response, error, total = self._request_once(
+                            endpoint, method, api_path, headers, body_bytes, request_timeout
+                        )
+
+                    if error is not None:
+                        code = deadline.classify(error)
+                        if code is None:
+                            raise error
+                        if deadline.expired():
+                            code = deadline.DEADLINE_EXCEEDED
+                        # 下一次尝试会发往另一个域名时不等待
+                        elif attempt < retries and (self.endpoints.choose() is not endpoint or self._backoff(attempt)):
+                            logger.warning(
+                                "请求失败，使用相同参数重试 - 接口: {}, 域名: {}, 错误: {}", api_name, endpoint.base, code
+                            )
+                            continue
+                        return self._request_failed(span, api_name, code, error)
+
+                    # elapsed 为收到响应头的耗时，其余为读取响应体的耗时
+                    connect = response.elapsed.total_seconds()
+                    exchange.received(response, attempt, connect, total)
+                    observe_stage("http_connect", api_name, connect)
+                    observe_stage("http_transfer", api_name, max(total - connect, 0.0))
+                    if (
+                        response.status_code in RETRY_STATUS_CODES
+                        and attempt < retries
+                        and (
+                            (response.status_code >= 500 and self.endpoints.choose() is not endpoint)
+                            or self._backoff(attempt, response.headers.get("Retry-After"))
+                        )
+                    ):
+                        logger.warning(
+                            "请求响应状态码 {}，使用相同参数重试 - 接口: {}, 域名: {}",
+                            response.status_code,
+                            api_name,
+                            endpoint.base,
+                        )
+                        record_api_result(api_name, response.status_code, None)
+                        continue
+                    break
+
+                # 记录响应结果，Request-Id 用于与微信支付侧排查问题
+                span.set_attributes(
+                    request_id=response.headers.get("Request-Id"),
+                    status_code=response.status_code,
+                    attempts=attempt + 1,
+                    endpoint=endpoint.base,
+                )
+                if response.status_code >= 400:
+                    span.set_error()
+                logger.info("请求响应状态码: {}", response.status_code)
+                with timed("json_decode", api_name):
+                    result = response.json() if response.content else {}
+                logger.info("请求响应内容: {}", payload(result))
+                record_api_result(api_name, response.status_code, result)
+
+                return response.status_code, result
+
+            except Exception as e:
+                logger.exception(f"请求处理异常: {str(e)}")
+                span.record_exception(e)
+                record_api_result(api_name, None, None)
+                return None, {"message": str(e)}
+
+    def _request_once(self, endpoint, method, api_path, headers, body_bytes, timeout):
+        """向一个域名发出请求，返回 (response, 异常, 耗时)，并记录上游与该域名的健康状况"""
+        UPSTREAM.begin(self.mch_id, self.pool_size)
+        token = self.endpoints.begin(endpoint)
+        started = time.perf_counter()
         try:
-            # 生成请求签名
-            sign_data = self.generate_sign(
+            response = self.http.request(
                 method,
-                api_path,
-                json.dumps(data) if data else "",
+                f"{endpoint.base}{api_path}",
+                headers=headers,
+                data=body_bytes or None,
+                timeout=timeout,
             )
-
-            # 构造请求头
-            headers = {
-                "Accept": "application/json",
-                "Authorization": (
-                    f'WECHATPAY2-SHA256-RSA2048 mchid="{self.mch_id}",'
-                    f'nonce_str="{sign_data["nonce"]}",'
-                    f'timestamp="{sign_data["timestamp"]}",'
-                    f'serial_no="{self.serial_no}",'
-                    f'signature="{sign_data["signature"]}"'
-                ),
-            }
-
-            # POST请求需要添加Content-Type
-            if method == "POST":
-                headers["Content-Type"] = "application/json"
-
-            # 构造完整URL
-            base_url = "https://api.mch.weixin.qq.com"
-            url = f"{base_url}{api_path}"
-
-            # 添加额外的请求头
-            if additional_headers:
-                headers.update(additional_headers)
-
-            # 发送请求
-            if method == "GET":
-                response = requests.get(url, headers=headers)
-            else:
-                response = requests.post(url, headers=headers, json=data)
-
-            # 记录响应结果
-            logger.info(f"请求响应状态码: {response.status_code}")
-            result = response.json() if response.content else {}
-            logger.info(f"请求响应内容: {result}")
-
-            return response.status_code, result
-
         except Exception as e:
-            logger.exception(f"请求处理异常: {str(e)}")
-            return None, {"message": str(e)}
+            seconds = time.perf_counter() - started
+            UPSTREAM.end(self.mch_id, seconds, True)
+            self.endpoints.end(endpoint, token, seconds, True)
+            return None, e, seconds
+        seconds = time.perf_counter() - started
+        failed = response.status_code >= 500
+        UPSTREAM.end(self.mch_id, seconds, failed)
+        self.endpoints.end(endpoint, token, seconds, failed)
+        return response, None, seconds
+
+    def _request_hedged(
+        self, endpoint, method, api_path, headers, body_str, body_bytes, timeout, api_name, additional_headers
+    ):
+        """幂等查询的对冲请求: 超过 HEDGE_AFTER 未返回时向另一个域名再发一次，返回 (域名, response, 异常, 耗时)"""
+        pool = hedge_pool()
+        first = pool.try_submit(self._request_once, endpoint, method, api_path, headers, body_bytes, timeout)
+        if first is None:
+            return (endpoint, *self._request_once(endpoint, method, api_path, headers, body_bytes, timeout))
+        done, _ = concurrent.futures.wait([first], timeout=self.endpoints.hedge_after)
+        alternate = None if done else self.endpoints.choose(exclude=endpoint)
+        # 对冲请求同样受商户限流约束，没有空闲令牌时不对冲
+        if alternate is None or (self.rate_limiter is not None and not self.rate_limiter.acquire(0)):
+            return (endpoint, *first.result())
+
+        # 对冲请求单独签名(不同的随机串)
+        hedge_headers = self._build_headers(method, api_path, body_str, api_name, additional_headers)
+        second = pool.try_submit(self._request_once, alternate, method, api_path, hedge_headers, body_bytes, timeout)
+        if second is None:
+            return (endpoint, *first.result())
+        logger.info(
+            "请求超过 {}ms 未返回，向 {} 发出对冲请求 - 接口: {}", self.endpoints.hedge_after * 1000, alternate.base, api_name
+        )
+        targets = {first: endpoint, second: alternate}
+        future, (response, error, seconds) = first_success(
+            targets, lambda result: result[1] is None and result[0].status_code < 500
+        )
+        self.endpoints.record_hedge(endpoint, future is second)
+        return targets[future], response, error, seconds
+
+    def _build_headers(self, method, api_path, body_str, api_name, additional_headers=None):
+        """生成签名并构造请求头，每次重试重新签名"""
+        with timed("sign", api_name):
+            sign_data = self.generate_sign(method, api_path, body_str)
+
+        headers = {
+            "Accept": "application/json",
+            "Authorization": (
+                f'WECHATPAY2-SHA256-RSA2048 mchid="{self.mch_id}",'
+                f'nonce_str="{sign_data["nonce"]}",'
+                f'timestamp="{sign_data["timestamp"]}",'
+                f'serial_no="{self.serial_no}",'
+                f'signature="{sign_data["signature"]}"'
+            ),
+        }
+
+        # POST请求需要添加Content-Type
+        if method == "POST":
+            headers["Content-Type"] = "application/json"
+
+        # 添加额外的请求头
+        if additional_headers:
+            headers.update(additional_headers)
+        return headers
+
+    @staticmethod
+    def _backoff(attempt, retry_after=None):
+        """重试前等待，剩余时间不够等待并完成一次请求时返回 False"""
+        delay = RETRY_BACKOFF * (2**attempt)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        left = deadline.remaining()
+        if left is not None and left <= delay:
+            return False
+        time.sleep(delay)
+        return True
+
+    @staticmethod
+    def _request_failed(span, api_name, code, exc=None):
+        """超时、连接失败或截止时间已到，返回分类后的错误"""
+        logger.error("请求微信支付失败 - 接口: {}, 错误: {}, 详情: {}", api_name, code, exc)
+        span.set_error(code)
+        record_api_result(api_name, code.lower(), None)
+        return None, deadline.error_result(code, exc and type(exc).__name__)
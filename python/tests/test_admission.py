@@ -0,0 +1,59 @@
+import threading
+import time
+
+import pytest
+
+from services.admission import ADMITTED, QUEUE_FULL, TIMED_OUT, Admission, Bulkhead, Overloaded
+
+
+def test_acquire_up_to_limit_then_shed():
+    bulkhead = Bulkhead("route", limit=2, queue_limit=0)
+    assert bulkhead.acquire(1) == ADMITTED
+    assert bulkhead.acquire(1) == ADMITTED
+    assert bulkhead.acquire(1) == QUEUE_FULL
+    bulkhead.release(0.1)
+    assert bulkhead.acquire(0) == ADMITTED
+    assert bulkhead.stats() == {"limit": 2, "active": 2, "waiting": 0, "admitted": 3, "shed": 1, "timed_out": 0}
+
+
+def test_queued_request_times_out():
+    bulkhead = Bulkhead("route", limit=1, queue_limit=1)
+    assert bulkhead.acquire(0) == ADMITTED
+    assert bulkhead.acquire(0.01) == TIMED_OUT
+    assert bulkhead.waiting == 0 and bulkhead.timed_out == 1
+
+
+def test_release_wakes_queued_request():
+    bulkhead = Bulkhead("route", limit=1, queue_limit=1)
+    bulkhead.acquire(0)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(bulkhead.acquire(5)))
+    thread.start()
+    while bulkhead.waiting == 0:
+        time.sleep(0.001)
+    # 队列已满时新请求直接被拒绝
+    assert bulkhead.acquire(5) == QUEUE_FULL
+    bulkhead.release(0.2)
+    thread.join()
+    assert results == [ADMITTED]
+    assert bulkhead.active == 1
+
+
+def test_retry_after_uses_service_time():
+    bulkhead = Bulkhead("route", limit=2, queue_limit=2)
+    bulkhead.acquire(0)
+    bulkhead.release(4.0)
+    assert bulkhead.retry_after() == 2
+
+
+def test_admission_releases_route_when_shared_pool_is_full():
+    admission = Admission({"/pay": 2}, capacity=2, notify_reserved=1, queue_timeout=0)
+    held = admission.enter("/pay")
+    assert [bulkhead.name for bulkhead in held] == ["/pay", "shared"]
+    with pytest.raises(Overloaded) as error:
+        admission.enter("/pay")
+    assert error.value.bulkhead is admission.shared
+    # 共享池满时已占用的路由名额被归还
+    assert admission.routes["/pay"].active == 1
+    Admission.leave(held, 0.1)
+    assert admission.shared.active == 0 and admission.routes["/pay"].active == 0
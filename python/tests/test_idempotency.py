@@ -0,0 +1,130 @@
+import threading
+
+import pytest
+from flask import Flask, request
+
+from services.idempotency import (
+    BEGIN,
+    BUSY,
+    DONE,
+    MISMATCH,
+    MemoryIdempotencyStore,
+    SQLiteIdempotencyStore,
+    _request_key,
+)
+
+RESPONSE = (200, {"Content-Type": "application/json"}, b'{"code": 0}')
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryIdempotencyStore()
+    return SQLiteIdempotencyStore(str(tmp_path / "idempotency.db"))
+
+
+def test_begin_then_complete_replays_response(store):
+    assert store.begin("k1", "f1", wait=0) == (BEGIN, None)
+    store.complete("k1", RESPONSE, ttl=60)
+    outcome, stored = store.begin("k1", "f1", wait=0)
+    assert outcome == DONE
+    assert stored[0] == 200 and stored[2] == RESPONSE[2]
+    assert store.stats()["replays"] == 1
+
+
+def test_same_key_with_different_body_is_rejected(store):
+    store.begin("k1", "f1", wait=0)
+    store.complete("k1", RESPONSE, ttl=60)
+    assert store.begin("k1", "f2", wait=0) == (MISMATCH, None)
+
+
+def test_in_flight_key_is_busy_until_completed(store):
+    store.begin("k1", "f1", wait=0)
+    assert store.begin("k1", "f1", wait=0) == (BUSY, None)
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(store.begin("k1", "f1", wait=5)))
+    waiter.start()
+    store.complete("k1", RESPONSE, ttl=60)
+    waiter.join()
+    assert results[0][0] == DONE
+
+
+def test_release_lets_the_key_be_retried(store):
+    store.begin("k1", "f1", wait=0)
+    store.release("k1")
+    assert store.begin("k1", "f1", wait=0) == (BEGIN, None)
+
+
+def test_expired_response_starts_over(store):
+    store.begin("k1", "f1", wait=0)
+    store.complete("k1", RESPONSE, ttl=-1)
+    assert store.begin("k1", "f2", wait=0) == (BEGIN, None)
+
+
+def request_key(body_window, headers=None, cookie=None):
+    app = Flask(__name__)
+    environ = {"REMOTE_ADDR": "10.0.0.1"}
+    if cookie:
+        environ["HTTP_COOKIE"] = f"session={cookie}"
+    with app.test_request_context(
+        "/create_native_order", method="POST", json={"amount": 1}, headers=headers, environ_base=environ
+    ):
+        return _request_key(request, "session", body_window)
+
+
+def test_request_key_prefers_header():
+    key, ttl = request_key(60, headers={"Idempotency-Key": "abc"})
+    assert key == "/create_native_order::key:abc" and ttl is None
+
+
+def test_request_key_is_not_derived_without_session():
+    assert request_key(60) == (None, None)
+    assert request_key(0, cookie="s1") == (None, None)
+
+
+def test_request_key_is_scoped_by_session():
+    key, ttl = request_key(60, cookie="s1")
+    assert ttl == 60
+    assert key != request_key(60, cookie="s2")[0]
+
+
+def make_app(monkeypatch, outcomes, admission=None):
+    from flask import jsonify
+
+    from services.idempotency import install_idempotency
+
+    monkeypatch.setenv("IDEMPOTENCY_BACKEND", "memory")
+    app = Flask(__name__)
+    calls = []
+
+    @app.route("/create_native_order", methods=["POST"])
+    def create_native_order():
+        calls.append(1)
+        return jsonify(outcomes[len(calls) - 1])
+
+    store = install_idempotency(app, admission)
+    return app.test_client(), calls, store
+
+
+def test_unknown_outcome_is_not_replayed(monkeypatch):
+    client, calls, _ = make_app(monkeypatch, [{"code": -1, "msg": "请求超时"}, {"code": 0}, {"code": 0}])
+    headers = {"Idempotency-Key": "k1"}
+    assert client.post("/create_native_order", json={"amount": 1}, headers=headers).json["code"] == -1
+    # 结果未知的应答不保存，用同一个键重试会重新处理，之后的成功应答被保存
+    assert client.post("/create_native_order", json={"amount": 1}, headers=headers).json["code"] == 0
+    replayed = client.post("/create_native_order", json={"amount": 1}, headers=headers)
+    assert replayed.headers["Idempotent-Replayed"] == "true"
+    assert len(calls) == 2
+
+
+def test_wait_is_capped_by_admission_queue_timeout(monkeypatch):
+    from types import SimpleNamespace
+
+    monkeypatch.setenv("IDEMPOTENCY_WAIT", "30")
+    waits = []
+    client, _, store = make_app(monkeypatch, [{"code": 0}], SimpleNamespace(queue_timeout=0.5))
+    begin = store.begin
+    store.begin = lambda key, fingerprint, wait: waits.append(wait) or begin(key, fingerprint, wait)
+    client.post("/create_native_order", json={"amount": 1}, headers={"Idempotency-Key": "k1"})
+    assert waits == [0.5]
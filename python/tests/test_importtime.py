@@ -0,0 +1,20 @@
+import json
+import platform
+
+import pytest
+
+from bench.importtime import DEFAULT_BASELINE, eager_lazy_modules, measure, measure_once
+
+
+def test_slow_dependencies_are_imported_lazily():
+    assert eager_lazy_modules(measure_once()) == []
+
+
+def test_import_app_within_budget():
+    with open(DEFAULT_BASELINE) as f:
+        baseline = json.load(f)
+    # 耗时预算只对测量基线的环境有意义
+    if (baseline["python"], baseline["machine"]) != (platform.python_version(), platform.machine()):
+        pytest.skip("基线来自不同的 Python 版本或机器")
+    import_ms, _ = measure(runs=3)
+    assert import_ms <= baseline["budget_ms"]
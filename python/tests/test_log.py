@@ -0,0 +1,34 @@
+import pytest
+
+from services import log
+from services.log import _current_sampled, payload
+
+
+@pytest.fixture
+def full_payloads(monkeypatch):
+    monkeypatch.setitem(log._settings, "full_payloads", True)
+    token = _current_sampled.set(True)
+    yield
+    _current_sampled.reset(token)
+
+
+def test_full_mode_redacts_sensitive_fields(full_payloads):
+    text = str(payload({"openid": "oUpF8uMuAJO_M2pxb1Q9zNjWeS6o", "code": "PARAM_ERROR"}))
+    assert "oUpF***" in text and "M2pxb1Q9" not in text
+    # 微信支付的错误码不脱敏
+    assert "PARAM_ERROR" in text
+
+
+@pytest.mark.parametrize("value", ["oUpF8uMuAJO_M2pxb1Q9zNjWeS6o", b"061Ab2ll2Ykqvd4wJ3ml2e7Bq84Ab2lj", '"0a1b2c3d4e5f"'])
+def test_full_mode_masks_scalars(full_payloads, value):
+    text = str(payload(value))
+    assert text.endswith("***") and len(text) <= 8
+
+
+def test_unsampled_request_only_logs_size(monkeypatch):
+    monkeypatch.setitem(log._settings, "full_payloads", True)
+    token = _current_sampled.set(False)
+    try:
+        assert str(payload("oUpF8uMuAJO_M2pxb1Q9zNjWeS6o")) == "<28 chars>"
+    finally:
+        _current_sampled.reset(token)
@@ -0,0 +1,65 @@
+import threading
+import time
+
+from services.merchant import MerchantRegistry
+
+MCH_A = "1900000001"
+MCH_B = "1900000002"
+
+
+class FakeClient:
+    def __init__(self, merchant, rate_limiter=None):
+        self.mch_id = merchant["mch_id"]
+        self.rate_limiter = rate_limiter
+
+
+class FakeTransfer(FakeClient):
+    pass
+
+
+def make_registry(max_clients=8):
+    merchants = [{"mch_id": MCH_A, "rate_limit": 5}, {"mch_id": MCH_B, "rate_limit": 5}]
+    return MerchantRegistry(merchants, default_mch_id=MCH_A, max_clients=max_clients)
+
+
+def test_rate_limiter_is_shared_across_clients_and_evictions():
+    registry = make_registry(max_clients=1)
+    pay = registry.client(FakeClient, MCH_A)
+    transfer = registry.client(FakeTransfer, MCH_A)
+    assert pay.rate_limiter is transfer.rate_limiter
+    # 淘汰后重新创建的客户端沿用原来的令牌桶
+    registry.client(FakeClient, MCH_B)
+    assert registry.client_stats()["evictions"] >= 1
+    assert registry.client(FakeClient, MCH_A) is not pay
+    assert registry.client(FakeClient, MCH_A).rate_limiter is pay.rate_limiter
+    assert registry.client(FakeClient, MCH_B).rate_limiter is not pay.rate_limiter
+
+
+def test_slow_client_creation_does_not_block_other_merchants():
+    registry = make_registry()
+    started = threading.Event()
+    release = threading.Event()
+    created = []
+
+    class SlowClient(FakeClient):
+        def __init__(self, merchant, rate_limiter=None):
+            created.append(merchant["mch_id"])
+            if merchant["mch_id"] == MCH_A:
+                started.set()
+                release.wait(5)
+            super().__init__(merchant, rate_limiter)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.client(SlowClient, MCH_A))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    assert started.wait(5)
+    begin = time.monotonic()
+    assert registry.client(SlowClient, MCH_B).mch_id == MCH_B
+    assert time.monotonic() - begin < 1
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    # 同一商户并发获取时只创建一次
+    assert created.count(MCH_A) == 1
+    assert len({id(client) for client in results}) == 1
@@ -0,0 +1,95 @@
+import sqlite3
+import time
+
+from services.pay.order_expiry import CLOSED, NOTPAY, RESCAN_INTERVAL, OrderExpiryScheduler, OrderStore
+
+MCH_A = "1900000001"
+MCH_B = "1900000002"
+
+
+def test_rescan_queues_orders_left_by_other_workers(tmp_path):
+    store = OrderStore(str(tmp_path / "orders.db"))
+    now = time.time()
+    # 其他 worker 创建、已过期的订单不在本进程的时间轮中
+    store.add(MCH_A, "T1", now - 7200 - RESCAN_INTERVAL * 2, now - RESCAN_INTERVAL * 2)
+    store.add(MCH_A, "T2", now - 7200 - RESCAN_INTERVAL * 2, now - RESCAN_INTERVAL * 2)
+    store.set_state(MCH_A, "T2", CLOSED)
+    # 刚过期的订单留给创建它的 worker
+    store.add(MCH_A, "T3", now - 7200, now - 1)
+
+    scheduler = OrderExpiryScheduler(store, ttl=7200, rate=1)
+    assert scheduler.rescan(now) == 1
+    assert scheduler.stats()["due"] == 1
+    # 已在关单队列中的订单不会重复加入
+    assert scheduler.rescan(now) == 0
+
+
+def test_rescan_skips_orders_tracked_by_this_worker(tmp_path):
+    store = OrderStore(str(tmp_path / "orders.db"))
+    scheduler = OrderExpiryScheduler(store, ttl=7200, rate=1)
+    scheduler.start = lambda: None
+    created_at = time.time() - 7200 - RESCAN_INTERVAL * 2
+    scheduler.track(MCH_A, "T1", created_at)
+    assert scheduler.rescan() == 0
+
+
+def test_same_out_trade_no_is_kept_per_merchant(tmp_path):
+    store = OrderStore(str(tmp_path / "orders.db"))
+    now = time.time()
+    store.add(MCH_A, "T1", now, now + 60)
+    store.add(MCH_B, "T1", now, now + 60)
+    store.set_state(MCH_A, "T1", CLOSED)
+    assert store.state(MCH_A, "T1") == CLOSED
+    assert store.state(MCH_B, "T1") == NOTPAY
+    assert store.claim([(MCH_A, "T1"), (MCH_B, "T1")]) == [(MCH_B, "T1")]
+
+
+def test_legacy_orders_table_is_rebuilt(tmp_path):
+    path = str(tmp_path / "orders.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE orders (out_trade_no TEXT PRIMARY KEY, mch_id TEXT, state TEXT NOT NULL, "
+        "created_at REAL NOT NULL, expire_at REAL, updated_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX idx_orders_state ON orders(state, expire_at)")
+    conn.execute("INSERT INTO orders VALUES ('T1', ?, 'SUCCESS', 1, 2, 3)", (MCH_A,))
+    conn.execute("INSERT INTO orders VALUES ('T2', NULL, 'NOTPAY', 1, 2, 3)")
+    conn.commit()
+    conn.close()
+
+    store = OrderStore(path)
+    assert store.state(MCH_A, "T1") == "SUCCESS"
+    assert store.state(None, "T2") == NOTPAY
+    indexes = [row[1] for row in store._conn().execute("PRAGMA index_list(orders)")]
+    assert "idx_orders_state" in indexes
+
+
+def test_failing_order_does_not_hold_up_the_batch(tmp_path, monkeypatch):
+    import services.pay.wechat_pay as wechat_pay
+
+    closed = []
+
+    class FakeClient:
+        def close_order(self, out_trade_no):
+            closed.append(out_trade_no)
+            return {"trade_state": CLOSED}
+
+    def get_wechat_pay(mch_id=None):
+        if mch_id == MCH_B:
+            raise ValueError(f"未配置的商户号: {mch_id}")
+        return FakeClient()
+
+    monkeypatch.setattr(wechat_pay, "get_wechat_pay", get_wechat_pay)
+    store = OrderStore(str(tmp_path / "orders.db"))
+    now = time.time()
+    store.add(MCH_B, "T1", now - 7200, now - 1)
+    store.add(MCH_A, "T2", now - 7200, now - 1)
+    scheduler = OrderExpiryScheduler(store, ttl=7200, rate=100)
+    scheduler._close_batch([(MCH_B, "T1"), (MCH_A, "T2")])
+
+    assert closed == ["T2"]
+    # 出错的订单释放 CLOSING 状态，稍后重试
+    assert store.state(MCH_B, "T1") == NOTPAY
+    assert (MCH_B, "T1") in scheduler._wheel
+    stats = scheduler.stats()
+    assert stats["closed"] == 1 and stats["failed"] == 1
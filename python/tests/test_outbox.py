@@ -0,0 +1,53 @@
+import time
+
+from services import outbox as outbox_module
+from services.outbox import DISPATCHING, DONE, PENDING, REFUND, RETRY, TRANSFER, OutboxStore
+
+
+def make_store(tmp_path):
+    store = OutboxStore(str(tmp_path / "outbox.db"))
+    store.enqueue(TRANSFER, "B1", "1900000001", {"openid": "o1", "amount": 100})
+    store.enqueue(REFUND, "R1", "1900000001", {"out_trade_no": "T1", "amount": 10})
+    return store
+
+
+def test_claim_leases_entries_once(tmp_path):
+    store = make_store(tmp_path)
+    batch = store.claim(10)
+    assert [entry["ref"] for entry in batch] == ["B1", "R1"]
+    assert all(entry["status"] == DISPATCHING and entry["attempts"] == 1 for entry in batch)
+    assert batch[0]["payload"] == {"openid": "o1", "amount": 100}
+    # 租约未到期的条目不会被重复领取
+    assert store.claim(10) == []
+
+
+def test_finish_records_result(tmp_path):
+    store = make_store(tmp_path)
+    entry = store.claim(1)[0]
+    assert store.finish(entry, DONE, {"state": "ACCEPTED"})
+    assert store.get("B1")["status"] == DONE
+    assert store.get("B1")["result"] == {"state": "ACCEPTED"}
+    assert store.counts() == {DONE: 1, PENDING: 1}
+
+
+def test_retry_is_claimed_again_when_due(tmp_path):
+    store = make_store(tmp_path)
+    entry = store.claim(1)[0]
+    store.finish(entry, RETRY, {"code": -1}, retry_at=time.time() - 1)
+    again = store.claim(1)[0]
+    assert again["ref"] == "B1" and again["attempts"] == 2
+
+
+def test_expired_lease_moves_to_new_owner(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    monkeypatch.setattr(outbox_module, "LEASE_SECONDS", -1)
+    stale = store.claim(1)[0]
+    current = store.claim(1)[0]
+    assert current["ref"] == stale["ref"] and current["attempts"] == stale["attempts"] + 1
+
+    # 原 worker 既不能续租，也不能覆盖新 worker 的结果
+    assert not store.renew(stale)
+    assert store.renew(current)
+    assert store.finish(current, DONE, {"state": "ACCEPTED"})
+    assert not store.finish(stale, RETRY, {"code": -1})
+    assert store.get("B1")["status"] == DONE
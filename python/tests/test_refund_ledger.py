@@ -0,0 +1,75 @@
+from services.pay.refund_ledger import CLOSED, FAILED, PROCESSING, SUCCESS, RefundLedger
+
+
+def make_ledger(tmp_path, total=100):
+    ledger = RefundLedger(str(tmp_path / "refund_ledger.db"))
+    ledger.record_order("T1", total)
+    return ledger
+
+
+def test_reserve_holds_balance(tmp_path):
+    ledger = make_ledger(tmp_path)
+    assert ledger.reserve("T1", "R1", 60) == (True, 40)
+    assert ledger.reserve("T1", "R2", 50) == (False, 40)
+    assert ledger.balance("T1") == {"total": 100, "refunded": 0, "reserved": 60, "refundable": 40}
+
+
+def test_reserve_is_idempotent_per_refund_no(tmp_path):
+    ledger = make_ledger(tmp_path)
+    assert ledger.reserve("T1", "R1", 60) == (True, 40)
+    assert ledger.reserve("T1", "R1", 60) == (True, 40)
+    # 同一退款单号换了金额视为冲突
+    assert ledger.reserve("T1", "R1", 10)[0] is False
+    assert ledger.balance("T1")["reserved"] == 60
+
+
+def test_reserve_rejects_unknown_order_and_bad_amount(tmp_path):
+    ledger = make_ledger(tmp_path)
+    assert ledger.reserve("T2", "R1", 10) == (False, 0)
+    assert ledger.reserve("T1", "R1", 0) == (False, 100)
+
+
+def test_settle_success_moves_reserved_to_refunded(tmp_path):
+    ledger = make_ledger(tmp_path)
+    ledger.reserve("T1", "R1", 60)
+    ledger.settle("R1", PROCESSING)
+    assert ledger.balance("T1")["reserved"] == 60
+    ledger.settle("R1", SUCCESS)
+    ledger.settle("R1", SUCCESS)
+    assert ledger.balance("T1") == {"total": 100, "refunded": 60, "reserved": 0, "refundable": 40}
+
+
+def test_settle_closed_releases_and_allows_retry(tmp_path):
+    ledger = make_ledger(tmp_path)
+    ledger.reserve("T1", "R1", 60)
+    ledger.settle("R1", CLOSED)
+    assert ledger.balance("T1")["refundable"] == 100
+    # 已结算的退款单不会被之后的通知改回
+    ledger.settle("R1", SUCCESS)
+    assert ledger.balance("T1")["refunded"] == 0
+    assert ledger.reserve("T1", "R1", 60) == (True, 40)
+
+
+def test_settle_response_keeps_reservation_when_result_unknown(tmp_path):
+    ledger = make_ledger(tmp_path)
+    ledger.reserve("T1", "R1", 30)
+    ledger.reserve("T1", "R2", 30)
+    ledger.settle_response("R1", 503, {})
+    ledger.settle_response("R2", 400, {"code": "PARAM_ERROR"})
+    assert ledger.balance("T1")["reserved"] == 30
+
+
+def test_settle_records_refund_missing_from_ledger(tmp_path):
+    ledger = RefundLedger(str(tmp_path / "refund_ledger.db"))
+    ledger.settle("R1", SUCCESS, out_trade_no="T9", amount=25, total=80)
+    assert ledger.balance("T9") == {"total": 80, "refunded": 25, "reserved": 0, "refundable": 55}
+
+
+def test_pending_refunds_claims_each_refund_once(tmp_path):
+    ledger = make_ledger(tmp_path)
+    ledger.reserve("T1", "R1", 10)
+    ledger.reserve("T1", "R2", 10)
+    ledger.settle("R2", FAILED)
+    assert ledger.pending_refunds(older_than=0) == [("R1", "T1")]
+    # 刚被取走的退款单在 older_than 秒内不会再返回
+    assert ledger.pending_refunds(older_than=60) == []
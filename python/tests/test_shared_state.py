@@ -0,0 +1,18 @@
+from services.shared_state import SharedStateTable, state_key
+
+
+def test_state_is_keyed_by_merchant(tmp_path):
+    table = SharedStateTable(str(tmp_path / "state.bin"), slots=64)
+    table.put(state_key("1900000001", "T1"), "SUCCESS")
+    assert table.get(state_key("1900000001", "T1"))[0] == "SUCCESS"
+    assert table.get(state_key("1900000002", "T1")) is None
+
+
+def test_non_ascii_or_long_keys_are_not_cached(tmp_path):
+    table = SharedStateTable(str(tmp_path / "state.bin"), slots=64)
+    table.put(state_key("1900000001", "订单1"), "SUCCESS")
+    assert table.get(state_key("1900000001", "订单1")) is None
+    long_key = state_key("1900000001", "T" * 64)
+    table.put(long_key, "SUCCESS")
+    assert table.get(long_key) is None
+    assert table.stats()["writes"] == 0
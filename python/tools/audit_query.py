@@ -0,0 +1,91 @@
+"""查询微信支付接口调用的审计日志(AUDIT_LOG_DIR)
+
+按商户单号查询时使用每天的索引，只读取命中的记录；不带 --id 时按条件扫描段文件。
+
+用法（在 python 目录下执行）:
+    python -m tools.audit_query --id 202401010000001234
+    python -m tools.audit_query --id B202401010000001234 --since 20240101 --bodies
+    python -m tools.audit_query --since 20240101 --until 20240131 --api create_transfer --status 500
+    python -m tools.audit_query --reindex 20240115
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.audit_log import DEFAULT_DIRECTORY, AuditReader, rebuild_index  # noqa: E402
+
+
+def _day(value):
+    """YYYYMMDD 或 YYYY-MM-DD"""
+    return datetime.datetime.strptime(value.replace("-", ""), "%Y%m%d").strftime("%Y%m%d")
+
+
+def _matches(record, args):
+    if args.api and record["api"] != args.api:
+        return False
+    if args.mch_id and record["mch_id"] != args.mch_id:
+        return False
+    if args.status is not None and record["status"] != args.status:
+        return False
+    if args.failed and record["status"] is not None and record["status"] < 400:
+        return False
+    return True
+
+
+def _format(record, reader, bodies):
+    if bodies:
+        for name in ("request_body", "response_body"):
+            record[name] = reader.body(record["day"], record[name]).decode("utf-8", "replace") or None
+    record["time"] = datetime.datetime.fromtimestamp(record["ts"]).isoformat(timespec="milliseconds")
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="查询微信支付接口调用审计日志")
+    parser.add_argument("--dir", default=os.getenv("AUDIT_LOG_DIR") or DEFAULT_DIRECTORY, help="审计日志目录")
+    parser.add_argument("--id", help="商户单号: out_trade_no / out_refund_no / out_bill_no")
+    parser.add_argument("--since", type=_day, help="起始日期(含)，YYYYMMDD")
+    parser.add_argument("--until", type=_day, help="结束日期(含)，YYYYMMDD")
+    parser.add_argument("--api", help="接口名称，例如 create_transfer")
+    parser.add_argument("--mch-id", help="商户号")
+    parser.add_argument("--status", type=int, help="HTTP 状态码")
+    parser.add_argument("--failed", action="store_true", help="只输出失败的调用(无应答或状态码 >= 400)")
+    parser.add_argument("--limit", type=int, default=100, help="扫描时最多输出的记录数")
+    parser.add_argument("--bodies", action="store_true", help="同时输出请求与应答包体")
+    parser.add_argument("--reindex", type=_day, metavar="DAY", help="按段文件重建该日期的索引")
+    args = parser.parse_args(argv)
+
+    if args.reindex:
+        print(f"重建完成，条目数: {rebuild_index(args.dir, args.reindex)}")
+        return 0
+
+    reader = AuditReader(args.dir)
+    started = time.perf_counter()
+    if args.id:
+        records = [record for record in reader.find(args.id, args.since, args.until) if _matches(record, args)]
+    else:
+        records = []
+        for day in reader.days(args.since, args.until):
+            for record in reader.scan(day):
+                if _matches(record, args):
+                    records.append(record)
+                    if len(records) >= args.limit:
+                        break
+            if len(records) >= args.limit:
+                break
+    elapsed = (time.perf_counter() - started) * 1000
+
+    for record in records:
+        print(json.dumps(_format(record, reader, args.bodies), ensure_ascii=False))
+    print(f"共 {len(records)} 条，查询耗时 {elapsed:.2f}ms", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
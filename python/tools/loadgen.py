@@ -0,0 +1,212 @@
+"""流量回放压测工具
+
+读取 ``services/traffic.py`` 录制的 JSON Lines 文件（或内置的请求组合），按目标 QPS 以开环方式
+回放到 app.py：请求按固定节奏发出，不等待前一个请求完成，延迟从计划发送时间开始计算，
+避免上游变慢时压测端自动降速而低估尾延迟。
+
+输出每个路由的请求数、错误数、吞吐量和 p50/p95/p99 延迟。路由对业务失败也返回 200，
+错误数同时统计 HTTP 状态码 >= 400、请求异常和 JSON 响应中 code 不为 0/"SUCCESS" 的请求。
+
+用法（在 python 目录下执行）:
+    python -m tools.loadgen --target http://127.0.0.1:5000 --input traffic.jsonl --qps 200 --duration 60
+    python -m tools.loadgen --target http://127.0.0.1:5000 --mix default --qps 50 --duration 30 --output report.json
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# 内置的请求组合: (权重, 方法, 路径, 请求体)
+MIXES = {
+    "default": [
+        (40, "POST", "/query_order", {"out_trade_no": "202401010000001234"}),
+        (20, "POST", "/create_native_order", {"amount": 1, "description": "压测商品"}),
+        (10, "POST", "/query_transfer", {"out_bill_no": "B202401010000001234"}),
+        (10, "GET", "/native_pay", None),
+        (10, "GET", "/", None),
+        (5, "POST", "/do_refund", {"out_trade_no": "202401010000001234", "amount": 1}),
+        (5, "POST", "/create_transfer", {"openid": "oUpF8uMuAJO_M2pxb1Q9zNjWeS6o", "amount": 100}),
+    ],
+}
+
+
+def load_recorded(path):
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if "method" in entry and "path" in entry:
+                entries.append(entry)
+    return entries
+
+
+def load_mix(name):
+    """按权重交错展开请求组合（平滑加权轮询），任意一段连续请求都接近目标比例"""
+    weighted = []
+    for weight, method, path, body in MIXES[name]:
+        entry = {"method": method, "path": path, "headers": {}}
+        if body is not None:
+            entry["body"] = json.dumps(body, ensure_ascii=False)
+            entry["headers"]["Content-Type"] = "application/json"
+        weighted.append([weight, 0, entry])
+    total = sum(item[0] for item in weighted)
+    entries = []
+    for _ in range(total):
+        for item in weighted:
+            item[1] += item[0]
+        best = max(weighted, key=lambda item: item[1])
+        best[1] -= total
+        entries.append(best[2])
+    return entries
+
+
+def _app_code(response):
+    """JSON 响应中的业务 code，非 JSON 或没有 code 时返回 None"""
+    if "json" not in response.headers.get("Content-Type", ""):
+        return None
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    return body.get("code") if isinstance(body, dict) else None
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class LoadResult:
+    """按路由汇总延迟与错误"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.status_codes = {}
+        self.app_codes = {}
+
+    def add(self, route, latency_ms, status, code=None):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(latency_ms)
+            key = f"{route} {status}"
+            self.status_codes[key] = self.status_codes.get(key, 0) + 1
+            failed = not isinstance(status, int) or status >= 400
+            if code is not None and code not in (0, "SUCCESS"):
+                failed = True
+                key = f"{route} code={code}"
+                self.app_codes[key] = self.app_codes.get(key, 0) + 1
+            if failed:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, elapsed):
+        rows = {}
+        for route, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            rows[route] = {
+                "count": len(values),
+                "errors": self.errors.get(route, 0),
+                "throughput_rps": round(len(values) / elapsed, 2),
+                "p50_ms": round(_percentile(values, 50), 2),
+                "p95_ms": round(_percentile(values, 95), 2),
+                "p99_ms": round(_percentile(values, 99), 2),
+                "max_ms": round(values[-1], 2),
+            }
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "routes": rows,
+            "status_codes": self.status_codes,
+            "app_codes": self.app_codes,
+        }
+
+
+def run(target, entries, qps, duration, concurrency, timeout):
+    result = LoadResult()
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    def send(entry, scheduled):
+        url = target.rstrip("/") + entry["path"]
+        if entry.get("query"):
+            url = f"{url}?{entry['query']}"
+        body = entry.get("body")
+        if body is None and entry.get("body_b64"):
+            body = b64decode(entry["body_b64"])
+        elif body is not None:
+            body = body.encode("utf-8")
+        try:
+            response = session().request(
+                entry["method"], url, data=body, headers=entry.get("headers"), timeout=timeout
+            )
+            status, code = response.status_code, _app_code(response)
+        except requests.RequestException as e:
+            status, code = type(e).__name__, None
+        # 延迟从计划发送时间开始计算，包含排队等待时间
+        result.add(entry["path"], (time.perf_counter() - scheduled) * 1000, status, code)
+
+    interval = 1.0 / qps
+    total = int(qps * duration)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i in range(total):
+            scheduled = started + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, entries[i % len(entries)], scheduled)
+    return result.report(time.perf_counter() - started)
+
+
+def print_report(report):
+    print(f"\n{'route':<24} {'count':>7} {'errors':>7} {'rps':>8} {'p50ms':>9} {'p95ms':>9} {'p99ms':>9}")
+    for route, row in report["routes"].items():
+        print(
+            f"{route:<24} {row['count']:>7} {row['errors']:>7} {row['throughput_rps']:>8} "
+            f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}"
+        )
+    print(f"\n耗时 {report['elapsed_s']}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="流量回放压测工具")
+    parser.add_argument("--target", default="http://127.0.0.1:5000", help="app.py 地址")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--input", help="录制的 JSON Lines 文件")
+    source.add_argument("--mix", choices=sorted(MIXES), default="default", help="内置请求组合")
+    parser.add_argument("--qps", type=float, default=50, help="目标 QPS(开环)")
+    parser.add_argument("--duration", type=float, default=30, help="压测时长(秒)")
+    parser.add_argument("--concurrency", type=int, default=64, help="最大并发请求数")
+    parser.add_argument("--timeout", type=float, default=30, help="单个请求超时(秒)")
+    parser.add_argument("--output", help="报告保存路径(JSON)")
+    args = parser.parse_args(argv)
+
+    entries = load_recorded(args.input) if args.input else load_mix(args.mix)
+    if not entries:
+        print("没有可回放的请求", file=sys.stderr)
+        return 1
+
+    report = run(args.target, entries, args.qps, args.duration, args.concurrency, args.timeout)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
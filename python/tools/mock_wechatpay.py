@@ -0,0 +1,467 @@
+"""本地微信支付API替身服务
+
+用于压测和联调，实现下单、查单、退款、商家转账、平台证书等接口，应答使用测试平台私钥签名，
+订单/转账状态到达终态后会向 ``--notify-url``（转账请求带有 notify_url 时发往该地址）发送加密并签名的回调通知。
+
+支持的接口:
+- POST /v3/pay/transactions/jsapi | native          下单，订单 NOTPAY -> SUCCESS
+- GET  /v3/pay/transactions/out-trade-no/{no}       查单
+- POST /v3/pay/transactions/out-trade-no/{no}/close 关单
+- POST /v3/refund/domestic/refunds                  申请退款，PROCESSING -> SUCCESS
+- GET  /v3/refund/domestic/refunds/{out_refund_no}  查询退款
+- POST /v3/fund-app/mch-transfer/transfer-bills     发起转账，ACCEPTED -> WAIT_USER_CONFIRM -> SUCCESS
+- GET  /v3/fund-app/mch-transfer/transfer-bills/out-bill-no/{no}  查询转账
+- GET  /v3/certificates                             下载平台证书
+
+用法（在 python 目录下执行）:
+    # 生成测试密钥并输出需要设置的环境变量
+    python -m tools.mock_wechatpay --generate-keys /tmp/wechatpay-mock
+    # 启动替身服务
+    python -m tools.mock_wechatpay --keys-dir /tmp/wechatpay-mock --port 9000 \\
+        --profile degraded --notify-url http://127.0.0.1:5000/wxpay/notify
+    # 应用侧设置 WECHAT_PAY_API_BASE=http://127.0.0.1:9000
+"""
+
+import argparse
+import heapq
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from base64 import b64encode
+from datetime import datetime, timedelta, timezone
+
+import requests
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from flask import Flask, Response, request
+from loguru import logger
+
+# 测试商户配置
+MOCK_API_V3_KEY = "0123456789abcdef0123456789abcdef"
+MOCK_PLATFORM_SERIAL_NO = "MOCKPLATFORMSERIAL0001"
+
+# 延迟与故障注入配置
+PROFILES = {
+    # 几乎无延迟，用于测量客户端自身的吞吐上限
+    "fast": {"latency": ("fixed", 2), "error_429": 0.0, "error_5xx": 0.0},
+    # 接近线上的正常延迟
+    "normal": {"latency": ("lognormal", 80, 0.4), "error_429": 0.0, "error_5xx": 0.001},
+    # 上游变慢并伴随少量限流与服务端错误
+    "degraded": {"latency": ("lognormal", 400, 0.8), "error_429": 0.05, "error_5xx": 0.05},
+    # 大面积故障
+    "outage": {"latency": ("uniform", 1000, 5000), "error_429": 0.1, "error_5xx": 0.5},
+}
+
+# 状态流转耗时(秒)，到达终态时发送回调通知
+TRANSITIONS = {
+    "order": [("NOTPAY", 0), ("SUCCESS", 5)],
+    "refund": [("PROCESSING", 0), ("SUCCESS", 3)],
+    "transfer": [("ACCEPTED", 0), ("WAIT_USER_CONFIRM", 1), ("SUCCESS", 5)],
+}
+
+NOTIFY_EVENTS = {
+    "order": ("TRANSACTION.SUCCESS", "transaction"),
+    "refund": ("REFUND.SUCCESS", "refund"),
+    "transfer": ("MCHTRANSFER.BILL.FINISHED", "mch_payment"),
+}
+
+
+def generate_keys(directory):
+    """生成测试用商户私钥和平台密钥对，返回应用侧需要设置的环境变量"""
+    os.makedirs(directory, exist_ok=True)
+    merchant_key = RSA.generate(2048)
+    platform_key = RSA.generate(2048)
+    files = {
+        "apiclient_key.pem": merchant_key.export_key(),
+        "apiclient_pub.pem": merchant_key.publickey().export_key(),
+        "platform_key.pem": platform_key.export_key(),
+        "platform_pub.pem": platform_key.publickey().export_key(),
+    }
+    for name, content in files.items():
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(content)
+    return {
+        "WECHAT_MCH_ID": "1900000001",
+        "WECHAT_APP_ID": "wx0000000000000001",
+        "WECHAT_APP_SECRET": "mock-app-secret",
+        "WECHAT_API_KEY": "mock-api-key",
+        "WECHAT_API_V3_KEY": MOCK_API_V3_KEY,
+        "WECHAT_PRIVATE_KEY_PATH": os.path.join(directory, "apiclient_key.pem"),
+        "WECHAT_CERT_SERIAL_NO": "MOCKMCHSERIAL0001",
+        "WECHAT_PAY_PLAT_CERT_PATH": os.path.join(directory, "platform_pub.pem"),
+    }
+
+
+class LatencyModel:
+    """按配置生成延迟(毫秒): fixed(ms) / uniform(min, max) / lognormal(median, sigma)"""
+
+    def __init__(self, spec):
+        self.kind, *self.params = spec
+
+    def sample_ms(self):
+        match self.kind:
+            case "fixed":
+                return self.params[0]
+            case "uniform":
+                return random.uniform(*self.params)
+            case "lognormal":
+                median, sigma = self.params
+                return random.lognormvariate(0, sigma) * median
+            case _:
+                return 0
+
+
+class MockState:
+    """替身服务的单据状态，状态随时间推进，到达终态时加入回调队列"""
+
+    def __init__(self, transitions=TRANSITIONS):
+        self.transitions = transitions
+        self.records = {"order": {}, "refund": {}, "transfer": {}}
+        self._lock = threading.Lock()
+        self._due = []  # (due_time, kind, key)
+        self._due_ready = threading.Condition(self._lock)
+
+    def create(self, kind, key, data):
+        """创建单据，单号重入时返回已有单据"""
+        with self._lock:
+            record = self.records[kind].get(key)
+            if record is not None:
+                return record, False
+            record = {**data, "_created": time.time()}
+            self.records[kind][key] = record
+            final_delay = self.transitions[kind][-1][1]
+            heapq.heappush(self._due, (record["_created"] + final_delay, kind, key))
+            self._due_ready.notify()
+            return record, True
+
+    def state_of(self, kind, record, now=None):
+        if record.get("_closed"):
+            return "CLOSED"
+        elapsed = (now or time.time()) - record["_created"]
+        state = self.transitions[kind][0][0]
+        for name, after in self.transitions[kind]:
+            if elapsed >= after:
+                state = name
+        return state
+
+    def get(self, kind, key):
+        with self._lock:
+            return self.records[kind].get(key)
+
+    def close(self, kind, key):
+        with self._lock:
+            record = self.records[kind].get(key)
+            if record is not None:
+                record["_closed"] = True
+            return record
+
+    def next_due(self, stop_event):
+        """阻塞直到有单据到达终态，返回 (kind, record)"""
+        with self._lock:
+            while not stop_event.is_set():
+                if self._due and self._due[0][0] <= time.time():
+                    _, kind, key = heapq.heappop(self._due)
+                    record = self.records[kind].get(key)
+                    if record is not None and not record.get("_closed"):
+                        return kind, record
+                    continue
+                timeout = self._due[0][0] - time.time() if self._due else 1.0
+                self._due_ready.wait(timeout=max(timeout, 0.01))
+        return None, None
+
+
+class MockWeChatPay:
+    """微信支付API替身"""
+
+    def __init__(self, platform_key, profile="fast", notify_url=None, api_v3_key=MOCK_API_V3_KEY, overrides=None):
+        self.platform_key = platform_key
+        self.api_v3_key = api_v3_key
+        self.notify_url = notify_url
+        config = {**PROFILES[profile], **(overrides or {})}
+        self.latency = LatencyModel(config["latency"])
+        self.error_429 = config["error_429"]
+        self.error_5xx = config["error_5xx"]
+        self.state = MockState()
+        self.stats = {"requests": 0, "injected_429": 0, "injected_5xx": 0, "notify_sent": 0, "notify_failed": 0}
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.app = self._create_app()
+
+    # ---- 签名与加密 ----
+
+    def sign_headers(self, body):
+        timestamp = str(int(time.time()))
+        nonce = uuid.uuid4().hex
+        message = f"{timestamp}\n{nonce}\n{body.decode('utf-8')}\n"
+        signature = pkcs1_15.new(self.platform_key).sign(SHA256.new(message.encode("utf-8")))
+        return {
+            "Wechatpay-Timestamp": timestamp,
+            "Wechatpay-Nonce": nonce,
+            "Wechatpay-Signature": b64encode(signature).decode("utf-8"),
+            "Wechatpay-Serial": MOCK_PLATFORM_SERIAL_NO,
+        }
+
+    def encrypt(self, plaintext, associated_data):
+        nonce = uuid.uuid4().hex[:12]
+        ciphertext = AESGCM(self.api_v3_key.encode("utf-8")).encrypt(
+            nonce.encode("utf-8"), plaintext.encode("utf-8"), associated_data.encode("utf-8")
+        )
+        return {
+            "algorithm": "AEAD_AES_256_GCM",
+            "ciphertext": b64encode(ciphertext).decode("utf-8"),
+            "nonce": nonce,
+            "associated_data": associated_data,
+        }
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def respond(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else b""
+        headers = self.sign_headers(body)
+        headers["Request-Id"] = uuid.uuid4().hex
+        return Response(body, status=status, headers=headers, content_type="application/json")
+
+    # ---- 接口实现 ----
+
+    def _create_app(self):
+        app = Flask("mock_wechatpay")
+
+        @app.before_request
+        def _inject():
+            self._count("requests")
+            time.sleep(self.latency.sample_ms() / 1000)
+            if not request.path.startswith("/v3/"):
+                return None
+            if not request.headers.get("Authorization", "").startswith("WECHATPAY2-SHA256-RSA2048 "):
+                return self.respond(401, {"code": "SIGN_ERROR", "message": "签名错误"})
+            roll = random.random()
+            if roll < self.error_429:
+                self._count("injected_429")
+                return self.respond(429, {"code": "FREQUENCY_LIMITED", "message": "频率超限"})
+            if roll < self.error_429 + self.error_5xx:
+                self._count("injected_5xx")
+                return self.respond(random.choice([500, 502, 503]), {"code": "SYSTEM_ERROR", "message": "系统错误"})
+            return None
+
+        @app.post("/v3/pay/transactions/<trade_type>")
+        def create_order(trade_type):
+            body = request.get_json()
+            record, _ = self.state.create(
+                "order",
+                body["out_trade_no"],
+                {
+                    "out_trade_no": body["out_trade_no"],
+                    "trade_type": trade_type.upper(),
+                    "amount": body.get("amount", {}),
+                    "appid": body.get("appid"),
+                    "mchid": body.get("mchid"),
+                    "payer": body.get("payer", {"openid": "oMockPayerOpenid"}),
+                    "transaction_id": f"42{int(time.time() * 1000)}{random.randint(1000, 9999)}",
+                },
+            )
+            if trade_type == "native":
+                return self.respond(200, {"code_url": f"weixin://wxpay/bizpayurl?pr={record['out_trade_no']}"})
+            return self.respond(200, {"prepay_id": f"wx{record['out_trade_no']}"})
+
+        @app.get("/v3/pay/transactions/out-trade-no/<out_trade_no>")
+        def query_order(out_trade_no):
+            record = self.state.get("order", out_trade_no)
+            if record is None:
+                return self.respond(404, {"code": "ORDER_NOT_EXIST", "message": "订单不存在"})
+            return self.respond(200, self._order_view(record))
+
+        @app.post("/v3/pay/transactions/out-trade-no/<out_trade_no>/close")
+        def close_order(out_trade_no):
+            record = self.state.get("order", out_trade_no)
+            if record is None:
+                return self.respond(404, {"code": "ORDER_NOT_EXIST", "message": "订单不存在"})
+            if self.state.state_of("order", record) == "SUCCESS":
+                return self.respond(400, {"code": "ORDERPAID", "message": "订单已支付"})
+            self.state.close("order", out_trade_no)
+            return self.respond(204, None)
+
+        @app.post("/v3/refund/domestic/refunds")
+        def refund():
+            body = request.get_json()
+            order = self.state.get("order", body.get("out_trade_no"))
+            amount = body.get("amount", {})
+            if order is not None and amount.get("refund", 0) > order["amount"].get("total", 0):
+                return self.respond(400, {"code": "INVALID_REQUEST", "message": "退款金额超过订单金额"})
+            record, _ = self.state.create(
+                "refund",
+                body["out_refund_no"],
+                {
+                    "out_refund_no": body["out_refund_no"],
+                    "out_trade_no": body.get("out_trade_no"),
+                    "refund_id": f"50{int(time.time() * 1000)}{random.randint(1000, 9999)}",
+                    "amount": amount,
+                },
+            )
+            return self.respond(200, self._refund_view(record))
+
+        @app.get("/v3/refund/domestic/refunds/<out_refund_no>")
+        def query_refund(out_refund_no):
+            record = self.state.get("refund", out_refund_no)
+            if record is None:
+                return self.respond(404, {"code": "RESOURCE_NOT_EXISTS", "message": "退款单不存在"})
+            return self.respond(200, self._refund_view(record))
+
+        @app.post("/v3/fund-app/mch-transfer/transfer-bills")
+        def create_transfer():
+            body = request.get_json()
+            record, _ = self.state.create(
+                "transfer",
+                body["out_bill_no"],
+                {
+                    "out_bill_no": body["out_bill_no"],
+                    "transfer_bill_no": f"13{int(time.time() * 1000)}{random.randint(1000, 9999)}",
+                    "transfer_amount": body.get("transfer_amount"),
+                    "transfer_scene_id": body.get("transfer_scene_id"),
+                    "openid": body.get("openid"),
+                    "_notify_url": body.get("notify_url"),
+                },
+            )
+            return self.respond(200, self._transfer_view(record))
+
+        @app.get("/v3/fund-app/mch-transfer/transfer-bills/out-bill-no/<out_bill_no>")
+        def query_transfer(out_bill_no):
+            record = self.state.get("transfer", out_bill_no)
+            if record is None:
+                return self.respond(404, {"code": "NOT_FOUND", "message": "记录不存在"})
+            return self.respond(200, self._transfer_view(record))
+
+        @app.get("/v3/certificates")
+        def certificates():
+            pem = self.platform_key.publickey().export_key().decode("utf-8")
+            now = datetime.now(timezone.utc)
+            return self.respond(
+                200,
+                {
+                    "data": [
+                        {
+                            "serial_no": MOCK_PLATFORM_SERIAL_NO,
+                            "effective_time": now.isoformat(),
+                            "expire_time": (now + timedelta(days=365)).isoformat(),
+                            "encrypt_certificate": self.encrypt(pem, "certificate"),
+                        }
+                    ]
+                },
+            )
+
+        @app.get("/mock/stats")
+        def mock_stats():
+            with self._stats_lock:
+                return dict(self.stats)
+
+        return app
+
+    def _public(self, record):
+        return {key: value for key, value in record.items() if not key.startswith("_")}
+
+    def _order_view(self, record):
+        state = self.state.state_of("order", record)
+        view = {**self._public(record), "trade_state": state}
+        if state != "SUCCESS":
+            view.pop("transaction_id", None)
+        return view
+
+    def _refund_view(self, record):
+        return {**self._public(record), "status": self.state.state_of("refund", record)}
+
+    def _transfer_view(self, record):
+        view = {**self._public(record), "state": self.state.state_of("transfer", record)}
+        view.pop("openid", None)
+        if view["state"] == "WAIT_USER_CONFIRM":
+            view["package_info"] = b64encode(record["out_bill_no"].encode("utf-8")).decode("utf-8")
+        return view
+
+    # ---- 回调通知 ----
+
+    def _notify_payload(self, kind, record):
+        views = {"order": self._order_view, "refund": self._refund_view, "transfer": self._transfer_view}
+        event_type, associated_data = NOTIFY_EVENTS[kind]
+        resource = self.encrypt(json.dumps(views[kind](record), ensure_ascii=False), associated_data)
+        resource["original_type"] = associated_data
+        return {
+            "id": uuid.uuid4().hex,
+            "create_time": datetime.now(timezone(timedelta(hours=8))).isoformat(timespec="seconds"),
+            "resource_type": "encrypt-resource",
+            "event_type": event_type,
+            "summary": "mock",
+            "resource": resource,
+        }
+
+    def _notify_loop(self):
+        while not self._stop.is_set():
+            kind, record = self.state.next_due(self._stop)
+            # 请求中带有 notify_url(例如转账的 TRANSFER_NOTIFY_URL)时发往该地址
+            notify_url = (record or {}).get("_notify_url") or self.notify_url
+            if record is None or not notify_url:
+                continue
+            body = json.dumps(self._notify_payload(kind, record), ensure_ascii=False).encode("utf-8")
+            headers = {**self.sign_headers(body), "Content-Type": "application/json"}
+            try:
+                response = requests.post(notify_url, data=body, headers=headers, timeout=5)
+                self._count("notify_sent" if response.status_code < 300 else "notify_failed")
+            except requests.RequestException as e:
+                self._count("notify_failed")
+                logger.warning("发送回调通知失败: {}", e)
+
+    def start_notifier(self):
+        thread = threading.Thread(target=self._notify_loop, name="mock-notifier", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地微信支付API替身服务")
+    parser.add_argument("--generate-keys", metavar="DIR", help="生成测试密钥到目录并输出环境变量后退出")
+    parser.add_argument("--keys-dir", help="测试密钥目录（包含 platform_key.pem）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="fast", help="延迟与故障注入配置")
+    parser.add_argument("--latency-ms", type=float, help="覆盖为固定延迟(毫秒)")
+    parser.add_argument("--error-429", type=float, help="覆盖 429 注入比例")
+    parser.add_argument("--error-5xx", type=float, help="覆盖 5xx 注入比例")
+    parser.add_argument("--notify-url", help="回调通知地址，例如 http://127.0.0.1:5000/wxpay/notify")
+    args = parser.parse_args(argv)
+
+    if args.generate_keys:
+        env = generate_keys(args.generate_keys)
+        env["WECHAT_PAY_API_BASE"] = f"http://{args.host}:{args.port}"
+        for key, value in env.items():
+            print(f"export {key}={value}")
+        return 0
+
+    if not args.keys_dir:
+        parser.error("需要 --keys-dir 或 --generate-keys")
+    with open(os.path.join(args.keys_dir, "platform_key.pem")) as f:
+        platform_key = RSA.import_key(f.read())
+
+    overrides = {}
+    if args.latency_ms is not None:
+        overrides["latency"] = ("fixed", args.latency_ms)
+    if args.error_429 is not None:
+        overrides["error_429"] = args.error_429
+    if args.error_5xx is not None:
+        overrides["error_5xx"] = args.error_5xx
+
+    mock = MockWeChatPay(platform_key, args.profile, args.notify_url, overrides=overrides)
+    mock.start_notifier()
+    logger.info("微信支付替身服务启动: http://{}:{} profile={}", args.host, args.port, args.profile)
+    mock.app.run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
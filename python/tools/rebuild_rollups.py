@@ -0,0 +1,79 @@
+"""重建 /stats 的汇总计数器
+
+计数器按事件表(ROLLUP_EVENTS_PATH)重新计算；加上 --backfill 时先从已有记录补录事件（已存在的事件不会重复计入）:
+- 订单状态库(ORDER_STORE_PATH): 已支付、已关闭等最终状态的订单，金额取自退款台账记录的订单金额
+- 退款台账(REFUND_LEDGER_PATH): 成功的退款
+- 发件箱(OUTBOX_PATH): 已受理的转账，状态为受理时的状态
+
+用法（在 python 目录下执行，环境变量与 app.py 一致）:
+    python -m tools.rebuild_rollups
+    python -m tools.rebuild_rollups --backfill
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.rollups import PAYMENT, TRANSFER, rollups  # noqa: E402
+
+
+def backfill_orders(events):
+    from services.pay.order_expiry import FINAL_TRADE_STATES, order_expiry
+    from services.pay.refund_ledger import refund_ledger
+
+    totals = dict(refund_ledger()._conn().execute("SELECT out_trade_no, total FROM refund_orders").fetchall())
+    rows = order_expiry().store._conn().execute("SELECT out_trade_no, state, updated_at FROM orders").fetchall()
+    count = 0
+    for out_trade_no, state, updated_at in rows:
+        if state not in FINAL_TRADE_STATES:
+            continue
+        # 已退款的订单先前支付成功，退款按退款单号单独计入
+        state = "SUCCESS" if state == "REFUND" else state
+        count += events.insert(PAYMENT, out_trade_no, state, "", totals.get(out_trade_no, 0), updated_at)
+    return count
+
+
+def backfill_refunds(events):
+    from services.pay.refund_ledger import refund_ledger
+
+    rows = refund_ledger()._conn().execute(
+        "SELECT out_refund_no, amount, updated_at FROM refunds WHERE status = 'SUCCESS'"
+    ).fetchall()
+    return sum(events.insert(PAYMENT, out_refund_no, "REFUND", "", amount, ts) for out_refund_no, amount, ts in rows)
+
+
+def backfill_transfers(events):
+    from services.outbox import DONE, TRANSFER as OUTBOX_TRANSFER
+    from services.outbox import outbox
+    from services.transfer.create_transfer import DEFAULT_TRANSFER_SCENE
+
+    rows = outbox().store._conn().execute(
+        "SELECT ref, payload, result, updated_at FROM outbox WHERE kind = ? AND status = ?", (OUTBOX_TRANSFER, DONE)
+    ).fetchall()
+    count = 0
+    for ref, payload, result, updated_at in rows:
+        data, result = json.loads(payload), json.loads(result or "{}")
+        scene = data.get("transfer_scene") or DEFAULT_TRANSFER_SCENE
+        if result.get("state"):
+            count += events.insert(TRANSFER, ref, result["state"], scene, data.get("amount", 0), updated_at)
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="重建汇总统计计数器")
+    parser.add_argument("--backfill", action="store_true", help="先从订单、退款、发件箱记录补录事件")
+    args = parser.parse_args(argv)
+
+    target = rollups()
+    if args.backfill:
+        for name, backfill in (("订单", backfill_orders), ("退款", backfill_refunds), ("转账", backfill_transfers)):
+            print(f"补录{name}事件: {backfill(target.events)}")
+    print(f"重建完成，事件数: {target.rebuild()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())